@@ -1,14 +1,44 @@
-from .character import Character
+from .character import Character, draw_response_words, response_max_tokens
 from .conversations import Conversations, Interlocutor
 from .voice import VoiceGenerator
 from .logger import Logger
 from .console import Console
+from .session import SessionStore
+from .archive import AudioArchive
+from .audio import read_wave
+from .scheduler import PlaybackScheduler, wave_duration
+from .retry import CircuitOpenError, retry_metrics
+from .hedge import hedge_metrics
+from .engine import EngineUnavailableError
+from .profiler import ThreadProfiler
+from .cassette import Cassette, CassetteMissError, use_cassette
+from .filler import FillerBank
+from .governor import ThroughputGovernor
+from .router import CandidateRouter
 
 __all__ = [
     "Character",
+    "draw_response_words",
+    "response_max_tokens",
     "Conversations",
     "Interlocutor",
     "VoiceGenerator",
     "Logger",
     "Console",
+    "SessionStore",
+    "AudioArchive",
+    "read_wave",
+    "PlaybackScheduler",
+    "wave_duration",
+    "CircuitOpenError",
+    "retry_metrics",
+    "hedge_metrics",
+    "EngineUnavailableError",
+    "ThreadProfiler",
+    "Cassette",
+    "CassetteMissError",
+    "use_cassette",
+    "FillerBank",
+    "ThroughputGovernor",
+    "CandidateRouter",
 ]
\ No newline at end of file
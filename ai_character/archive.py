@@ -0,0 +1,144 @@
+import os
+import mmap
+import struct
+import threading
+from collections import namedtuple
+
+from .audio import AudioFormat, read_wave, write_wave
+
+INDEX_MAGIC = b'AIDX0001'
+# utterance_id, character, offset, length, rate, channels, width
+INDEX_RECORD = struct.Struct('<Q32sQQIHH')
+
+ArchiveEntry = namedtuple('ArchiveEntry', ['utterance_id', 'character', 'offset', 'length', 'format'])
+
+class AudioArchive(object):
+    """セッション単位の音声アーカイブ
+
+    ・合成した音声のPCMを1本のコンテナファイル（session_audio.dat）に追記していく。
+    ・インデックス（session_audio.idx）は固定長レコードの列。
+      発話ID、キャラクターID、オフセット、長さ、フォーマットを持つ。
+    ・読み出しはコンテナをmmapして該当範囲を切り出すだけなので、再合成せずに再生・書き出しできる。
+
+    """
+
+    def __init__(self, archive_dir:str, logger=None):
+        self.logger = logger
+
+        if not os.path.isdir(archive_dir):
+            os.makedirs(archive_dir)
+
+        self.data_path = os.path.join(archive_dir, 'session_audio.dat')
+        self.index_path = os.path.join(archive_dir, 'session_audio.idx')
+
+        self._lock = threading.Lock()
+        self._entries = {}
+        self._mmap = None
+        self._mmap_size = 0
+
+        self.__load_index()
+        self._next_id = max(self._entries.keys(), default=0) + 1
+
+        self._data_file = open(self.data_path, 'ab')
+        self._index_file = open(self.index_path, 'ab')
+        if self._index_file.tell() == 0:
+            self._index_file.write(INDEX_MAGIC)
+            self._index_file.flush()
+
+        self.__log('Open : {} ({} entries)', self.data_path, len(self._entries))
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def __load_index(self):
+        if not os.path.isfile(self.index_path):
+            return
+
+        with open(self.index_path, 'rb') as f:
+            if f.read(len(INDEX_MAGIC)) != INDEX_MAGIC:
+                raise ValueError('Invalid audio archive index : {}'.format(self.index_path))
+            while True:
+                record = f.read(INDEX_RECORD.size)
+                if len(record) < INDEX_RECORD.size:
+                    # 書き込み途中で終わったレコードは捨てる
+                    break
+                entry = self.__unpack(record)
+                self._entries[entry.utterance_id] = entry
+
+    def __unpack(self, record:bytes) -> ArchiveEntry:
+        utterance_id, character, offset, length, rate, channels, width = INDEX_RECORD.unpack(record)
+        return ArchiveEntry(utterance_id,
+                            character.rstrip(b'\0').decode('utf-8', 'ignore'),
+                            offset,
+                            length,
+                            AudioFormat(rate, channels, width))
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    def entries(self) -> list:
+        with self._lock:
+            return sorted(self._entries.values(), key=lambda e: e.utterance_id)
+
+    def append(self, character:str, pcm:bytes, fmt:AudioFormat) -> int:
+        """PCMを追記し、発話IDを返す。"""
+        with self._lock:
+            utterance_id = self._next_id
+            self._next_id += 1
+            offset = self._data_file.seek(0, os.SEEK_END)
+            self._data_file.write(pcm)
+            self._data_file.flush()
+
+            entry = ArchiveEntry(utterance_id, character, offset, len(pcm), fmt)
+            self._index_file.write(INDEX_RECORD.pack(utterance_id,
+                                                    character.encode('utf-8')[:32],
+                                                    offset,
+                                                    len(pcm),
+                                                    fmt.rate,
+                                                    fmt.channels,
+                                                    fmt.width))
+            self._index_file.flush()
+            self._entries[utterance_id] = entry
+
+        self.__log('Append : {} {} ({} bytes)', utterance_id, character, len(pcm))
+
+        return utterance_id
+
+    def append_wave(self, wav:str, character:str) -> int:
+        pcm, fmt = read_wave(wav)
+        return self.append(character, pcm, fmt)
+
+    def read(self, utterance_id:int):
+        """発話IDの (PCM, AudioFormat) を返す。"""
+        with self._lock:
+            entry = self._entries[utterance_id]
+            end = entry.offset + entry.length
+            if not entry.length:
+                return b'', entry.format
+            if self._mmap is None or self._mmap_size < end:
+                # 追記で伸びていたらmmapし直す
+                if self._mmap is not None:
+                    self._mmap.close()
+                with open(self.data_path, 'rb') as f:
+                    self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._mmap_size = len(self._mmap)
+            pcm = self._mmap[entry.offset:end]
+
+        return pcm, entry.format
+
+    def export_wave(self, utterance_id:int, path:str) -> str:
+        pcm, fmt = self.read(utterance_id)
+        write_wave(path, pcm, fmt)
+        self.__log('Export : {} -> {}', utterance_id, path)
+        return path
+
+    def close(self):
+        with self._lock:
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+            self._data_file.close()
+            self._index_file.close()
@@ -0,0 +1,273 @@
+import os
+import threading
+import time
+import wave
+from collections import namedtuple
+
+try:
+    import audioop
+except ImportError: # Python 3.13以降
+    audioop = None
+
+AudioFormat = namedtuple('AudioFormat', ['rate', 'channels', 'width'])
+
+def read_wave(wav:str):
+    """wavファイルを読み込み (PCM, AudioFormat) を返す。"""
+    with wave.open(wav, mode='r') as wf:
+        fmt = AudioFormat(wf.getframerate(), wf.getnchannels(), wf.getsampwidth())
+        pcm = wf.readframes(wf.getnframes())
+    return pcm, fmt
+
+def write_wave(wav:str, pcm:bytes, fmt:AudioFormat):
+    with wave.open(wav, mode='wb') as wf:
+        wf.setframerate(fmt.rate)
+        wf.setnchannels(fmt.channels)
+        wf.setsampwidth(fmt.width)
+        wf.writeframes(pcm)
+
+def convert_pcm(pcm:bytes, src:AudioFormat, dst:AudioFormat) -> bytes:
+    """PCMをdstのフォーマットに変換する。変換できない場合はNone。"""
+    if src == dst:
+        return pcm
+    if audioop is None:
+        return None
+
+    if src.width != dst.width:
+        pcm = audioop.lin2lin(pcm, src.width, dst.width)
+    if src.channels == 2 and dst.channels == 1:
+        pcm = audioop.tomono(pcm, dst.width, 0.5, 0.5)
+    elif src.channels == 1 and dst.channels == 2:
+        pcm = audioop.tostereo(pcm, dst.width, 1, 1)
+    elif src.channels != dst.channels:
+        return None
+    if src.rate != dst.rate:
+        pcm, _ = audioop.ratecv(pcm, dst.width, dst.channels, src.rate, dst.rate, None)
+    return pcm
+
+class PyAudioSink(object):
+    """PyAudioの出力ストリームをフォーマットごとに1本だけ開いて使い回す。"""
+
+    def __init__(self):
+        import pyaudio
+        self._pyaudio = pyaudio.PyAudio()
+        self._streams = {}
+
+    def write(self, fmt:AudioFormat, data:bytes):
+        if not fmt in self._streams:
+            self._streams[fmt] = self._pyaudio.open(format=self._pyaudio.get_format_from_width(fmt.width),
+                                                    channels=fmt.channels,
+                                                    rate=fmt.rate,
+                                                    output=True)
+        self._streams[fmt].write(data)
+
+    def close(self):
+        for stream in self._streams.values():
+            stream.stop_stream()
+            stream.close()
+        self._streams = {}
+        self._pyaudio.terminate()
+
+class NullSink(object):
+    """音声デバイスの無い環境用。再生時間ぶん待つだけで何も出力しない。"""
+
+    def write(self, fmt:AudioFormat, data:bytes):
+        time.sleep(len(data) / float(fmt.rate * fmt.channels * fmt.width))
+
+    def close(self):
+        pass
+
+class WaveFileSink(object):
+    """音声デバイスの無い環境用。再生した音声を1本のwavファイルに書き出す。"""
+
+    def __init__(self, path:str):
+        self.path = path
+        self._files = {}
+
+        dir_path = os.path.dirname(os.path.abspath(path))
+        if not os.path.isdir(dir_path):
+            os.makedirs(dir_path)
+
+    def write(self, fmt:AudioFormat, data:bytes):
+        if not fmt in self._files:
+            path = self.path
+            if self._files:
+                # 2つ目以降のフォーマットは別ファイル
+                root, ext = os.path.splitext(self.path)
+                path = '{}_{}hz_{}ch{}'.format(root, fmt.rate, fmt.channels, ext)
+            wf = wave.open(path, mode='wb')
+            wf.setframerate(fmt.rate)
+            wf.setnchannels(fmt.channels)
+            wf.setsampwidth(fmt.width)
+            self._files[fmt] = wf
+        self._files[fmt].writeframes(data)
+
+    def close(self):
+        for wf in self._files.values():
+            wf.close()
+        self._files = {}
+
+def create_sink(name:str, file_path:str=''):
+    if name == 'null':
+        return NullSink()
+    if name == 'file':
+        return WaveFileSink(file_path)
+    return PyAudioSink()
+
+class PlaybackHandle(object):
+    """AudioEngine.playの戻り値。再生完了を待つのに使う。"""
+
+    def __init__(self, end:int):
+        self.end = end # リングバッファに書いた通算バイト数の終端
+        self._done = threading.Event()
+
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    def wait(self, timeout:float=None) -> bool:
+        return self._done.wait(timeout)
+
+class RingBuffer(object):
+    """固定サイズのバイトリングバッファ。writeは空きが出るまで、readはデータが来るまでブロックする。"""
+
+    def __init__(self, size:int):
+        self.size = size
+        self._buf = bytearray(size)
+        self._read_pos = 0
+        self._length = 0
+        self._closed = False
+        self._cond = threading.Condition()
+
+        # 通算バイト数（PlaybackHandleの完了判定に使う）
+        self.total_written = 0
+        self.total_read = 0
+
+    def __len__(self):
+        with self._cond:
+            return self._length
+
+    def write(self, data:bytes):
+        view = memoryview(data)
+        while len(view):
+            with self._cond:
+                self._cond.wait_for(lambda: self._length < self.size or self._closed)
+                if self._closed:
+                    return
+                n = min(len(view), self.size - self._length)
+                write_pos = (self._read_pos + self._length) % self.size
+                first = min(n, self.size - write_pos)
+                self._buf[write_pos:write_pos + first] = view[:first]
+                self._buf[:n - first] = view[first:n]
+                self._length += n
+                self.total_written += n
+                self._cond.notify_all()
+            view = view[n:]
+
+    def read(self, max_bytes:int, timeout:float=None) -> bytes:
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._length or self._closed, timeout=timeout):
+                return b''
+            n = min(max_bytes, self._length)
+            first = min(n, self.size - self._read_pos)
+            data = bytes(self._buf[self._read_pos:self._read_pos + first]) + bytes(self._buf[:n - first])
+            self._read_pos = (self._read_pos + n) % self.size
+            self._length -= n
+            self.total_read += n
+            self._cond.notify_all()
+            return data
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+class AudioEngine(object):
+    """常駐する音声出力エンジン
+
+    ・出力ストリームは開きっぱなしにして、発話ごとのデバイスopen/closeをなくす。
+    ・playはPCMをリングバッファに書くだけ。書き込みスレッドがバッファからストリームへ流し続けるので、
+      前の発話が終わる前に次の発話を入れておけば隙間なく再生される。
+    ・フォーマット変換はplayの時に1回だけ行う。変換できなければそのフォーマットのストリームで再生する。
+
+    """
+
+    def __init__(self, sink, fmt:AudioFormat, chunk_frames:int=1024, buffer_seconds:float=1.0, logger=None):
+        self.sink = sink
+        self.format = fmt
+        self.logger = logger
+
+        frame_bytes = fmt.channels * fmt.width
+        self.chunk_bytes = chunk_frames * frame_bytes
+        self._ring = RingBuffer(max(self.chunk_bytes, int(fmt.rate * buffer_seconds) * frame_bytes))
+
+        # リングバッファ内のPCMのフォーマット（変換できなかった発話の時だけself.formatと異なる）
+        self._ring_format = fmt
+        self._handles = []
+        self._play_lock = threading.Lock()
+        self._handles_lock = threading.Lock()
+
+        self._exit_flag = False
+        self._thread = threading.Thread(target=self.__writer_thread, name='AudioEngine', daemon=True)
+        self._thread.start()
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def __writer_thread(self):
+        while not self._exit_flag:
+            data = self._ring.read(self.chunk_bytes, timeout=0.1)
+            if data:
+                # フォーマットの切り替えはバッファが空の時だけ行われる
+                self.sink.write(self._ring_format, data)
+            self.__complete_handles()
+
+    def __complete_handles(self):
+        total_read = self._ring.total_read
+        with self._handles_lock:
+            while self._handles and self._handles[0].end <= total_read:
+                self._handles.pop(0)._done.set()
+
+    def play(self, pcm:bytes, fmt:AudioFormat) -> PlaybackHandle:
+        """PCMを再生キューに追加し、PlaybackHandleを返す（再生完了は待たない）。"""
+
+        converted = convert_pcm(pcm, fmt, self.format)
+
+        with self._play_lock:
+            if converted is None:
+                # 変換できないフォーマットはバッファが空になるのを待ってから、そのフォーマットで流す
+                self.__log('Cannot convert {} -> {}. Play as is.', fmt, self.format, lv='warning')
+                self.drain()
+                self._ring_format = fmt
+            else:
+                pcm = converted
+                if self._ring_format != self.format:
+                    self.drain()
+                    self._ring_format = self.format
+
+            with self._handles_lock:
+                handle = PlaybackHandle(self._ring.total_written + len(pcm))
+                self._handles.append(handle)
+
+            self._ring.write(pcm)
+
+        return handle
+
+    def drain(self):
+        """キューに入っている発話がすべて再生されるまで待つ。"""
+        with self._handles_lock:
+            handle = self._handles[-1] if self._handles else None
+        while handle and not handle.wait(0.1):
+            if self._exit_flag:
+                break
+
+    def close(self):
+        self.drain()
+        self._exit_flag = True
+        self._ring.close()
+        self._thread.join()
+        self.sink.close()
+        with self._handles_lock:
+            for handle in self._handles:
+                handle._done.set()
+            self._handles = []
@@ -0,0 +1,252 @@
+import os
+import json
+import time
+import random
+import hashlib
+import threading
+from collections import deque
+from datetime import datetime
+
+from openai.util import convert_to_openai_object
+
+CASSETTE_VERSION = 1
+
+class CassetteMissError(Exception):
+    """再生モードで、リクエストに対応する録音が無いことを表す。"""
+
+    def __init__(self, kind:str):
+        super().__init__('No recorded response for {}'.format(kind))
+        self.kind = kind
+
+class Cassette(object):
+    """OpenAI・VOICEVOXへのリクエストとレスポンスの録音・再生
+
+    ・record : 実際に呼び出し、リクエスト・レスポンス・レイテンシをcassette.jsonlに追記する。
+      音声（bytes）はblobs/に別ファイルで保存する。ユーザー入力もターン番号付きで記録する。
+    ・replay : 録音したレスポンスを返す。ネットワークには出ない。
+      同じリクエスト（ハッシュが一致）を優先し、無ければ同じ種類の録音を順番に使う。
+      latencyがoriginalなら録音時と同じだけ待ち、zeroなら待たない。
+    ・乱数のシードも記録・再現するので、返答のワード数や判別不能時の抽選も同じになる。
+
+    """
+
+    MODES = ('record', 'replay')
+    LATENCIES = ('original', 'zero')
+
+    def __init__(self, path:str, mode:str='record', latency:str='original', logger=None):
+        if not mode in self.MODES:
+            raise ValueError('Unknown cassette mode : {}'.format(mode))
+        if not latency in self.LATENCIES:
+            raise ValueError('Unknown replay latency : {}'.format(latency))
+        self.path = os.path.abspath(path)
+        self.mode = mode
+        self.latency = latency
+        self.logger = logger
+
+        self.jsonl_path = os.path.join(self.path, 'cassette.jsonl')
+        self.blob_dir = os.path.join(self.path, 'blobs')
+
+        self._lock = threading.Lock()
+        self._seq = 0
+        self._start = time.monotonic()
+
+        if mode == 'record':
+            if not os.path.isdir(self.blob_dir):
+                os.makedirs(self.blob_dir)
+            self.seed = random.randrange(2 ** 32)
+            self._file = open(self.jsonl_path, 'w', encoding='utf-8')
+            self.__write({"kind": "header",
+                            "version": CASSETTE_VERSION,
+                            "seed": self.seed,
+                            "created": datetime.now().isoformat(timespec='seconds')})
+        else:
+            self._file = None
+            self.__load()
+
+        random.seed(self.seed)
+        self.__log('Cassette {} : {} (seed={})', mode, self.path, self.seed)
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    @property
+    def replaying(self) -> bool:
+        return self.mode == 'replay'
+
+    def __key(self, kind:str, request:dict) -> str:
+        data = json.dumps([kind, request], sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+    def __elapsed(self) -> float:
+        return time.monotonic() - self._start
+
+    def __wait(self, seconds:float):
+        if self.latency == 'original' and seconds > 0:
+            time.sleep(seconds)
+
+    # ---- 録音 ----
+
+    def __write(self, entry:dict):
+        with self._lock:
+            entry["seq"] = self._seq
+            self._seq += 1
+            self._file.write(json.dumps(entry, ensure_ascii=False) + '\n')
+            self._file.flush()
+
+    def __encode(self, response):
+        if isinstance(response, bytes):
+            with self._lock:
+                blob = os.path.join('blobs', '{:06d}.bin'.format(self._seq))
+                self._seq += 1
+            with open(os.path.join(self.path, blob), 'wb') as f:
+                f.write(response)
+            return {"blob": blob}
+        return {"object": response}
+
+    # ---- 再生 ----
+
+    def __load(self):
+        self._by_key = {}
+        self._by_kind = {}
+        self._used = set()
+        self._user_inputs = deque()
+        self.seed = None
+
+        with open(self.jsonl_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                entry = json.loads(line)
+                kind = entry["kind"]
+                if kind == 'header':
+                    if entry["version"] != CASSETTE_VERSION:
+                        raise ValueError('Unsupported cassette version : {}'.format(entry["version"]))
+                    self.seed = entry["seed"]
+                elif kind == 'user_input':
+                    self._user_inputs.append(entry)
+                else:
+                    self._by_key.setdefault(entry["key"], deque()).append(entry)
+                    self._by_kind.setdefault(kind, deque()).append(entry)
+
+        self.__log('Load cassette : {} kinds / {} user inputs',
+                    {kind: len(entries) for kind, entries in self._by_kind.items()}, len(self._user_inputs))
+
+    def __take(self, kind:str, key:str) -> dict:
+        with self._lock:
+            for entries in (self._by_key.get(key), self._by_kind.get(kind)):
+                while entries:
+                    entry = entries.popleft()
+                    if not entry["seq"] in self._used:
+                        self._used.add(entry["seq"])
+                        return entry
+        raise CassetteMissError(kind)
+
+    def __chunks_to_object(self, chunks:list) -> dict:
+        """ストリーミングで録音したものを、通常のレスポンスの形にする（usageは概算）。"""
+        content = ''.join(chunk["choices"][0]["delta"].get("content") or '' for offset, chunk in chunks)
+        tokens = sum(1 for offset, chunk in chunks if chunk["choices"][0]["delta"].get("content"))
+        finish_reason = next((chunk["choices"][0].get("finish_reason") for offset, chunk in reversed(chunks) 
+                                if chunk["choices"][0].get("finish_reason")), "stop")
+        return {"choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": finish_reason}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": tokens, "total_tokens": tokens}}
+
+    def __object_to_chunks(self, data:dict, latency:float) -> list:
+        content = data["choices"][0]["message"]["content"]
+        return [[latency, {"choices": [{"index": 0, "delta": {"content": content}, 
+                                        "finish_reason": data["choices"][0].get("finish_reason")}]}]]
+
+    def __decode(self, response:dict):
+        if "blob" in response:
+            with open(os.path.join(self.path, response["blob"]), 'rb') as f:
+                return f.read()
+        return convert_to_openai_object(response["object"])
+
+    # ---- 呼び出し ----
+
+    def call(self, kind:str, request:dict, fn):
+        """fn()の結果を録音する、または録音から返す。"""
+
+        key = self.__key(kind, request)
+        if self.replaying:
+            entry = self.__take(kind, key)
+            self.__wait(entry["latency"])
+            # 録音時と再生時で、ストリーミングするかどうかが変わることがある（再生中かどうかで決まるので）
+            if "chunks" in entry:
+                return convert_to_openai_object(self.__chunks_to_object(entry["chunks"]))
+            return self.__decode(entry["response"])
+
+        start = time.monotonic()
+        response = fn()
+        latency = time.monotonic() - start
+        self.__write({"kind": kind,
+                        "key": key,
+                        "t": self.__elapsed(),
+                        "latency": latency,
+                        "request": request,
+                        "response": self.__encode(response)})
+        return response
+
+    def stream(self, kind:str, request:dict, fn):
+        """ストリーミングのレスポンス（チャンクのイテレータ）を、チャンクごとの到着時刻付きで録音・再生する。"""
+
+        key = self.__key(kind, request)
+        if self.replaying:
+            entry = self.__take(kind, key)
+            chunks = entry.get("chunks") or self.__object_to_chunks(entry["response"]["object"], entry["latency"])
+            prev = 0.0
+            for offset, chunk in chunks:
+                self.__wait(offset - prev)
+                prev = offset
+                yield convert_to_openai_object(chunk)
+            return
+
+        start = time.monotonic()
+        chunks = []
+        for chunk in fn():
+            chunks.append([time.monotonic() - start, chunk])
+            yield chunk
+        self.__write({"kind": kind,
+                        "key": key,
+                        "t": self.__elapsed(),
+                        "latency": time.monotonic() - start,
+                        "request": request,
+                        "chunks": chunks})
+
+    def record_user_input(self, content:str, turn:int):
+        if self.replaying:
+            return
+        self.__write({"kind": "user_input", "content": content, "turn": turn, "t": self.__elapsed()})
+
+    def next_user_input(self):
+        """次のユーザー入力の (内容, ターン番号) を返す。originalなら録音時の時刻まで待つ。無ければNone。"""
+        with self._lock:
+            if not self._user_inputs:
+                return None
+            entry = self._user_inputs.popleft()
+        self.__wait(entry["t"] - self.__elapsed())
+        return entry["content"], entry["turn"]
+
+    def close(self):
+        if self._file:
+            self._file.close()
+            self._file = None
+
+_active = None
+
+def use_cassette(cassette:Cassette):
+    global _active
+    _active = cassette
+
+def active_cassette():
+    return _active
+
+def cassette_call(kind:str, request:dict, fn):
+    """カセットが有効ならそれを通してfn()を呼ぶ。"""
+    if _active is None:
+        return fn()
+    return _active.call(kind, request, fn)
+
+def cassette_stream(kind:str, request:dict, fn):
+    if _active is None:
+        return fn()
+    return _active.stream(kind, request, fn)
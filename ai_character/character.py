@@ -1,10 +1,17 @@
 import os
+import re
 import json
 import random
+import time
 import openai
 
 from .console import Console
+from .logger import LazyJson
+from .memory import MemoryIndex, estimate_tokens
 from .retry import retry_decorator
+from .hedge import hedged_call, remaining_seconds
+from .history import BoundedHistory, CompletionRecord, SegmentTable
+from .cassette import cassette_stream
 from .prompts import (
     SYSTEM_TEMPLATE, 
     CONVERSATION_USER_TEMPLATE
@@ -20,9 +27,50 @@ TEMPERATURE = settings_dict["talk"]["completion"]["temperature"]
 TOP_P = settings_dict["talk"]["completion"]["top_p"]
 P_PENALTY = settings_dict["talk"]["completion"]["presence_penalty"]
 F_PENALTY = settings_dict["talk"]["completion"]["frequency_penalty"]
+MAX_TOKENS = settings_dict["talk"]["completion"]["max_tokens"] # nullの場合はワード数から決める
+STOP = settings_dict["talk"]["completion"]["stop"]
+STREAM = settings_dict["talk"]["stream"] # トークンが届くたびにコンソールに出す
 
 RESPONSE_MIN = settings_dict["talk"]["response_min"]
 RESPONSE_MAX = settings_dict["talk"]["response_max"]
+TOKENS_PER_WORD = settings_dict["talk"]["tokens_per_word"] # ワード数 -> max_tokens換算係数
+MAX_TOKENS_MARGIN = settings_dict["talk"]["max_tokens_margin"] # 文末が切れないための余裕
+
+MEMORY_ENABLED = settings_dict["memory"]["enabled"] # 過去セッションの長期記憶を使うかどうか
+MEMORY_TOP_K = settings_dict["memory"]["top_k"]
+MEMORY_MAX_TOKENS = settings_dict["memory"]["max_tokens"] # systemプロンプトに入れる記憶の上限
+MEMORY_NGRAM_MIN = settings_dict["memory"]["ngram_min"]
+MEMORY_NGRAM_MAX = settings_dict["memory"]["ngram_max"]
+MEMORY_WINDOW = settings_dict["memory"]["window"]
+MEMORY_QUERY_CHARS = settings_dict["memory"]["query_chars"] # 検索に使う直近の会話の文字数
+
+FILLER_DEFAULT = settings_dict["filler"]["default"] # キャラデータにfillersが無い場合のつなぎの言葉
+
+HISTORY_MAX_COMPLETIONS = settings_dict["history"]["max_resident_completions"] # メモリに置くCompletion履歴の件数
+HISTORY_MAX_SEGMENTS = settings_dict["history"]["max_segments"]
+
+# 文の終わり（max_tokensで切れた返答を、最後の文までに詰める）
+SENTENCE_END_PATTERN = re.compile(r'[。！？!?…\n]')
+
+# プロンプト断片の共有テーブル。プロフィール等の毎回同じ部分は、全キャラ・全セッションで1つぶんのメモリになる
+_segment_table = SegmentTable(HISTORY_MAX_SEGMENTS)
+
+def draw_response_words() -> int:
+    """応答のワード数を決める（2回コールとfusedモードで同じ決め方にする）"""
+    return random.randint(RESPONSE_MIN, RESPONSE_MAX)
+
+def response_max_tokens(words:int) -> int:
+    """max_tokensを返す。設定が無ければワード数から換算する。"""
+    if MAX_TOKENS:
+        return MAX_TOKENS
+    return int(words * TOKENS_PER_WORD) + MAX_TOKENS_MARGIN
+
+def trim_incomplete_sentence(text:str) -> str:
+    """最後の文の終わりまでに詰める。文の終わりが1つも無ければそのまま返す。"""
+    ends = [m.end() for m in SENTENCE_END_PATTERN.finditer(text)]
+    if not ends:
+        return text
+    return text[:ends[-1]].rstrip()
 
 class Character(object):
 
@@ -51,6 +99,8 @@ class Character(object):
         self.voice_speed = 0
         self.voice_pitch = 0
         self.voice_intonation = 0
+        self.voice_fillers = [] # つなぎの言葉（「えっと」等）
+        self.aliases = [] # 名前以外の呼ばれ方（応答者の候補を絞るときに使う）
         
         # ペルソナデータの読み込み
         self.__log('Load Character ...')
@@ -63,16 +113,31 @@ class Character(object):
             os.makedirs(self.comp_log_dir)
         
         # Completion履歴。送ったmessagesと、返ってきた文、使用トークン数
-        self.completion_log = []
+        # 古いものは<id>_completion_log.jsonlに書き出してメモリから外す
+        self.completion_log = BoundedHistory(os.path.join(self.comp_log_dir, '{}_completion_log.jsonl'.format(self.id)), 
+                                            lambda data: CompletionRecord.from_dict(data, _segment_table), 
+                                            HISTORY_MAX_COMPLETIONS)
+
+        # 長期記憶（過去セッションの要約と会話ログの索引）
+        self.memory = None
+        if MEMORY_ENABLED:
+            self.memory = MemoryIndex(log_dir, 
+                                        ch_id, 
+                                        exclude_session=session_id, 
+                                        ngram_min=MEMORY_NGRAM_MIN, 
+                                        ngram_max=MEMORY_NGRAM_MAX, 
+                                        window=MEMORY_WINDOW, 
+                                        logger=logger)
+            self.memory.build()
 
     def __verbose(self, msg:str, col:str='', force:bool=False):
         if self.verbose or force:
             self.console('[{}] {}'.format(self.id, msg), col=col)
 
-    def __log(self, msg:str, lv='info'):
+    def __log(self, msg:str, *args, lv='info'):
         if not self.logger:
             return
-        self.logger('[{}] {}'.format(self.id, msg), cls=self, lv=lv)
+        self.logger('[{}] '.format(self.id) + msg, *args, cls=self, lv=lv)
 
     def __load_character(self):
         character_data = self.__character_loader(self.data_dir)
@@ -85,12 +150,14 @@ class Character(object):
         
         profile_dict, self.talksample, self.talkstyle = character_data
         self.name = profile_dict['profile']['name']
+        self.aliases = profile_dict['profile'].get('aliases', [])
         self.profile = self.__profile_dict_to_str(profile_dict['profile'])
 
         self.voice_speaker_id = int(profile_dict['voice']['speaker_id'])
         self.voice_speed = float(profile_dict['voice']['speed'])
         self.voice_pitch = float(profile_dict['voice']['pitch'])
         self.voice_intonation = float(profile_dict['voice']['intonation'])
+        self.voice_fillers = profile_dict['voice'].get('fillers', FILLER_DEFAULT)
 
         self.console.set_default_color(profile_dict['console_color'])
 
@@ -134,51 +201,122 @@ class Character(object):
 
         return '\n'.join(profile_list)
     
-    @retry_decorator
-    def __completion(self, messages:list):
+    @retry_decorator('talk')
+    def __completion(self, messages:list, max_tokens:int):
         """OpenAIのGPT-3.5モデルを使用して、ユーザーの入力に基づいてテキスト生成を行う。"""
 
-        msg = json.dumps(messages, indent=4, ensure_ascii=False)
-        self.__log('Sent message list :\n{}'.format(msg), lv='debug')
+        self.__log('Sent message list :\n{}', LazyJson(messages), lv='debug')
 
-        response = openai.ChatCompletion.create(
+        response = hedged_call('talk', openai.ChatCompletion.create, 
             model=MODEL_NAME,
             temperature=TEMPERATURE, 
             top_p=TOP_P, 
             presence_penalty=P_PENALTY, 
             frequency_penalty=F_PENALTY, 
+            max_tokens=max_tokens, 
+            stop=STOP, 
             messages=messages
         )
         ai_message_text = response.choices[0].message.content
 
-        return ai_message_text, response['usage']
+        return ai_message_text, response['usage'], response.choices[0].get('finish_reason')
+
+    @retry_decorator('talk')
+    def __completion_stream(self, messages:list, max_tokens:int, stream):
+        """ストリーミングでテキスト生成し、トークンが届くたびにstream.write()する。
+
+        ・途中まで出したものは複製できないのでヘッジはしない（タイムアウトだけ付ける）。
+        ・usageは返ってこないので、promptは文字数から、completionは受け取ったチャンク数で概算する。
+        """
+
+        self.__log('Sent message list :\n{}', LazyJson(messages), lv='debug')
+
+        # リトライ時は書きかけの行を捨てる
+        stream.restart()
+
+        request = dict(
+            model=MODEL_NAME,
+            temperature=TEMPERATURE, 
+            top_p=TOP_P, 
+            presence_penalty=P_PENALTY, 
+            frequency_penalty=F_PENALTY, 
+            max_tokens=max_tokens, 
+            stop=STOP, 
+            messages=messages, 
+            stream=True
+        )
+
+        start = time.monotonic()
+        response = cassette_stream('talk', request, 
+                                    lambda: openai.ChatCompletion.create(request_timeout=remaining_seconds('talk'), **request))
+
+        tokens = []
+        finish_reason = None
+        for chunk in response:
+            finish_reason = chunk['choices'][0].get('finish_reason') or finish_reason
+            token = chunk['choices'][0]['delta'].get('content')
+            if not token:
+                continue
+            if not tokens:
+                self.__log('First token : {:.2f} sec', time.monotonic() - start)
+            tokens.append(token)
+            stream.write(token)
+        ai_message_text = ''.join(tokens)
+
+        prompt_tokens = sum(estimate_tokens(message['content']) for message in messages)
+        usage = {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": len(tokens),
+            "total_tokens": prompt_tokens + len(tokens),
+            "estimated": True,
+        }
 
-    def create_system_message(self, talk_summary:str='', lines_of_conversations:str=''):
+        return ai_message_text, usage, finish_reason
+
+    def recall(self, user_input:str, lines_of_conversations:str='') -> str:
+        """長期記憶から、今の会話に関係しそうな過去の会話を取り出す。"""
+        if not self.memory:
+            return ''
+        query = lines_of_conversations[-MEMORY_QUERY_CHARS:] + '\n' + user_input
+        return self.memory.context(query, top_k=MEMORY_TOP_K, max_tokens=MEMORY_MAX_TOKENS)
+
+    def prompt_pieces(self, user_input:str, lines_of_conversations:str='') -> dict:
+        """プロンプトに入れるキャラの情報。create_messagesもfusedモードのペルソナも、ここから作る。"""
+        return {
+            "name": self.name, 
+            "profile": self.profile, 
+            "talk_style": self.talkstyle, 
+            "talk_sample": self.talksample, 
+            "memories": self.recall(user_input, lines_of_conversations), 
+        }
+
+    def create_system_message(self, talk_summary:str='', lines_of_conversations:str='', memories:str=''):
 
         prompt = SYSTEM_TEMPLATE.format(profile=self.profile, 
                                                 talk_sample=self.talksample, 
+                                                memories=memories, 
                                                 talk_summary=talk_summary,
                                                 lines_of_conversations=lines_of_conversations)
         
-        self.__log('Create system prompt: \n{}'.format(prompt), lv='debug')
+        self.__log('Create system prompt: \n{}', prompt, lv='debug')
 
         system_message = {"role": "system", "content": prompt}
 
         return system_message
     
-    def create_user_message(self, user_input:str, user_name:str='User') -> str:
+    def create_user_message(self, user_input:str, user_name:str='User', words:int=RESPONSE_MAX) -> str:
         
         if not user_input:
             return
-        
+
         # chat user prompt
         prompt = CONVERSATION_USER_TEMPLATE.format(name=self.name, 
                                             talk_style=self.talkstyle,
                                             input=user_input, 
                                             user=user_name, 
-                                            words=random.randint(RESPONSE_MIN, RESPONSE_MAX))
+                                            words=words)
         
-        self.__log('Create user prompt: \n{}'.format(prompt), lv='debug')
+        self.__log('Create user prompt: \n{}', prompt, lv='debug')
 
         user_message = {"role": "user", "content": prompt}
 
@@ -188,22 +326,42 @@ class Character(object):
                         user_input:str, 
                         user_name:str='User', 
                         talk_summary:str='', 
-                        lines_of_conversations:str=''):
+                        lines_of_conversations:str='', 
+                        words:int=RESPONSE_MAX):
+        """systemプロンプトとuserプロンプトのmessagesを作る。
+
+        wordsは応答のワード数。talk()にはresponse_max_tokens(words)を渡す。
+        """
         
         messages = []
-        messages.append(self.create_system_message(talk_summary=talk_summary, lines_of_conversations=lines_of_conversations))
-        messages.append(self.create_user_message(user_input=user_input, user_name=user_name))
+        pieces = self.prompt_pieces(user_input, lines_of_conversations)
+        messages.append(self.create_system_message(talk_summary=talk_summary, lines_of_conversations=lines_of_conversations, memories=pieces["memories"]))
+        messages.append(self.create_user_message(user_input=user_input, user_name=user_name, words=words))
 
         return messages
 
-    def talk(self, messages:list) -> str:
+    def talk(self, messages:list, max_tokens:int=None, stream=None) -> str:
+        """返答を作る。streamを渡すと、生成されたトークンを順にstream.write()する（talk.streamが有効な場合）。
+
+        Args:
+            max_tokens (int): create_messagesに渡したワード数からresponse_max_tokens()で決める。省略時はresponse_maxから
+        """
+
+        if max_tokens is None:
+            max_tokens = response_max_tokens(RESPONSE_MAX)
         
         self.__verbose('Start completion...', col="yellow")
         self.__log('Start completion...')
 
         # APIコール
         try:
-            completion_result = self.__completion(messages)
+            if stream and STREAM:
+                try:
+                    completion_result = self.__completion_stream(messages, max_tokens, stream)
+                finally:
+                    stream.close()
+            else:
+                completion_result = self.__completion(messages, max_tokens)
         except Exception as e:
             self.__verbose('Completion failure', col="red", force=True)
             self.__verbose("(スタッフ) {}は今考え中です！少し待ってからもう一度話しかけてみてね！".format(self.name), col="red", force=True)
@@ -211,39 +369,52 @@ class Character(object):
             self.__log(str(e), lv='error')
             return
         
-        ai_content, usage = completion_result
+        ai_content, usage, finish_reason = completion_result
+
+        # max_tokensで切れた場合、途中で切れた文は読み上げない
+        if finish_reason == 'length':
+            trimmed = trim_incomplete_sentence(ai_content)
+            self.__log('Completion truncated by max_tokens ({}) : {} -> {}', max_tokens, ai_content, trimmed, lv='warning')
+            ai_content = trimmed
 
         # log
         self.__verbose("Completion response : {}".format(ai_content), col="yellow")
-        self.__log('Completion response : {}'.format(ai_content))
-
-        usage_msg = '{3} letters / {0} prompt + {1} completion = {2} tokens'.format(
-                        usage['prompt_tokens'], 
-                        usage['completion_tokens'], 
-                        usage['total_tokens'], 
-                        int(len(ai_content))
-                    )
-
-        self.__log(usage_msg)
-
-        # completion log dict
-        log = {
-            "messages":messages,
-            "response":{
-                "content":ai_content,
-                "usage":usage
-            }
-        }
-        self.completion_log.append(log)
-        self.export_completion_log()
+        self.__log('Completion response : {}', ai_content)
+
+        self.__log('{3} letters / {0} prompt + {1} completion = {2} tokens', 
+                    usage['prompt_tokens'], 
+                    usage['completion_tokens'], 
+                    usage['total_tokens'], 
+                    int(len(ai_content)))
+
+        self.record_completion(messages, ai_content, usage)
         
         return ai_content, usage
+
+    def record_completion(self, messages:list, content:str, usage:dict):
+        """Completion履歴に追加して書き出す。"""
+
+        self.completion_log.append(CompletionRecord(messages, content, usage, _segment_table))
+        self.export_completion_log()
     
-    def __export_json(self, dict:dict, path:str):
-        self.__log('Export : {}'.format(path))
-        with open(path, 'w', encoding='utf-8-sig') as f:
-            json.dump(dict, f, indent=4, ensure_ascii=False)
+    def get_state(self) -> dict:
+        """スナップショット用の状態"""
+        completion_log, offset, spill_bytes = self.completion_log.snapshot()
+        return {
+            "completion_log": completion_log,
+            "completion_log_offset": offset, # これより前はjsonlにある
+            "completion_log_spill_bytes": spill_bytes,
+        }
+
+    def set_state(self, state:dict):
+        """スナップショットから状態を戻す。"""
+        self.completion_log.restore(state["completion_log"], 
+                                    state.get("completion_log_offset", 0), 
+                                    state.get("completion_log_spill_bytes"))
+        self.__log('Restore state ({} completions)', len(self.completion_log))
 
     def export_completion_log(self):
-        file_path = os.path.join(self.comp_log_dir, '{}_completion_log.json'.format(self.id))
-        self.__export_json(self.completion_log, file_path)
\ No newline at end of file
+        """メモリに置く上限を超えた古い履歴をjsonlに書き出す。"""
+        count = self.completion_log.spill()
+        if count:
+            self.__log('Spill {} completions : {}', count, self.completion_log.spill_path, lv='debug')
@@ -1,52 +1,121 @@
-import ctypes
+import os
+import sys
+import atexit
+import queue
+import threading
 
-ENABLE_PROCESSED_OUTPUT = 0x0001
-ENABLE_WRAP_AT_EOL_OUTPUT = 0x0002
-ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
-MODE = ENABLE_PROCESSED_OUTPUT + ENABLE_WRAP_AT_EOL_OUTPUT + ENABLE_VIRTUAL_TERMINAL_PROCESSING
+COLORS = {
+    'red': '\033[31m',
+    'green': '\033[32m',
+    'yellow': '\033[33m',
+    'blue': '\033[34m',
+    'magenta': '\033[35m',
+    'cyan': '\033[36m',
+}
+RESET = '\033[0m'
+
+if os.name == 'nt':
+    # Windowsのコンソールでエスケープシーケンス（色）を有効にする
+    import ctypes
+
+    ENABLE_PROCESSED_OUTPUT = 0x0001
+    ENABLE_WRAP_AT_EOL_OUTPUT = 0x0002
+    ENABLE_VIRTUAL_TERMINAL_PROCESSING = 0x0004
+    MODE = ENABLE_PROCESSED_OUTPUT + ENABLE_WRAP_AT_EOL_OUTPUT + ENABLE_VIRTUAL_TERMINAL_PROCESSING
+
+    kernel32 = ctypes.windll.kernel32
+    kernel32.SetConsoleMode(kernel32.GetStdHandle(-11), MODE)
+
+class ConsoleWriter(object):
+    """コンソールへの書き込みを1本のスレッドにまとめる
+
+    ・呼び出し側はキューに積むだけなので、端末への書き込みで待たされない。
+    ・キューが空になったところでまとめてflushする。
+    ・全Consoleで共有するので、スレッドをまたいでも書き込んだ順に出る。
+
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self.__run, name='console-writer', daemon=True)
+        self._thread.start()
+
+    def __run(self):
+        while True:
+            text = self._queue.get()
+            stream = self.stream or sys.stdout
+            try:
+                stream.write(text)
+                if self._queue.empty():
+                    stream.flush()
+            except (OSError, ValueError):
+                pass
+            finally:
+                self._queue.task_done()
+
+    def write(self, text:str):
+        self._queue.put(text)
+
+    def flush(self):
+        """積まれた分を書き終わるまで待つ。"""
+        self._queue.join()
+
+_writer = ConsoleWriter()
+atexit.register(_writer.flush)
+
+class ConsoleStream(object):
+    """1行をトークンごとに書き足していく（Completionのストリーミング表示用）"""
+
+    def __init__(self, console, header:str='', col:str=''):
+        self.console = console
+        self.header = header
+        self.col = col
+        self.text = ''
+        self._started = False
+
+    def write(self, token:str):
+        if not self._started:
+            self.console.write(self.header, col=self.col)
+            self._started = True
+        self.console.write(token, col=self.col)
+        self.text += token
+
+    def restart(self):
+        """リトライ時など、書きかけの行を捨てて次の行から書き直す。"""
+        if self._started:
+            self.console.write('\n')
+        self._started = False
+        self.text = ''
+
+    def close(self):
+        if self._started:
+            self.console.write('\n')
+        self._started = False
 
 class Console(object):
 
     def __init__(self, default_color:str='') -> None:
-        kernel32 = ctypes.windll.kernel32
-        handle = kernel32.GetStdHandle(-11)
-        kernel32.SetConsoleMode(handle, MODE)
-
         self.default_color = ''
         self.set_default_color(default_color)
 
+    def __color(self, col:str) -> str:
+        return COLORS.get(col, self.default_color)
+
     def __call__(self, msg:str, col:str='') -> None:
+        _writer.write(self.__color(col) + msg + RESET + '\n')
+
+    def write(self, text:str, col:str='') -> None:
+        """改行せずに書く。"""
+        if not text:
+            return
+        _writer.write(self.__color(col) + text + RESET)
+
+    def stream(self, header:str='', col:str='') -> ConsoleStream:
+        return ConsoleStream(self, header, col)
+
+    def flush(self) -> None:
+        _writer.flush()
 
-        if col == 'red':
-            s = '\033[31m'
-        elif col == 'green':
-            s = '\033[32m'
-        elif col == 'yellow':
-            s = '\033[33m'
-        elif col == 'blue':
-            s = '\033[34m'
-        elif col == 'magenta':
-            s = '\033[35m'
-        elif col == 'cyan':
-            s = '\033[36m'
-        else:
-            s = self.default_color
-        e = '\033[0m'
-
-        print(s + msg + e)
-    
     def set_default_color(self, col:str) -> None:
-        if col == 'red':
-            self.default_color = '\033[31m'
-        elif col == 'green':
-            self.default_color = '\033[32m'
-        elif col == 'yellow':
-            self.default_color = '\033[33m'
-        elif col == 'blue':
-            self.default_color = '\033[34m'
-        elif col == 'magenta':
-            self.default_color = '\033[35m'
-        elif col == 'cyan':
-            self.default_color = '\033[36m'
-        else:
-            self.default_color = ''
\ No newline at end of file
+        self.default_color = COLORS.get(col, '')
@@ -1,19 +1,55 @@
 import os
 import json
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 import openai
 
 from .console import Console
+from .character import draw_response_words
 from .retry import retry_decorator
+from .hedge import hedged_call
+from .memory import estimate_tokens
+from .history import BoundedHistory, ConversationLine
 from .prompts import (
     WHO_IS_TALKING_TO_SYSTEM_TEMPLATE,
     WHO_IS_TALKING_TO_USER_TEMPLATE,
-    SUMMARIZE_TEMPLATE
+    CHUNK_SUMMARIZE_TEMPLATE,
+    ROLLUP_SUMMARIZE_TEMPLATE,
+    FUSED_SYSTEM_TEMPLATE,
+    FUSED_PERSONA_TEMPLATE,
+    FUSED_USER_TEMPLATE,
+    FUSED_HAND_BACK_TEMPLATE
 )
 
 openai.api_key = os.getenv('OPENAI_API_KEY')
 
+with open('settings.json', mode="r", encoding="utf-8") as f:
+    settings_dict = json.load(f)
+
+# 話し相手の判定用
+GUESS_MODEL = settings_dict["guess"]["completion"]["model"]
+GUESS_TEMPERATURE = settings_dict["guess"]["completion"]["temperature"]
+GUESS_MAX_TOKENS = settings_dict["guess"]["completion"]["max_tokens"]
+GUESS_STOP = settings_dict["guess"]["completion"]["stop"]
+
+# 話し相手の判定と返答を1回で行う用（fusedモード）
+FUSED_MODEL = settings_dict["fused"]["completion"]["model"]
+FUSED_TEMPERATURE = settings_dict["fused"]["completion"]["temperature"]
+FUSED_TOP_P = settings_dict["fused"]["completion"]["top_p"]
+FUSED_MAX_TOKENS_MARGIN = settings_dict["fused"]["max_tokens_margin"] # json部分のぶん
+TOKENS_PER_WORD = settings_dict["talk"]["tokens_per_word"]
+
+# 要約用
+SUMMARIZE_MODEL = settings_dict["summarize"]["completion"]["model"]
+SUMMARIZE_TEMPERATURE = settings_dict["summarize"]["completion"]["temperature"]
+SUMMARIZE_MAX_TOKENS = settings_dict["summarize"]["completion"]["max_tokens"]
+SUMMARIZE_STOP = settings_dict["summarize"]["completion"]["stop"]
+SUMMARY_FAN_IN = settings_dict["summarize"]["fan_in"] # この数の要約がたまったら1つ上のレベルにまとめる
+SUMMARY_MAX_TOKENS = settings_dict["summarize"]["max_summary_tokens"] # プロンプトに入れる要約の上限
+
+HISTORY_MAX_LINES = settings_dict["history"]["max_resident_lines"] # メモリに置く会話データの行数（超えたぶんはファイルへ）
 
 class Interlocutor(object):
 
@@ -21,17 +57,17 @@ class Interlocutor(object):
         
         self.logger = logger
     
-    def __log(self, msg:str, lv='info'):
+    def __log(self, msg:str, *args, lv='info'):
         if not self.logger:
             return
-        self.logger(msg, cls=self, lv=lv)
+        self.logger(msg, *args, cls=self, lv=lv)
 
     def guess(self, template:dict, input:str):
         system_prompt = WHO_IS_TALKING_TO_SYSTEM_TEMPLATE.format(template=json.dumps(template, indent=2, ensure_ascii=False))
-        self.__log('Create system prompt: \n{}'.format(system_prompt), lv='debug')
+        self.__log('Create system prompt: \n{}', system_prompt, lv='debug')
 
         user_prompt = WHO_IS_TALKING_TO_USER_TEMPLATE.format(input=input)
-        self.__log('Create user prompt: \n{}'.format(user_prompt), lv='debug')
+        self.__log('Create user prompt: \n{}', user_prompt, lv='debug')
         
         messages = []
         messages.append({"role": "system", "content": system_prompt})
@@ -61,39 +97,133 @@ class Interlocutor(object):
         try:
             interlocutor_dict = json.loads(interlocutor)
         except Exception as e:
-            self.__log('Guess result type is not dict : {}'.format(interlocutor), lv='error')
+            self.__log('Guess result type is not dict : {}', interlocutor, lv='error')
             interlocutor_dict = None
 
-        self.__log('Guess result: {}'.format(interlocutor_dict), lv='debug')
+        self.__log('Guess result: {}', interlocutor_dict, lv='debug')
 
-        usage_msg = '{3} letters / {0} prompt + {1} completion = {2} tokens'.format(
-                        usage['prompt_tokens'], 
-                        usage['completion_tokens'], 
-                        usage['total_tokens'], 
-                        int(len(interlocutor))
-                    )
-        self.__log(usage_msg)
+        self.__log('{3} letters / {0} prompt + {1} completion = {2} tokens', 
+                    usage['prompt_tokens'], 
+                    usage['completion_tokens'], 
+                    usage['total_tokens'], 
+                    int(len(interlocutor)))
 
         return interlocutor_dict, usage
 
-    @retry_decorator
+    @retry_decorator('guess')
     def __completion(self, messages:list) -> str:
         
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = hedged_call('guess', openai.ChatCompletion.create, 
+            model=GUESS_MODEL,
             messages=messages,
-            temperature=0
+            temperature=GUESS_TEMPERATURE, 
+            max_tokens=GUESS_MAX_TOKENS, 
+            stop=GUESS_STOP
         )
         data = response.choices[0].message.content
         
         return data, response['usage']
 
+    def guess_and_talk(self, 
+                        candidates:list, 
+                        input:str, 
+                        user_name:str='User', 
+                        talk_summary:str='', 
+                        lines_of_conversations:str='', 
+                        username:str=''):
+        """誰が応答するかと、その返答を1回のAPIコールで得る。
+
+        Args:
+            candidates (list): 応答候補のCharacter
+            username (str): 応答候補に入れるユーザー名（AI同士の会話からユーザーに話を返せるように）。発言者がユーザーなら空にする
+        
+        Returns:
+            (応答者の名前, 返答, 送ったmessages, usage)。失敗した場合はNone。
+            応答者がユーザーの場合、返答は使わない。
+        """
+
+        # ペルソナ（長期記憶も含む）は、2回コールのcreate_messagesと同じものから作る
+        personas = '\n\n'.join(FUSED_PERSONA_TEMPLATE.format(**ch.prompt_pieces(input, lines_of_conversations)) for ch in candidates)
+        system_prompt = FUSED_SYSTEM_TEMPLATE.format(personas=personas, 
+                                                    talk_summary=talk_summary, 
+                                                    lines_of_conversations=lines_of_conversations)
+        self.__log('Create system prompt: \n{}', system_prompt, lv='debug')
+
+        words = draw_response_words()
+        names = [ch.name for ch in candidates] + ([username] if username else [])
+        user_prompt = FUSED_USER_TEMPLATE.format(candidates=json.dumps(names, ensure_ascii=False), 
+                                                hand_back=FUSED_HAND_BACK_TEMPLATE.format(user=username) if username else '', 
+                                                words=words, 
+                                                user=user_name, 
+                                                input=input)
+        self.__log('Create user prompt: \n{}', user_prompt, lv='debug')
+
+        messages = []
+        messages.append({"role": "system", "content": system_prompt})
+        messages.append({"role": "user", "content": user_prompt})
+
+        self.__log('Guess and talk...')
+
+        # APIコール
+        try:
+            result = self.__fused_completion(messages, int(words * TOKENS_PER_WORD) + FUSED_MAX_TOKENS_MARGIN)
+        except Exception as e:
+            self.__log('Guess and talk failure', lv='error')
+            self.__log(str(e), lv='error')
+            return
+        
+        data, usage = result
+
+        self.__log('{3} letters / {0} prompt + {1} completion = {2} tokens', 
+                    usage['prompt_tokens'], 
+                    usage['completion_tokens'], 
+                    usage['total_tokens'], 
+                    int(len(data)))
+
+        # {}抽出
+        match = re.search(r'{.*}', data, flags=re.S)
+        try:
+            result_dict = json.loads(match.group(0))
+            responder = result_dict["responder"]
+            content = result_dict["content"]
+        except Exception as e:
+            self.__log('Guess and talk result is not valid json : {}', data, lv='error')
+            return
+
+        self.__log('Guess and talk result: {}', result_dict, lv='debug')
+
+        return responder, content, messages, usage
+
+    @retry_decorator('fused')
+    def __fused_completion(self, messages:list, max_tokens:int) -> str:
+
+        response = hedged_call('fused', openai.ChatCompletion.create, 
+            model=FUSED_MODEL,
+            messages=messages,
+            temperature=FUSED_TEMPERATURE, 
+            top_p=FUSED_TOP_P, 
+            max_tokens=max_tokens
+        )
+        data = response.choices[0].message.content
+        if response.choices[0].get('finish_reason') == 'length':
+            self.__log('Guess and talk truncated by max_tokens ({})', max_tokens, lv='warning')
+
+        return data, response['usage']
+
 class Conversations(object):
     """会話クラス
 
     ・会話データの保持、保存。
     ・APIに送るためのmessageリストもこのクラスが生成。
-    ・一定の長さを超えると（gpt-3.5-turboで）前半を要約する機能を持つ。
+    ・一定の長さを超えると前半を要約する機能を持つ。
+    
+    要約は階層的に行う。
+    ・レベル0 : 要約する会話の塊ごとの要約。前の要約は入力に含めない。
+    ・レベル1以上 : 1つ下のレベルの要約がfan_in個たまったら1つにまとめる。
+    各APIコールの入力は「会話の塊1つ」か「要約fan_in個」に収まるので、会話が長くなってもコストは一定。
+    レベルの違うまとめは互いに独立しているので並列に実行する。
+    プロンプトには、まだまとめられていない要約を上限トークン数に収まるだけ古い順に並べる。
+    いちばん上のレベル（会話全体の長期の記憶）は必ず入れ、溢れたら下のレベル・中ほどの範囲から削る。
     
     """
 
@@ -105,26 +235,38 @@ class Conversations(object):
         self.logger = logger
         
         # 会話データディレクトリ
-        self.conv_dir = os.path.join(os.path.abspath(log_dir), session_id, 'conversations')
+        self.log_dir = os.path.abspath(log_dir)
+        self.conv_dir = os.path.join(self.log_dir, session_id, 'conversations')
         if not os.path.isdir(self.conv_dir):
             os.makedirs(self.conv_dir)
         
         # セッション全体の会話履歴データ。名前と発言内容とそれまでの要約。
-        self._session_data = []
+        # 要約済みの古い行はsession_data.jsonlに書き出してメモリから外す。
+        self._session_data = BoundedHistory(os.path.join(self.conv_dir, 'session_data.jsonl'), 
+                                            ConversationLine.from_dict, 
+                                            HISTORY_MAX_LINES)
 
         self.current_start_index = 0 # 現在（未要約ぶん）の開始地点
         self.prev_summary_index = None # None = prev_summaryが無い
 
+        # 階層要約。レベルごとに、まだ上のレベルにまとめられていない要約 {"summary", "start", "end"} のリスト
+        self._summary_levels = []
+        self._summary_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix='summarize')
+
+        # 要約の反映（各indexと_summary_levels）とスナップショットを排他にする。
+        # 片方だけ新しい状態で保存されると、再開時に要約をやり直したり、行を飛ばしたりするので。
+        self._state_lock = threading.RLock()
+
         self.__log('Init')
     
     def __verbose(self, msg:str, col:str='', force:bool=False):
         if self.verbose or force:
             self.console(msg, col=col)
 
-    def __log(self, msg:str, lv='info'):
+    def __log(self, msg:str, *args, lv='info'):
         if not self.logger:
             return
-        self.logger(msg, cls=self, lv=lv)
+        self.logger(msg, *args, cls=self, lv=lv)
 
     @property
     def session_data(self):
@@ -133,7 +275,7 @@ class Conversations(object):
     @property
     def prev_summary(self):
         if type(self.prev_summary_index) == int:
-            return self._session_data[self.prev_summary_index]["summary_so_far"]
+            return self._session_data[self.prev_summary_index].summary_so_far
         else:
             return ''
         
@@ -142,30 +284,50 @@ class Conversations(object):
         # current_start_index ~ 最後-1までの会話履歴
         return self.__create_conv_lines(start=self.current_start_index, end=int(len(self._session_data))-1)
 
+    def get_state(self) -> dict:
+        """スナップショット用の状態"""
+        with self._state_lock:
+            session_data, offset, spill_bytes = self._session_data.snapshot()
+            return {
+                "session_data": session_data,
+                "session_data_offset": offset, # これより前はsession_data_spillにある
+                "session_data_spill_bytes": spill_bytes,
+                "session_data_spill": os.path.relpath(self._session_data.spill_path, self.log_dir),
+                "current_start_index": self.current_start_index,
+                "prev_summary_index": self.prev_summary_index,
+                "summary_levels": [list(nodes) for nodes in self._summary_levels],
+            }
+
+    def set_state(self, state:dict):
+        """スナップショットから状態を戻す。要約はやり直さない。"""
+        with self._state_lock:
+            self._session_data.restore(state["session_data"], 
+                                        state.get("session_data_offset", 0), 
+                                        state.get("session_data_spill_bytes"))
+            self.current_start_index = state["current_start_index"]
+            self.prev_summary_index = state["prev_summary_index"]
+            self._summary_levels = state.get("summary_levels", [])
+
+        self.__log('Restore state')
+        self.__log_data_length()
+
     def __log_data_length(self):
-        s = 'session data len: {} / current start index: {} / prev summary index: {}'.format(
-            len(self._session_data),
-            self.current_start_index,
-            self.prev_summary_index
-        )
-        self.__log(s)
+        self.__log('session data len: {} / current start index: {} / prev summary index: {}', 
+                    len(self._session_data),
+                    self.current_start_index,
+                    self.prev_summary_index)
     
     def add_content(self, name:str, content:str):
         
-        self.__log('Add new content ({}:{})'.format(name, content))
+        self.__log('Add new content ({}:{})', name, content)
 
-        data = {"name":name, 
-                "content": content, 
-                "summary_so_far":"", 
-                "summary_usage":{}
-                }
-        
         # 新しい要素の追加
-        self._session_data.append(data)
+        self._session_data.append(ConversationLine(name, content))
 
         self.__log_data_length()
 
         self.export_session_data()
+        self.__append_talk_history(name, content)
 
     def check_current_lengh(self, max:int):
         current_length = int(len(self._session_data)) - self.current_start_index
@@ -204,82 +366,163 @@ class Conversations(object):
         self.__verbose(msg, col="yellow")
         self.__log(msg)
 
-        # APIコール
+        # APIコール。新しい塊の要約と、たまっているレベルのまとめを並列に行う
+        chunk_future = self._summary_executor.submit(self.__summarize_completion, 
+                                                    CHUNK_SUMMARIZE_TEMPLATE.format(new_lines=lines))
+        rollup_futures = {}
+        for level, nodes in enumerate(self._summary_levels):
+            if len(nodes) >= SUMMARY_FAN_IN:
+                batch = nodes[:SUMMARY_FAN_IN]
+                summaries = '\n'.join('- {}'.format(node["summary"]) for node in batch)
+                self.__log('Roll up level {} ({} summaries)', level, len(batch))
+                rollup_futures[level] = (batch, self._summary_executor.submit(self.__summarize_completion, 
+                                                    ROLLUP_SUMMARIZE_TEMPLATE.format(summaries=summaries)))
+
+        total_usage = {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+
+        # 結果を待つ（API待ちの間はスナップショットを止めないよう、反映はまとめて後で行う）
+        rollups = []
+        for level, (batch, future) in sorted(rollup_futures.items()):
+            try:
+                rollup_summary, usage = future.result()
+            except Exception as e:
+                # 失敗したレベルは次回やり直し
+                self.__log('Roll up failure (level {})', level, lv='error')
+                self.__log(str(e), lv='error')
+                continue
+            self.__add_usage(total_usage, usage)
+            rollups.append((level, batch, rollup_summary))
+
         try:
-            summarize_result = self.__summarize_completion(self.prev_summary, lines)
+            chunk_summary, usage = chunk_future.result()
         except Exception as e:
             self.__verbose('Summarization failure', col="red", force=True)
             self.__log('Summarization failure', lv='error')
             self.__log(str(e), lv='error')
-            return
+            chunk_summary = None
         
-        new_summary, usage = summarize_result
+        # まとめ結果・要約・各indexを、スナップショットから見て一度に変わるように反映する
+        with self._state_lock:
+            for level, batch, rollup_summary in rollups:
+                del self._summary_levels[level][:len(batch)]
+                self.__push_summary(level + 1, {"summary": rollup_summary, 
+                                                "start": batch[0]["start"], 
+                                                "end": batch[-1]["end"]})
+            if chunk_summary is None:
+                return
+
+            self.__add_usage(total_usage, usage)
+            self.__push_summary(0, {"summary": chunk_summary, 
+                                    "start": self.current_start_index, 
+                                    "end": summarize_end_index})
+
+            new_summary = self.__compose_summary()
+
+            # 要約結果をsession_dataに格納
+            self._session_data[summarize_end_index].summary_so_far = new_summary
+            self._session_data[summarize_end_index].summary_usage = total_usage
+
+            # 各indexを更新
+            self.current_start_index = summarize_end_index + 1
+            self.prev_summary_index = summarize_end_index
         
         self.__verbose('Summarization complete : {}'.format(new_summary), col="yellow")
-        self.__log('Summarization complete : {}'.format(new_summary))
-
-        usage_msg = '{3} letters / {0} prompt + {1} completion = {2} tokens'.format(
-                        usage['prompt_tokens'], 
-                        usage['completion_tokens'], 
-                        usage['total_tokens'], 
-                        int(len(new_summary))
-                    )
-        
-        self.__log(usage_msg)
+        self.__log('Summarization complete : {}', new_summary)
 
-        # 要約結果をsession_dataに格納
-        self._session_data[summarize_end_index]["summary_so_far"] = new_summary
-        self._session_data[summarize_end_index]["summary_usage"] = usage
-
-        # 各indexを更新
-        self.current_start_index = summarize_end_index + 1
-        self.prev_summary_index = summarize_end_index
+        self.__log('{3} letters / {0} prompt + {1} completion = {2} tokens', 
+                    total_usage['prompt_tokens'], 
+                    total_usage['completion_tokens'], 
+                    total_usage['total_tokens'], 
+                    int(len(new_summary)))
 
         self.export_session_data()
         
         self.__log_data_length()
 
+    def __add_usage(self, total:dict, usage:dict):
+        for key in total.keys():
+            total[key] += usage[key]
+
+    def __push_summary(self, level:int, node:dict):
+        while len(self._summary_levels) <= level:
+            self._summary_levels.append([])
+        self._summary_levels[level].append(node)
+
+    def __compose_summary(self) -> str:
+        """まとめられていない要約を、上限トークン数に収まるだけ古い順に並べる。
+
+        入れる順番
+        1. いちばん上のレベルの要約（上限を超えても入れる）
+        2. いちばん新しい要約（直前の会話とのつながり）
+        3. 残りを上のレベルから、同じレベルでは新しい方から
+        収まらないものは飛ばすので、削られるのは下のレベルの古い方（中ほどの範囲）になる。
+        """
+
+        levels = [(level, node) for level, nodes in enumerate(self._summary_levels) for node in nodes]
+        if not levels:
+            return ''
+        top = max(level for level, node in levels)
+
+        forced = [node for level, node in levels if level == top]
+        rest = sorted([(level, node) for level, node in levels if level != top], 
+                        key=lambda x: x[1]["end"], reverse=True)
+        if rest:
+            newest = rest.pop(0)[1]
+            rest.sort(key=lambda x: (-x[0], -x[1]["end"]))
+            rest = [newest] + [node for level, node in rest]
+
+        selected = list(forced)
+        tokens = sum(estimate_tokens(node["summary"]) for node in forced)
+        for node in rest:
+            node_tokens = estimate_tokens(node["summary"])
+            if tokens + node_tokens > SUMMARY_MAX_TOKENS:
+                continue
+            selected.append(node)
+            tokens += node_tokens
+
+        selected.sort(key=lambda node: node["start"])
+
+        self.__log('Compose summary : {}/{} summaries, ~{} tokens', len(selected), len(levels), tokens, lv='debug')
+
+        return '\n'.join(node["summary"] for node in selected)
+
     def __create_conv_lines(self, start:int=0, end=None) -> str:
         lines = []
         for msg in self._session_data[start:end]:
-            lines.append('{} : {}'.format(msg['name'], msg['content']))
+            lines.append('{} : {}'.format(msg.name, msg.content))
         
         return '\n'.join(lines)
     
-    @retry_decorator
-    def __summarize_completion(self, prev_summary:str="", new_lines:str="") -> str:
+    @retry_decorator('summarize')
+    def __summarize_completion(self, prompt:str) -> str:
         
-        prompt = SUMMARIZE_TEMPLATE.format(summary=prev_summary, new_lines=new_lines)
+        self.__log('Summarize prompt :\n{}', prompt, lv='debug')
         
-        self.__log('Summarize prompt :\n{}'.format(prompt), lv='debug')
-        
-        response = openai.ChatCompletion.create(
-            model="gpt-3.5-turbo",
+        response = hedged_call('summarize', openai.ChatCompletion.create, 
+            model=SUMMARIZE_MODEL,
             messages=[{"role": "user", "content": prompt}], 
-            temperature=0
+            temperature=SUMMARIZE_TEMPERATURE, 
+            max_tokens=SUMMARIZE_MAX_TOKENS, 
+            stop=SUMMARIZE_STOP
         )
         summary = response.choices[0].message.content
         
         return summary, response['usage']
     
-    def __export_json(self, dict:dict, path:str):
-        self.__log('Export : {}'.format(path))
-
-        with open(path, 'w', encoding='utf-8-sig') as f:
-            json.dump(dict, f, indent=4, ensure_ascii=False)
+    def __append_txt(self, text:str, path:str):
+        with open(path, 'a', encoding='utf-8-sig') as f:
+            f.write(text)
 
-    def __export_txt(self, data, path:str):
-        self.__log('Export : {}'.format(path))
-
-        with open(path, 'w', encoding='utf-8-sig') as f:
-            if type(data) == list:
-                f.writelines(data)
-            elif type(data) == str:
-                f.write(data)
+    def __append_talk_history(self, name:str, content:str):
+        file_path = os.path.join(self.conv_dir, 'talk_history.txt')
+        self.__append_txt('{} : {}\n'.format(name, content), file_path)
 
     def export_session_data(self):
-        file_path = os.path.join(self.conv_dir, 'session_data.json')
-        self.__export_json(self._session_data, file_path)
-
-        file_path = os.path.join(self.conv_dir, 'talk_history.txt')
-        self.__export_txt(self.__create_conv_lines(), file_path)
\ No newline at end of file
+        """メモリに置く上限を超えた古い行をsession_data.jsonlに書き出す。
+        
+        prev_summaryの行より後ろ（まだ要約に使う行）はメモリに残す。
+        """
+        before = self.prev_summary_index if type(self.prev_summary_index) == int else self.current_start_index
+        count = self._session_data.spill(before=before)
+        if count:
+            self.__log('Spill {} lines : {}', count, self._session_data.spill_path, lv='debug')
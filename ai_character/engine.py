@@ -0,0 +1,302 @@
+import os
+import time
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+class VoicevoxEngine(object):
+    """ローカルのVOICEVOX ENGINEの起動・監視
+
+    ・既に起動しているエンジンがあればそれを使う（自分では起動しない、落ちても再起動しない）。
+    ・無ければengine_pathを--host/--port付きで起動し、/versionが返るまでポーリングする。
+    ・起動後、各キャラのspeakerを/initialize_speakerで並列に初期化しておく（初回発話のモデル読み込み待ちを無くす）。
+    ・監視スレッドでプロセスの終了を検知したら、再起動して初期化し直す。
+
+    """
+
+    def __init__(self, engine_path:str='', host:str='localhost', port:int=50021, args:list=None,
+                    startup_timeout:float=60.0, poll_interval:float=0.5, watch_interval:float=2.0,
+                    restart:bool=True, logger=None):
+        self.engine_path = engine_path
+        self.host = host
+        self.port = port
+        self.args = args or []
+        self.startup_timeout = startup_timeout
+        self.poll_interval = poll_interval
+        self.watch_interval = watch_interval
+        self.restart = restart
+        self.logger = logger
+
+        self.url = 'http://{}:{}'.format(host, port)
+        self.speaker_ids = set()
+        self.restart_count = 0
+
+        self._process = None
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._watch_thread = None
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger('[{}] '.format(self.url) + msg, *args, cls=self, lv=lv)
+
+    @property
+    def owned(self) -> bool:
+        """このプロセスが起動したエンジンかどうか"""
+        return self._process is not None
+
+    def is_ready(self, timeout:float=1.0) -> bool:
+        try:
+            res = requests.get(self.url + '/version', timeout=timeout)
+            return res.status_code == 200
+        except requests.exceptions.RequestException:
+            return False
+
+    def wait_ready(self, timeout:float=None) -> bool:
+        """/versionが返るまで待つ。タイムアウトしたらFalse。"""
+        timeout = self.startup_timeout if timeout is None else timeout
+        deadline = time.monotonic() + timeout
+        while not self._stop_event.is_set():
+            if self.is_ready(timeout=self.poll_interval):
+                return True
+            if self._process is not None and self._process.poll() is not None:
+                self.__log('Engine exited while starting : returncode={}', self._process.returncode, lv='warning')
+                return False
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.poll_interval)
+        return False
+
+    def __launch(self):
+        cmd = [self.engine_path, '--host', self.host, '--port', str(self.port)] + list(self.args)
+        self.__log('Launch engine : {}', cmd)
+
+        kwargs = {}
+        if os.name == 'nt':
+            # Windowsでは別コンソールで起動する（以前の`start`と同じ見た目）
+            kwargs['creationflags'] = subprocess.CREATE_NEW_CONSOLE
+        else:
+            kwargs['stdout'] = subprocess.DEVNULL
+            kwargs['stderr'] = subprocess.DEVNULL
+            kwargs['start_new_session'] = True
+        self._process = subprocess.Popen(cmd, **kwargs)
+
+    def start(self, speaker_ids:list=()) -> bool:
+        """エンジンを使える状態にし、speakerを初期化して監視を始める。使える状態にならなければFalse。"""
+
+        self.speaker_ids.update(speaker_ids)
+
+        start = time.monotonic()
+        with self._lock:
+            if not self.is_ready():
+                if not self.engine_path:
+                    self.__log('Engine is not running and engine_path is empty', lv='warning')
+                    return False
+                self.__launch()
+            ready = self.wait_ready()
+
+        if not ready:
+            self.__log('Engine is not ready in {} sec', self.startup_timeout, lv='error')
+            return False
+        self.__log('Engine is ready : {:.2f} sec', time.monotonic() - start)
+
+        self.warmup(self.speaker_ids)
+
+        if self.owned and self.restart and self._watch_thread is None:
+            self._watch_thread = threading.Thread(target=self.__watch, name='voicevox-watch', daemon=True)
+            self._watch_thread.start()
+
+        return True
+
+    def __initialize_speaker(self, speaker_id:int) -> bool:
+        try:
+            res = requests.post(self.url + '/initialize_speaker',
+                                params={"speaker": speaker_id, "skip_reinit": "true"},
+                                timeout=self.startup_timeout)
+            return res.status_code in (200, 204)
+        except requests.exceptions.RequestException as e:
+            self.__log('Failed to initialize speaker {} : {}', speaker_id, e, lv='warning')
+            return False
+
+    def warmup(self, speaker_ids) -> dict:
+        """speakerを並列に初期化する。speaker_id -> 成否 を返す。"""
+
+        speaker_ids = sorted(set(speaker_ids))
+        if not speaker_ids:
+            return {}
+
+        start = time.monotonic()
+        with ThreadPoolExecutor(max_workers=len(speaker_ids), thread_name_prefix='voicevox-warmup') as executor:
+            results = dict(zip(speaker_ids, executor.map(self.__initialize_speaker, speaker_ids)))
+        self.__log('Warmup speakers {} : {:.2f} sec', results, time.monotonic() - start)
+
+        return results
+
+    def __watch(self):
+        while not self._stop_event.wait(self.watch_interval):
+            if self._process is None or self._process.poll() is None:
+                continue
+
+            self.__log('Engine exited : returncode={}. Restarting...', self._process.returncode, lv='warning')
+            with self._lock:
+                if self._stop_event.is_set():
+                    break
+                self.restart_count += 1
+                self.__launch()
+                ready = self.wait_ready()
+            if ready:
+                self.warmup(self.speaker_ids)
+            else:
+                self.__log('Engine is not ready after restart', lv='error')
+
+    def stop(self):
+        """監視を止め、自分で起動したエンジンなら終了させる。"""
+
+        self._stop_event.set()
+        if self._watch_thread is not None:
+            self._watch_thread.join()
+            self._watch_thread = None
+
+        with self._lock:
+            if self._process is not None and self._process.poll() is None:
+                self.__log('Terminate engine')
+                self._process.terminate()
+                try:
+                    self._process.wait(timeout=10)
+                except subprocess.TimeoutExpired:
+                    self._process.kill()
+            self._process = None
+
+def is_engine_failure(e:Exception) -> bool:
+    """エンジン側の障害（別のエンジンでやり直すべきもの）かどうか。リクエスト内容の誤り（4xx）はFalse。"""
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, requests.exceptions.HTTPError) and e.response is not None:
+        return e.response.status_code >= 500
+    return False
+
+class EngineUnavailableError(Exception):
+    """使えるVOICEVOX ENGINEが1つも無いことを表す。"""
+
+    def __init__(self, urls:list):
+        super().__init__('No healthy VOICEVOX engine : {}'.format(', '.join(urls)))
+        self.urls = urls
+
+class EnginePool(object):
+    """複数のVOICEVOX ENGINEへの合成の振り分け
+
+    ・同時実行数が最も少ない（同数なら累計リクエスト数が少ない）健全なエンジンに振り分ける。
+    ・エンジンごとに同時実行数の上限があり、全部埋まっていたら空くまで待つ。
+    ・リクエストが接続エラー等で失敗したら、そのエンジンを不健全にして別のエンジンでやり直す。
+    ・ヘルスチェックスレッドが/versionで定期的に確認し、戻ってきたエンジンを健全に戻す。
+
+    """
+
+    def __init__(self, engines:list, max_concurrency:int=1, health_interval:float=5.0,
+                    acquire_timeout:float=60.0, logger=None):
+        self.engines = engines
+        self.max_concurrency = max_concurrency
+        self.health_interval = health_interval
+        self.acquire_timeout = acquire_timeout # 健全なエンジンが無い時に待つ秒数
+        self.logger = logger
+
+        self._cond = threading.Condition()
+        self._stats = {engine.url: {"active": 0, "requests": 0, "failures": 0, "healthy": False} for engine in engines}
+        self._stop_event = threading.Event()
+        self._health_thread = None
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    @property
+    def urls(self) -> list:
+        return [engine.url for engine in self.engines]
+
+    def start(self, speaker_ids:list=()) -> int:
+        """各エンジンを並列に起動してヘルスチェックを始める。使えるエンジンの数を返す。"""
+
+        with ThreadPoolExecutor(max_workers=len(self.engines), thread_name_prefix='voicevox-start') as executor:
+            ready_list = list(executor.map(lambda engine: engine.start(speaker_ids), self.engines))
+
+        for engine, ready in zip(self.engines, ready_list):
+            self.__set_healthy(engine.url, ready)
+        self.__log('Engine pool : {}/{} ready', sum(ready_list), len(self.engines))
+
+        if self._health_thread is None:
+            self._health_thread = threading.Thread(target=self.__health_check, name='voicevox-health', daemon=True)
+            self._health_thread.start()
+
+        return sum(ready_list)
+
+    def __set_healthy(self, url:str, healthy:bool):
+        with self._cond:
+            if self._stats[url]["healthy"] != healthy:
+                self.__log('[{}] {}', url, 'healthy' if healthy else 'unhealthy', lv='info' if healthy else 'warning')
+            self._stats[url]["healthy"] = healthy
+            self._cond.notify_all()
+
+    def __health_check(self):
+        while not self._stop_event.wait(self.health_interval):
+            for engine in self.engines:
+                self.__set_healthy(engine.url, engine.is_ready())
+
+    def __acquire(self, exclude:set) -> str:
+        """空いている健全なエンジンのURLを返す。無ければ空くまで待つ。"""
+
+        deadline = time.monotonic() + self.acquire_timeout
+        with self._cond:
+            while True:
+                candidates = [url for url, stats in self._stats.items() 
+                                if stats["healthy"] and not url in exclude]
+                available = [url for url in candidates if self._stats[url]["active"] < self.max_concurrency]
+                if available:
+                    url = min(available, key=lambda url: (self._stats[url]["active"], self._stats[url]["requests"]))
+                    self._stats[url]["active"] += 1
+                    self._stats[url]["requests"] += 1
+                    return url
+
+                remaining = deadline - time.monotonic()
+                if remaining <= 0 or (not candidates and exclude.issuperset(self._stats.keys())):
+                    raise EngineUnavailableError(self.urls)
+                self._cond.wait(remaining)
+
+    def __release(self, url:str):
+        with self._cond:
+            self._stats[url]["active"] -= 1
+            self._cond.notify_all()
+
+    def call(self, fn):
+        """fn(url)を空いているエンジンで実行する。接続エラー等なら別のエンジンでやり直す。"""
+
+        tried = set()
+        while True:
+            url = self.__acquire(tried)
+            try:
+                return fn(url)
+            except requests.exceptions.RequestException as e:
+                if not is_engine_failure(e):
+                    raise
+                tried.add(url)
+                with self._cond:
+                    self._stats[url]["failures"] += 1
+                self.__set_healthy(url, False)
+                self.__log('[{}] Request failed, failover : {}', url, e, lv='warning')
+            finally:
+                self.__release(url)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {url: dict(stats) for url, stats in self._stats.items()}
+
+    def stop(self):
+        self._stop_event.set()
+        if self._health_thread is not None:
+            self._health_thread.join()
+            self._health_thread = None
+        for engine in self.engines:
+            engine.stop()
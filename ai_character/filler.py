@@ -0,0 +1,107 @@
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from .audio import read_wave
+
+class FillerBank(object):
+    """キャラごとのつなぎの音声（「えっと」「うーん」等）
+
+    ・起動時にキャラのspeaker_idと話し方の設定で合成し、PCMでメモリに持っておく。
+    ・ターンが始まってからthreshold秒たっても何も再生していなければ、1つ流して無音を埋める。
+      つなぎも本物の音声と同じ再生キュー（PlaybackScheduler）に、何も無いことの確認と同時に入れる（put_if_idle）。
+      本物の音声の後ろや分割した返答の途中に入ることはなく、再生し終わるまでキューはidleにならないので、
+      2つ目のつなぎやストリーミング表示の返答とも重ならない。
+
+    """
+
+    def __init__(self, voice_generator, threshold:float, path:str, volume:float=1, logger=None):
+        self.voice_generator = voice_generator
+        self.threshold = threshold
+        self.path = path # 合成時の一時ファイルの置き場所
+        self.volume = volume
+        self.logger = logger
+
+        self._clips = {} # キャラID -> [(テキスト, PCM, AudioFormat)]
+        self._last = {} # キャラID -> 直前に流したテキスト
+        self._lock = threading.Lock()
+        self.played = 0
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def __render_clip(self, ch, text:str):
+        wav = self.voice_generator.text2voice(text,
+                                'filler_{}_{}'.format(ch.id, abs(hash(text))),
+                                path=self.path,
+                                speaker=ch.voice_speaker_id,
+                                speed=ch.voice_speed,
+                                pitch=ch.voice_pitch,
+                                intonation=ch.voice_intonation,
+                                volume=self.volume,
+                                post=0)
+        pcm, fmt = read_wave(wav)
+        os.remove(wav)
+        return text, pcm, fmt
+
+    def render(self, characters:list, texts_by_id:dict):
+        """各キャラのつなぎを並列に合成する。
+
+        Args:
+            characters (list): Character
+            texts_by_id (dict): キャラID -> つなぎのテキストのリスト
+        """
+
+        jobs = [(ch, text) for ch in characters for text in texts_by_id.get(ch.id, [])]
+        if not jobs:
+            return
+
+        with ThreadPoolExecutor(max_workers=len(jobs), thread_name_prefix='filler') as executor:
+            futures = [(ch, executor.submit(self.__render_clip, ch, text)) for ch, text in jobs]
+            for ch, future in futures:
+                try:
+                    clip = future.result()
+                except Exception as e:
+                    self.__log('[{}] Failed to render filler : {}', ch.id, e, lv='warning')
+                    continue
+                self._clips.setdefault(ch.id, []).append(clip)
+
+        self.__log('Render fillers : {}', {ch_id: [clip[0] for clip in clips] for ch_id, clips in self._clips.items()})
+
+    def choose(self, ch_id:str):
+        """直前と違うつなぎを1つ選ぶ。無ければNone。"""
+        clips = self._clips.get(ch_id)
+        if not clips:
+            return None
+        with self._lock:
+            candidates = [clip for clip in clips if clip[0] != self._last.get(ch_id)] or clips
+            clip = random.choice(candidates)
+            self._last[ch_id] = clip[0]
+        return clip
+
+    def start(self, ch, play_filler) -> threading.Timer:
+        """threshold秒後につなぎを流すタイマーを返す。ターンが終わったらcancel()する。
+
+        Args:
+            ch (Character): つなぎを話すキャラ
+            play_filler (callable): play_filler(ch, text, pcm, fmt) で、何も再生していなければ再生キューに入れてTrueを返す
+        """
+
+        def play():
+            clip = self.choose(ch.id)
+            if clip is None:
+                return
+            text, pcm, fmt = clip
+            if not play_filler(ch, text, pcm, fmt):
+                return
+            self.__log('[{}] Play filler : {}', ch.id, text)
+            with self._lock:
+                self.played += 1
+
+        timer = threading.Timer(self.threshold, play)
+        timer.daemon = True
+        timer.start()
+        return timer
@@ -0,0 +1,159 @@
+import time
+import threading
+from collections import deque
+
+class ThroughputGovernor(object):
+    """AI同士の会話のペースを制御する（セッションごと）
+
+    ・直近1分間のトークン数・ターン数に上限を設け、超えそうならAIだけのターンを待たせる。
+      ユーザーのターンはカウントはするが待たせない。
+    ・ユーザーが idle_after 秒話していなければ、AIだけのターンの間隔を idle_interval 秒以上あける。
+      pause_after 秒話していなければ、ユーザーが戻るまでAIだけのターンを止める。
+    ・待っている間にユーザーが話したら（user_active()）、すぐに待つのをやめる。
+    ・上限・秒数は0で無効。
+
+    """
+
+    WINDOW_SECONDS = 60.0
+
+    def __init__(self,
+                max_tokens_per_minute:int=0,
+                max_turns_per_minute:int=0,
+                idle_after:float=0,
+                idle_interval:float=0,
+                pause_after:float=0,
+                logger=None):
+        self.max_tokens_per_minute = max_tokens_per_minute
+        self.max_turns_per_minute = max_turns_per_minute
+        self.idle_after = idle_after
+        self.idle_interval = idle_interval
+        self.pause_after = pause_after
+        self.logger = logger
+
+        self._cond = threading.Condition()
+        self._tokens = deque() # (時刻, トークン数)
+        self._turns = deque() # 時刻
+        self._last_user = time.monotonic() # 起動時はユーザーがいるものとする
+        self._last_ai_turn = 0.0
+        self._user_seq = 0 # user_active()が呼ばれた回数（待っている間に来たかどうかの判定用）
+
+        # メトリクス
+        self._ai_turns = 0
+        self._user_turns = 0
+        self._total_tokens = 0
+        self._throttled_seconds = 0.0
+        self._paused_seconds = 0.0
+        self._preempted = 0
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "ai_turns": self._ai_turns,
+                "user_turns": self._user_turns,
+                "total_tokens": self._total_tokens,
+                "throttled_seconds": self._throttled_seconds,
+                "paused_seconds": self._paused_seconds,
+                "preempted": self._preempted,
+            }
+
+    def user_active(self):
+        """ユーザーが話した。AIのターン待ちを中断させる。"""
+        with self._cond:
+            self._last_user = time.monotonic()
+            self._user_seq += 1
+            self._cond.notify_all()
+
+    def wake(self):
+        """終了時など、待っているスレッドを起こす。"""
+        with self._cond:
+            self._cond.notify_all()
+
+    def record_turn(self, user:bool):
+        with self._cond:
+            now = time.monotonic()
+            self._turns.append(now)
+            if user:
+                self._user_turns += 1
+            else:
+                self._ai_turns += 1
+                self._last_ai_turn = now
+
+    def record_tokens(self, usage:dict):
+        """Completionのusageを加算する。"""
+        if not usage:
+            return
+        tokens = int(usage.get("total_tokens", 0))
+        with self._cond:
+            self._tokens.append((time.monotonic(), tokens))
+            self._total_tokens += tokens
+
+    def __expire(self, now:float):
+        while self._tokens and self._tokens[0][0] <= now - self.WINDOW_SECONDS:
+            self._tokens.popleft()
+        while self._turns and self._turns[0] <= now - self.WINDOW_SECONDS:
+            self._turns.popleft()
+
+    def __delay(self, now:float):
+        """AIだけのターンを始めるまでの待ち秒数と理由を返す。Noneならユーザーが戻るまで止める。"""
+
+        self.__expire(now)
+        idle = now - self._last_user
+
+        if self.pause_after and idle >= self.pause_after:
+            return None, 'paused'
+
+        delay, reason = 0.0, ''
+        if self.max_turns_per_minute and len(self._turns) >= self.max_turns_per_minute:
+            # 古いターンが窓から出るまで
+            delay, reason = self._turns[len(self._turns) - self.max_turns_per_minute] + self.WINDOW_SECONDS - now, 'turns'
+        if self.max_tokens_per_minute:
+            # 窓内の合計が上限を下回るまで、古い順に窓から出るのを待つ
+            excess = sum(tokens for _, tokens in self._tokens) - self.max_tokens_per_minute
+            for t, tokens in self._tokens:
+                if excess < 0:
+                    break
+                excess -= tokens
+                if t + self.WINDOW_SECONDS - now > delay:
+                    delay, reason = t + self.WINDOW_SECONDS - now, 'tokens'
+        if self.idle_after and self.idle_interval and idle >= self.idle_after:
+            wait = self._last_ai_turn + self.idle_interval - now
+            if wait > delay:
+                delay, reason = wait, 'idle'
+        return max(0.0, delay), reason
+
+    def wait_ai_turn(self, interrupted=None) -> bool:
+        """AIだけのターンを始めてよくなるまで待つ。
+
+        Args:
+            interrupted (callable): Trueを返したら待つのをやめる（終了時、ユーザー入力がキューにある時など）
+
+        Returns:
+            bool: ユーザーが話した・interruptedで中断したらFalse
+        """
+
+        with self._cond:
+            user_seq = self._user_seq
+            held = None # 待っている理由（変わったらログに出す）
+            while True:
+                if self._user_seq != user_seq or (interrupted and interrupted()):
+                    if held:
+                        self._preempted += 1
+                    return False
+                now = time.monotonic()
+                delay, reason = self.__delay(now)
+                if delay is not None and delay <= 0:
+                    return True
+                if reason != held:
+                    self.__log('Hold AI turn ({}){}', reason, '' if delay is None else ' : {:.1f} sec'.format(delay))
+                    held = reason
+                # interruptedはポーリングで見るので、長くても1秒で起きる（止める時刻になったかもこれで見直す）
+                self._cond.wait(1.0 if delay is None else min(delay, 1.0))
+                if reason == 'paused':
+                    self._paused_seconds += time.monotonic() - now
+                else:
+                    self._throttled_seconds += time.monotonic() - now
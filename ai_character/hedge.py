@@ -0,0 +1,160 @@
+import json
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .cassette import cassette_call
+
+with open('settings.json', mode="r", encoding="utf-8") as f:
+    settings_dict = json.load(f)
+
+DEADLINES = settings_dict["deadline"]["call_types"] # 呼び出し種別ごとのタイムアウト秒数（リトライを含めた全体）とヘッジ有無
+HEDGE_PERCENTILE = settings_dict["deadline"]["hedge_percentile"] # この分位のレイテンシを超えたら複製リクエストを送る
+HEDGE_WINDOW = settings_dict["deadline"]["window"] # レイテンシ計測に使う直近の件数
+HEDGE_MIN_SAMPLES = settings_dict["deadline"]["min_samples"] # これ未満のサンプル数ではヘッジしない
+
+MIN_REQUEST_TIMEOUT = 0.1 # 締め切り直前の試行でも、request_timeoutは0にしない
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix='hedge')
+
+# 呼び出し元スレッドごとの、リトライを含めた呼び出し全体の締め切り（time.monotonic()）
+_call_deadline = threading.local()
+
+class LatencyTracker(object):
+    """直近window件のレイテンシを保持し、分位点を返す。"""
+
+    def __init__(self, window:int=HEDGE_WINDOW, min_samples:int=HEDGE_MIN_SAMPLES):
+        self.min_samples = min_samples
+        self._samples = deque(maxlen=window)
+        self._lock = threading.Lock()
+
+    def add(self, seconds:float):
+        with self._lock:
+            self._samples.append(seconds)
+
+    def percentile(self, p:float):
+        with self._lock:
+            if len(self._samples) < self.min_samples:
+                return None
+            samples = sorted(self._samples)
+        index = min(len(samples) - 1, int(round(p / 100 * (len(samples) - 1))))
+        return samples[index]
+
+class HedgeMetrics(object):
+
+    KEYS = ['calls', 'hedges', 'hedge_wins']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, call_type:str, key:str, value=1):
+        with self._lock:
+            if not call_type in self._data:
+                self._data[call_type] = dict.fromkeys(self.KEYS, 0)
+            self._data[call_type][key] += value
+
+    def snapshot(self, trackers:dict) -> dict:
+        with self._lock:
+            data = {k: dict(v) for k, v in self._data.items()}
+        for call_type, tracker in trackers.items():
+            data.setdefault(call_type, dict.fromkeys(self.KEYS, 0))
+            data[call_type]['p{}'.format(HEDGE_PERCENTILE)] = tracker.percentile(HEDGE_PERCENTILE)
+        return data
+
+_trackers = {}
+_trackers_lock = threading.Lock()
+
+metrics = HedgeMetrics()
+
+def get_latency_tracker(call_type:str) -> LatencyTracker:
+    with _trackers_lock:
+        if not call_type in _trackers:
+            _trackers[call_type] = LatencyTracker()
+        return _trackers[call_type]
+
+def hedge_metrics() -> dict:
+    with _trackers_lock:
+        trackers = dict(_trackers)
+    return metrics.snapshot(trackers)
+
+def deadline(call_type:str) -> float:
+    return DEADLINES[call_type]["timeout_seconds"]
+
+@contextmanager
+def call_deadline(call_type:str):
+    """この中の呼び出し（リトライを含む）全体の締め切りを、timeout_seconds秒後にする。"""
+    if not call_type in DEADLINES:
+        yield
+        return
+    previous = getattr(_call_deadline, 'at', None)
+    _call_deadline.at = time.monotonic() + deadline(call_type)
+    try:
+        yield
+    finally:
+        _call_deadline.at = previous
+
+def remaining_seconds(call_type:str) -> float:
+    """締め切りまでの秒数。call_deadlineの外ではtimeout_secondsそのまま。各試行のrequest_timeoutに使う。"""
+    at = getattr(_call_deadline, 'at', None)
+    if at is None:
+        return deadline(call_type)
+    return max(MIN_REQUEST_TIMEOUT, at - time.monotonic())
+
+def hedged_call(call_type:str, fn, **kwargs):
+    """タイムアウト付きでfnを呼び、遅い場合は複製リクエストを送って先に返った方を採用する。
+
+    ・request_timeoutには、呼び出し種別ごとの締め切り（リトライ前の試行を含めた全体）までの残り秒数が入る。
+    ・直近レイテンシのp95を超えても返ってこなければ、同じリクエストをもう1本送る。
+    ・負けた方のリクエストは止められないので、そのまま捨てる（レイテンシ計測には使う）。
+    ・失敗・タイムアウトしたリクエストも、かかった秒数をレイテンシ計測に使う。
+
+    Args:
+        call_type (str): talk, guess, summarize...
+        fn : openai.ChatCompletion.create など、request_timeoutを受け取る関数
+    """
+
+    # 録音・再生中はカセットを通す（再生時はAPIを呼ばないのでヘッジもしない）
+    return cassette_call(call_type, kwargs, lambda: _hedged_call(call_type, fn, dict(kwargs)))
+
+def _hedged_call(call_type:str, fn, kwargs:dict):
+
+    kwargs['request_timeout'] = remaining_seconds(call_type)
+    tracker = get_latency_tracker(call_type)
+    metrics.add(call_type, 'calls')
+
+    def timed_call():
+        # 失敗・タイムアウトした呼び出しも、かかった秒数を記録する（遅いエンドポイントのp95が低く見えないように）
+        start = time.monotonic()
+        try:
+            return fn(**kwargs)
+        finally:
+            tracker.add(time.monotonic() - start)
+
+    threshold = tracker.percentile(HEDGE_PERCENTILE)
+    if not DEADLINES[call_type]["hedge"] or threshold is None:
+        return timed_call()
+
+    primary = _executor.submit(timed_call)
+    done, _ = wait([primary], timeout=threshold)
+    if done:
+        return primary.result()
+
+    # p95を超えたので複製リクエストを送る
+    metrics.add(call_type, 'hedges')
+    hedge = _executor.submit(timed_call)
+
+    pending = {primary, hedge}
+    error = None
+    while pending:
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None:
+                if future is hedge:
+                    metrics.add(call_type, 'hedge_wins')
+                return future.result()
+            error = future.exception()
+
+    raise error
@@ -0,0 +1,261 @@
+import os
+import re
+import sys
+import json
+import threading
+from array import array
+
+# 空行の直後で区切る（区切った断片をつなげると元に戻る）
+SEGMENT_PATTERN = re.compile(r'(?<=\n\n)')
+
+class SegmentTable(object):
+    """プロンプト断片の共有テーブル
+
+    プロンプトを空行ごとの断片に分け、同じ内容の断片には同じ文字列オブジェクトを使う。
+    プロフィールや会話サンプルなど、毎回同じ部分は1つぶんのメモリで済む。
+    上限を超えたら作り直す（共有されなくなるだけで、内容は変わらない）。
+
+    """
+
+    def __init__(self, max_segments:int=4096):
+        self.max_segments = max_segments
+        self._segments = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._segments)
+
+    def split(self, text:str) -> tuple:
+        parts = SEGMENT_PATTERN.split(text)
+        with self._lock:
+            if len(self._segments) + len(parts) > self.max_segments:
+                self._segments = {}
+            return tuple(self._segments.setdefault(part, part) for part in parts)
+
+class ConversationLine(object):
+    """会話データ1行"""
+
+    __slots__ = ('name', 'content', 'summary_so_far', 'summary_usage')
+
+    def __init__(self, name:str, content:str, summary_so_far:str='', summary_usage:dict=None):
+        self.name = sys.intern(name)
+        self.content = content
+        self.summary_so_far = summary_so_far
+        self.summary_usage = summary_usage or None # 要約した行にだけ付く
+
+    def to_dict(self) -> dict:
+        return {
+            "name": self.name,
+            "content": self.content,
+            "summary_so_far": self.summary_so_far,
+            "summary_usage": self.summary_usage or {},
+        }
+
+    @classmethod
+    def from_dict(cls, data:dict):
+        return cls(data["name"], data["content"], data["summary_so_far"], data["summary_usage"])
+
+class CompletionRecord(object):
+    """Completion履歴1件。messagesは役割と断片のタプルで持ち、usageは数値のタプルで持つ。"""
+
+    __slots__ = ('roles', 'segments', 'content', 'usage')
+
+    USAGE_KEYS = ('prompt_tokens', 'completion_tokens', 'total_tokens')
+
+    def __init__(self, messages:list, content:str, usage:dict, segment_table:SegmentTable):
+        self.roles = tuple(sys.intern(message["role"]) for message in messages)
+        self.segments = tuple(segment_table.split(message["content"]) for message in messages)
+        self.content = content
+        self.usage = tuple(int(usage[key]) for key in self.USAGE_KEYS) + (bool(usage.get("estimated")),)
+
+    @property
+    def messages(self) -> list:
+        return [{"role": role, "content": ''.join(segments)} for role, segments in zip(self.roles, self.segments)]
+
+    def to_dict(self) -> dict:
+        usage = dict(zip(self.USAGE_KEYS, self.usage))
+        if self.usage[-1]:
+            usage["estimated"] = True
+        return {
+            "messages": self.messages,
+            "response": {
+                "content": self.content,
+                "usage": usage,
+            }
+        }
+
+    @classmethod
+    def from_dict(cls, data:dict, segment_table:SegmentTable):
+        return cls(data["messages"], data["response"]["content"], data["response"]["usage"], segment_table)
+
+def read_jsonl(path:str, limit:int=None):
+    """JSONLを先頭からlimit行まで読む。"""
+    if not os.path.isfile(path):
+        return
+    with open(path, 'r', encoding='utf-8') as f:
+        for i, line in enumerate(f):
+            if limit is not None and i >= limit:
+                break
+            yield json.loads(line)
+
+class BoundedHistory(object):
+    """メモリに置く件数に上限のある履歴
+
+    ・古いレコードはspill()でJSONL（spill_path）に追記し、メモリから外す。
+    ・インデックスは通し番号のままで、外したレコードもファイルから読める（行頭のバイト位置をarrayで持つ）。
+    ・スナップショットにはメモリ上のぶんと、外した件数（offset）、ファイルのバイト数だけを入れる。
+      戻す時はファイルをそのバイト数に切り詰めるだけで、行頭の位置は外したレコードを読む時に数え直す。
+
+    レコードはto_dict()を持ち、decodeでdictから戻す。
+    """
+
+    def __init__(self, spill_path:str, decode, max_resident:int):
+        self.spill_path = spill_path
+        self.decode = decode
+        self.max_resident = max_resident
+
+        self._resident = []
+        self._offset = 0 # ファイルに外した件数
+        self._positions = array('Q') # ファイル内の各行の開始位置（_positions_start件目から）
+        self._positions_start = 0 # これより前の行の位置はまだ数えていない（restore直後）
+        self._spill_bytes = 0 # ファイルのうち、このインスタンスのレコードが入っているバイト数
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        with self._lock:
+            return self._offset + len(self._resident)
+
+    @property
+    def offset(self) -> int:
+        with self._lock:
+            return self._offset
+
+    @property
+    def resident(self) -> list:
+        with self._lock:
+            return list(self._resident)
+
+    def snapshot(self) -> tuple:
+        """スナップショット用に、メモリ上のレコード（dict）・外した件数・ファイルのバイト数を同じ時点のものとして返す。
+
+        residentとoffsetを別々に読むと、間にspill()が入った時に食い違う。
+        """
+        with self._lock:
+            return [record.to_dict() for record in self._resident], self._offset, self._spill_bytes
+
+    def append(self, record):
+        with self._lock:
+            self._resident.append(record)
+
+    def __index(self, i:int) -> int:
+        n = len(self)
+        if i < 0:
+            i += n
+        if not 0 <= i < n:
+            raise IndexError('history index out of range')
+        return i
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self[i] for i in range(*key.indices(len(self)))]
+        with self._lock:
+            i = self.__index(key)
+            if i >= self._offset:
+                return self._resident[i - self._offset]
+            positions, start = self._positions, self._positions_start
+            position = positions[i - start] if i >= start else None
+
+        # ファイルの読み込みはロックの外で行う（外した行は追記されるだけで、書き換わらない）
+        if position is None:
+            position = self.__count_positions(positions, start)[i]
+        return self.__read(position)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def __read(self, position:int):
+        with open(self.spill_path, 'rb') as f:
+            f.seek(position)
+            return self.decode(json.loads(f.readline().decode('utf-8')))
+
+    def __count_positions(self, positions:array, start:int) -> array:
+        """restoreで数えなかったstart行ぶんの開始位置を、ファイルの先頭から数えて返す。
+
+        数えるのはロックの外で、結果を_positionsにつなげるのはロックの中で行う。
+        間にrestoreが入って数え直しの対象が変わっていたら、つなげずに返すだけにする。
+        """
+        counted = array('Q')
+        position = 0
+        with open(self.spill_path, 'rb') as f:
+            for line in f:
+                if len(counted) >= start:
+                    break
+                counted.append(position)
+                position += len(line)
+        if len(counted) < start:
+            raise ValueError('Spill file has {} records, expects {} : {}'.format(len(counted), start, self.spill_path))
+
+        with self._lock:
+            if self._positions is positions and self._positions_start == start:
+                self._positions = counted + self._positions
+                self._positions_start = 0
+        return counted
+
+    def spill(self, before:int=None) -> int:
+        """beforeより前のレコードのうち、上限を超えているぶんをファイルに外す。外した件数を返す。"""
+
+        with self._lock:
+            end = len(self) - self.max_resident
+            if before is not None:
+                end = min(end, before)
+            count = end - self._offset
+            if count <= 0:
+                return 0
+
+            directory = os.path.dirname(self.spill_path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(self.spill_path, 'ab') as f:
+                position = f.tell()
+                for record in self._resident[:count]:
+                    line = (json.dumps(record.to_dict(), ensure_ascii=False) + '\n').encode('utf-8')
+                    self._positions.append(position)
+                    f.write(line)
+                    position += len(line)
+
+            del self._resident[:count]
+            self._offset += count
+            self._spill_bytes = position
+            return count
+
+    def restore(self, records:list, offset:int=0, spill_bytes:int=None):
+        """スナップショットから戻す。ファイルはoffset件目まで（spill_bytesバイト）に切り詰める（スナップショット後に外したぶんは捨てる）。
+
+        spill_bytesが無い古いスナップショットでは、ファイルを先頭から数えて切り詰める位置を探す。
+        """
+
+        with self._lock:
+            self._positions = array('Q')
+            self._positions_start = offset
+            if spill_bytes is None:
+                # 行を数え直して、offset件目の終わりを探す
+                self._spill_bytes = 0
+                if offset and os.path.isfile(self.spill_path):
+                    self.__count_positions(self._positions, offset)
+                    with open(self.spill_path, 'rb') as f:
+                        f.seek(self._positions[-1])
+                        self._spill_bytes = self._positions[-1] + len(f.readline())
+                elif offset:
+                    raise ValueError('Spill file has 0 records, snapshot expects {} : {}'.format(offset, self.spill_path))
+            else:
+                size = os.path.getsize(self.spill_path) if os.path.isfile(self.spill_path) else 0
+                if size < spill_bytes:
+                    raise ValueError('Spill file has {} bytes, snapshot expects {} : {}'.format(size, spill_bytes, self.spill_path))
+                self._spill_bytes = spill_bytes
+            if os.path.isfile(self.spill_path):
+                with open(self.spill_path, 'r+b') as f:
+                    f.truncate(self._spill_bytes)
+
+            self._offset = offset
+            self._resident = [self.decode(data) for data in records]
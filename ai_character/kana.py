@@ -0,0 +1,45 @@
+import re
+from functools import lru_cache
+
+import alkana
+
+# 英単語（アルファベットの連続）を1トークンとして扱う
+ENGLISH_WORD_PATTERN = re.compile(r'[a-zA-Z]+')
+
+@lru_cache(maxsize=4096)
+def _get_kana(word:str):
+    """alkana.get_kanaのメモ化版。alkanaは大文字小文字を区別しないので小文字をキーにする。"""
+    return alkana.get_kana(word)
+
+class EnglishKanaConverter(object):
+    """英単語をカタカナ読みに変換する。
+
+    ・テキストを1回だけ走査し、見つかった英単語をその場で置き換える。
+    ・単語は正規表現として解釈されず、他の単語の一部が置き換わることもない。
+    ・override辞書はalkanaより優先される（キーは大文字小文字を区別しない）。
+
+    """
+
+    def __init__(self, override:dict=None) -> None:
+        self.override = {}
+        if override:
+            self.add_words(override)
+
+    def add_words(self, words:dict) -> None:
+        """override辞書に読みを追加する。"""
+        for word, kana in words.items():
+            self.override[word.lower()] = kana
+
+    def get_kana(self, word:str):
+        key = word.lower()
+        if key in self.override:
+            return self.override[key]
+        return _get_kana(key)
+
+    def __replace(self, match) -> str:
+        word = match.group(0)
+        kana = self.get_kana(word)
+        return kana if kana else word
+
+    def __call__(self, text:str) -> str:
+        return ENGLISH_WORD_PATTERN.sub(self.__replace, text)
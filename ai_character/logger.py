@@ -1,57 +1,106 @@
 import os
+import json
+import queue
 import logging
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+
+LEVELS = {
+    'debug': logging.DEBUG,
+    'info': logging.INFO,
+    'warning': logging.WARNING,
+    'error': logging.ERROR,
+    'critical': logging.CRITICAL,
+}
+
+class LazyMessage(object):
+    """str()された時に初めてformatする。無効なレベルのログでは一切formatされない。"""
+
+    __slots__ = ('fmt', 'args')
+
+    def __init__(self, fmt:str, args:tuple):
+        self.fmt = fmt
+        self.args = args
+
+    def __str__(self):
+        return self.fmt.format(*self.args)
+
+class LazyJson(object):
+    """str()された時に初めてjson.dumpsする。"""
+
+    __slots__ = ('obj',)
+
+    def __init__(self, obj):
+        self.obj = obj
+
+    def __str__(self):
+        return json.dumps(self.obj, indent=4, ensure_ascii=False)
+
+class _DeferredQueueHandler(QueueHandler):
+    """レコードをformatせずにそのままキューに入れる（formatは書き込みスレッドで行う）。
+
+    ログの引数は呼び出し後に変更されないもの（文字列、数値、作り終えたmessagesなど）に限る。
+    """
+
+    def prepare(self, record):
+        return record
 
 class Logger(object):
 
-    def __init__(self, logdir:str, filename:str, lv='debug', format_str='') -> None:
+    def __init__(self, logdir:str, filename:str, lv='debug', format_str='', max_bytes:int=0, backup_count:int=0) -> None:
 
         if not os.path.isdir(logdir):
             os.makedirs(logdir)
 
         filepath = os.path.join(logdir, filename)
-        
-        self.logger = logging.getLogger(__name__)
+
+        # ファイルごとに別のloggerにする（同じプロセスで複数セッションが動いても混ざらないように）
+        self.logger = logging.getLogger('{}.{}'.format(__name__, filepath))
+        self.logger.propagate = False
 
         self.set_level(lv)
 
         if not format_str:
             format_str = '%(asctime)s [%(levelname)s] %(message)s'
         formatter = logging.Formatter(format_str)
-        file_handler = logging.FileHandler(filepath, encoding='utf-8')
-        file_handler.setFormatter(formatter)
-        self.logger.addHandler(file_handler)
+
+        # ファイル書き込みはQueueListenerのスレッドで行う。max_bytesを超えたらローテーション。
+        self.file_handler = RotatingFileHandler(filepath, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8')
+        self.file_handler.setFormatter(formatter)
+
+        self._queue = queue.SimpleQueue()
+        self.logger.addHandler(_DeferredQueueHandler(self._queue))
+        self._listener = QueueListener(self._queue, self.file_handler)
+        self._listener.start()
 
     def set_level(self, lv):
-        if lv == 'debug':
-            level = logging.DEBUG
-        elif lv == 'info':
-            level = logging.INFO
-        elif lv == 'warning':
-            level = logging.WARNING
-        elif lv == 'error':
-            level = logging.DEBUG
-        elif lv == 'critical':
-            level = logging.CRITICAL
-        
-        self.logger.setLevel(level)
-
-    def __call__(self, msg:str, cls=None, fn=None, lv:str='info') -> None:
-        
+        self.logger.setLevel(LEVELS[lv])
+
+    def is_enabled(self, lv:str) -> bool:
+        return self.logger.isEnabledFor(LEVELS[lv])
+
+    def __call__(self, msg:str, *args, cls=None, fn=None, lv:str='info') -> None:
+        """ログを出力する。
+
+        argsがある場合、msgは str.format のテンプレートとして扱われ、
+        レベルが有効な時に書き込みスレッドで初めてformatされる。
+        """
+
+        level = LEVELS[lv]
+        if not self.logger.isEnabledFor(level):
+            return
+
         head = []
         if cls:
             head.append(type(cls).__name__)
         if fn:
             head.append(fn.__name__)
 
-        message = '{0} | {1}'.format('.'.join(head), msg)
-
-        if lv == 'debug':
-            self.logger.debug(message)
-        elif lv == 'info':
-            self.logger.info(message)
-        elif lv == 'warning':
-            self.logger.warning(message)
-        elif lv == 'error':
-            self.logger.error(message)
-        elif lv == 'critical':
-            self.logger.critical(message)
\ No newline at end of file
+        if args:
+            msg = LazyMessage(msg, args)
+
+        self.logger.log(level, '%s | %s', '.'.join(head), msg)
+
+    def close(self):
+        self._listener.stop()
+        self.logger.handlers.clear()
+        self.file_handler.close()
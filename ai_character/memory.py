@@ -0,0 +1,156 @@
+import os
+import json
+import math
+import itertools
+from collections import Counter
+
+import numpy as np
+
+from .history import read_jsonl
+
+def estimate_tokens(text:str) -> int:
+    """トークン数の概算。日本語は1文字≒1トークン（UTF-8で3バイト）、英語は4文字≒1トークンとして見積もる。"""
+    return int(math.ceil(len(text.encode('utf-8')) / 3))
+
+def char_ngrams(text:str, n_min:int, n_max:int) -> Counter:
+    text = ''.join(text.split())
+    grams = Counter()
+    for n in range(n_min, n_max + 1):
+        for i in range(len(text) - n + 1):
+            grams[text[i:i + n]] += 1
+    return grams
+
+class MemoryIndex(object):
+    """キャラクターごとの長期記憶
+
+    ・過去セッションの要約（summary_so_far）と会話ログを文書として、文字n-gramのTF-IDFで索引を作る。
+    ・索引はn-gram -> (文書番号の配列, 重みの配列) の転置インデックス。文書ベクトルはL2正規化済み。
+    ・ネットワークは使わない。
+
+    """
+
+    def __init__(self, log_dir:str, ch_id:str, exclude_session:str='',
+                    ngram_min:int=2, ngram_max:int=3, window:int=4, logger=None):
+        self.log_dir = os.path.abspath(log_dir)
+        self.ch_id = ch_id
+        self.exclude_session = exclude_session
+        self.ngram_min = ngram_min
+        self.ngram_max = ngram_max
+        self.window = window # 会話ログを何行ずつ1文書にするか
+        self.logger = logger
+
+        self.documents = []
+        self._idf = {}
+        self._postings = {}
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger('[{}] '.format(self.ch_id) + msg, *args, cls=self, lv=lv)
+
+    def __len__(self):
+        return len(self.documents)
+
+    def __session_data_list(self):
+        """このキャラが登場した過去セッションのsession_dataを返す。"""
+        index_path = os.path.join(self.log_dir, 'sessions.json')
+        if not os.path.isfile(index_path):
+            return
+        with open(index_path, 'r', encoding='utf-8') as f:
+            sessions = json.load(f)
+
+        for session_id, info in sorted(sessions.items()):
+            if session_id == self.exclude_session or not self.ch_id in info["characters"]:
+                continue
+            snapshot_path = os.path.join(self.log_dir, info["snapshot"])
+            if not os.path.isfile(snapshot_path):
+                continue
+            with open(snapshot_path, 'r', encoding='utf-8') as f:
+                conversations = json.load(f)["conversations"]
+            # 古い行はスナップショットではなくjsonlにある
+            spilled = []
+            if conversations.get("session_data_offset"):
+                spilled = read_jsonl(os.path.join(self.log_dir, conversations["session_data_spill"]), 
+                                        limit=conversations["session_data_offset"])
+            yield itertools.chain(spilled, conversations["session_data"])
+
+    def __collect_documents(self) -> list:
+        documents = []
+        for session_data in self.__session_data_list():
+            lines = []
+            for data in session_data:
+                lines.append('{} : {}'.format(data['name'], data['content']))
+                if len(lines) >= self.window:
+                    documents.append('\n'.join(lines))
+                    lines = []
+                if data['summary_so_far']:
+                    documents.append(data['summary_so_far'])
+            if lines:
+                documents.append('\n'.join(lines))
+        return documents
+
+    def build(self, documents:list=None):
+        """索引を作る。documentsを省略すると過去セッションから集める。"""
+
+        if documents is None:
+            documents = self.__collect_documents()
+        self.documents = documents
+
+        grams_list = [char_ngrams(doc, self.ngram_min, self.ngram_max) for doc in documents]
+
+        df = Counter()
+        for grams in grams_list:
+            df.update(grams.keys())
+
+        n_docs = len(documents)
+        self._idf = {gram: math.log((1 + n_docs) / (1 + count)) + 1.0 for gram, count in df.items()}
+
+        postings = {}
+        for doc_id, grams in enumerate(grams_list):
+            weights = {gram: (1 + math.log(tf)) * self._idf[gram] for gram, tf in grams.items()}
+            norm = math.sqrt(sum(w * w for w in weights.values())) or 1.0
+            for gram, w in weights.items():
+                postings.setdefault(gram, ([], []))
+                postings[gram][0].append(doc_id)
+                postings[gram][1].append(w / norm)
+
+        self._postings = {gram: (np.array(ids, dtype=np.int32), np.array(ws, dtype=np.float32))
+                            for gram, (ids, ws) in postings.items()}
+
+        self.__log('Build memory index : {} documents / {} terms', n_docs, len(self._postings))
+
+    def search(self, query:str, top_k:int=3) -> list:
+        """(スコア, 文書) のリストをスコアの高い順に返す。"""
+
+        if not self.documents or not query:
+            return []
+
+        grams = char_ngrams(query, self.ngram_min, self.ngram_max)
+        scores = np.zeros(len(self.documents), dtype=np.float32)
+        for gram, tf in grams.items():
+            if not gram in self._postings:
+                continue
+            ids, ws = self._postings[gram]
+            scores[ids] += (1 + math.log(tf)) * self._idf[gram] * ws
+
+        top_k = min(top_k, len(self.documents))
+        top = np.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[np.argsort(-scores[top])]
+
+        return [(float(scores[i]), self.documents[i]) for i in top if scores[i] > 0]
+
+    def context(self, query:str, top_k:int=3, max_tokens:int=300) -> str:
+        """検索結果をmax_tokensに収まるぶんだけ連結して返す。"""
+
+        snippets = []
+        tokens = 0
+        for score, doc in self.search(query, top_k=top_k):
+            doc_tokens = estimate_tokens(doc)
+            if tokens + doc_tokens > max_tokens:
+                continue
+            snippets.append(doc)
+            tokens += doc_tokens
+
+        self.__log('Memory context : {} snippets / ~{} tokens', len(snippets), tokens, lv='debug')
+
+        return '\n---\n'.join(snippets)
@@ -0,0 +1,208 @@
+import os
+import io
+import sys
+import cProfile
+import pstats
+import threading
+import functools
+from collections import Counter
+
+class ThreadProfiler(object):
+    """ワーカースレッドごとのプロファイル
+
+    ・wrap()した関数を、スレッド名をタグにしてプロファイルする。
+    ・deterministic : スレッドごとにcProfileを動かす。<name>.pstats と <name>.txt を書き出す。
+    ・sampling : 別スレッドがinterval秒ごとにスタックを取る（オーバーヘッドが小さい）。<name>.txt を書き出す。
+    ・どちらも全スレッドをまとめたcollapsed stack（profile.collapsed、flamegraph.pl / speedscope用）を書き出す。
+      deterministicでは呼び出し関係（caller -> callee）からの近似で、値はマイクロ秒。samplingでは値はサンプル数。
+    ・Python 3.12以降のcProfileはsys.monitoringを使い、プロセスで同時に1つしか動かせない（スレッドごとに分けられない）ので、
+      deterministicを指定してもsamplingで動かす。
+
+    """
+
+    MODES = ('deterministic', 'sampling')
+
+    def __init__(self, mode:str='sampling', interval:float=0.005, max_depth:int=64, logger=None):
+        if not mode in self.MODES:
+            raise ValueError('Unknown profile mode : {}'.format(mode))
+        self.interval = interval
+        self.max_depth = max_depth
+        self.logger = logger
+
+        if mode == 'deterministic' and sys.version_info >= (3, 12):
+            self.__log('deterministic profiling needs Python 3.11 or earlier (cProfile is process-wide on {}.{}). Fall back to sampling.', 
+                        *sys.version_info[:2], lv='warning')
+            mode = 'sampling'
+        self.mode = mode
+
+        self._lock = threading.Lock()
+        self._profiles = {} # name -> cProfile.Profile
+        self._threads = {} # thread ident -> name
+        self._samples = {} # name -> Counter(stack tuple -> count)
+        self._stop_event = threading.Event()
+        self._sampler = None
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def start(self):
+        if self.mode == 'sampling' and self._sampler is None:
+            self._sampler = threading.Thread(target=self.__sample, name='profile-sampler', daemon=True)
+            self._sampler.start()
+        self.__log('Start profiling ({})', self.mode)
+
+    def stop(self):
+        self._stop_event.set()
+        if self._sampler is not None:
+            self._sampler.join()
+            self._sampler = None
+
+    def wrap(self, fn, name:str=None):
+        """fnをプロファイルしながら実行する関数を返す。"""
+
+        name = name or fn.__name__
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if self.mode == 'sampling':
+                return self.__run_sampled(name, fn, *args, **kwargs)
+            return self.__run_deterministic(name, fn, *args, **kwargs)
+
+        return wrapper
+
+    def __run_sampled(self, name:str, fn, *args, **kwargs):
+        ident = threading.get_ident()
+        with self._lock:
+            self._threads[ident] = name
+            self._samples.setdefault(name, Counter())
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            with self._lock:
+                del self._threads[ident]
+
+    def __run_deterministic(self, name:str, fn, *args, **kwargs):
+        profile = cProfile.Profile()
+        profile.enable()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            profile.disable()
+            with self._lock:
+                self._profiles[name] = profile
+
+    def __frame_name(self, code) -> str:
+        return '{}:{}:{}'.format(os.path.basename(code.co_filename), code.co_name, code.co_firstlineno)
+
+    def __sample(self):
+        while not self._stop_event.wait(self.interval):
+            frames = sys._current_frames()
+            with self._lock:
+                threads = dict(self._threads)
+            for ident, name in threads.items():
+                frame = frames.get(ident)
+                stack = []
+                # wrap()より外側（スレッドプールの呼び出し部分）は含めない
+                while frame is not None and frame.f_code is not RUN_SAMPLED_CODE and len(stack) < self.max_depth:
+                    stack.append(self.__frame_name(frame.f_code))
+                    frame = frame.f_back
+                if not stack:
+                    continue
+                with self._lock:
+                    self._samples[name][tuple(reversed(stack))] += 1
+
+    def __sampled_stats(self, samples:Counter) -> str:
+        total = sum(samples.values())
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in samples.items():
+            own[stack[-1]] += count
+            for frame in set(stack):
+                inclusive[frame] += count
+
+        lines = ['{} samples ({:.3f} sec interval)'.format(total, self.interval), '']
+        for title, counter in (('self', own), ('inclusive', inclusive)):
+            lines.append('{:>8} {:>7}  function ({})'.format('samples', '%', title))
+            for frame, count in counter.most_common(50):
+                lines.append('{:>8} {:>6.1f}%  {}'.format(count, 100.0 * count / (total or 1), frame))
+            lines.append('')
+        return '\n'.join(lines)
+
+    def __pstats_function_name(self, func:tuple) -> str:
+        filename, line, funcname = func
+        return '{}:{}:{}'.format(os.path.basename(filename), funcname, line)
+
+    def __collapse_pstats(self, stats:pstats.Stats) -> Counter:
+        """呼び出し関係からcollapsed stackを作る（マイクロ秒）。
+
+        各関数の自己時間を、呼び出し元ごとの累積時間の比で各経路に配分する。
+        """
+
+        children = {}
+        roots = []
+        for func, (cc, nc, tt, ct, callers) in stats.stats.items():
+            if not callers:
+                roots.append(func)
+            for caller, caller_stats in callers.items():
+                children.setdefault(caller, []).append((func, caller_stats[3]))
+
+        collapsed = Counter()
+
+        def walk(func, path, fraction):
+            if func in path or len(path) >= self.max_depth or fraction <= 0:
+                return
+            cc, nc, tt, ct, callers = stats.stats[func]
+            path = path + (func,)
+            value = int(tt * fraction * 1e6)
+            if value:
+                collapsed[tuple(self.__pstats_function_name(f) for f in path)] += value
+            for child, edge_ct in children.get(func, []):
+                # この経路で呼ばれたぶん = このfuncからの呼び出しの累積時間 × この経路の割合
+                child_ct = stats.stats[child][3]
+                if child_ct > 0:
+                    walk(child, path, fraction * min(1.0, edge_ct / child_ct))
+
+        for root in roots:
+            walk(root, (), 1.0)
+        return collapsed
+
+    def dump(self, out_dir:str) -> str:
+        """スレッドごとの結果とprofile.collapsedを書き出し、collapsedのパスを返す。"""
+
+        self.stop()
+        if not os.path.isdir(out_dir):
+            os.makedirs(out_dir)
+
+        collapsed = Counter()
+        with self._lock:
+            profiles = dict(self._profiles)
+            samples = {name: Counter(counter) for name, counter in self._samples.items()}
+
+        for name, profile in profiles.items():
+            profile.dump_stats(os.path.join(out_dir, name + '.pstats'))
+            text = io.StringIO()
+            stats = pstats.Stats(profile, stream=text)
+            stats.sort_stats('cumulative').print_stats(50)
+            with open(os.path.join(out_dir, name + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(text.getvalue())
+            for stack, value in self.__collapse_pstats(stats).items():
+                collapsed[(name,) + stack] += value
+
+        for name, counter in samples.items():
+            with open(os.path.join(out_dir, name + '.txt'), 'w', encoding='utf-8') as f:
+                f.write(self.__sampled_stats(counter))
+            for stack, count in counter.items():
+                collapsed[(name,) + stack] += count
+
+        collapsed_path = os.path.join(out_dir, 'profile.collapsed')
+        with open(collapsed_path, 'w', encoding='utf-8') as f:
+            for stack, value in sorted(collapsed.items()):
+                f.write('{} {}\n'.format(';'.join(frame.replace(' ', '_') for frame in stack), value))
+
+        self.__log('Profile : {}', out_dir)
+
+        return collapsed_path
+
+RUN_SAMPLED_CODE = ThreadProfiler._ThreadProfiler__run_sampled.__code__
@@ -1,6 +1,7 @@
 SYSTEM_TEMPLATE = """You are an AI character conversing with the User.
 From now on you should behave as the following characters.
 You have also had conversations provided in Talk Summary in the past.
+Excerpts from older conversations that may be relevant are shown in Memories.
 The immediate preceding statement is shown in Lines of Conversation.
 
 ## Character Profile:
@@ -9,6 +10,9 @@ The immediate preceding statement is shown in Lines of Conversation.
 ## Talk Samples:
 {talk_sample}
 
+## Memories:
+{memories}
+
 ## Talk Summary:
 {talk_summary}
 
@@ -45,26 +49,76 @@ WHO_IS_TALKING_TO_USER_TEMPLATE = """Command(input={input}) -> """
 
 
 
-SUMMARIZE_TEMPLATE = """Progressively summarize the lines of Conversation provided, adding onto the Previous Summary returning a New Summary.
-* The New Summary must be written in Japanese.
-* New Summary should not exceed 150 words.
+CHUNK_SUMMARIZE_TEMPLATE = """Summarize the lines of Conversation provided, returning a Summary.
+* The Summary must be written in Japanese.
+* Summary should not exceed 100 words.
 
 # EXAMPLE
-## Previous Summary:
-人間は、AIが人工知能をどう思うかを問う。AIは人工知能を善のための力だと考えている。
-
-## New lines of Conversation:
+## Lines of Conversation:
+User: 人工知能についてどう思いますか？
+AI: 人工知能は善のための力だと思います。
 User: なぜ、人工知能は善のための力だと思うのですか？
 AI: 人工知能が人間の潜在能力を最大限に引き出してくれるからです。
 
-## New Summary:
+## Summary:
 人間は、AIが人工知能をどう考えているのか聞いている。AIは、人工知能が人間の潜在能力を最大限に引き出すのに役立つから、人工知能は善のための力だと思う。
 # END OF EXAMPLE
 
-## Previous Summary:
-{summary}
-
-## New lines of Conversation:
+## Lines of Conversation:
 {new_lines}
+## Summary:
+"""
+
+
+ROLLUP_SUMMARIZE_TEMPLATE = """Combine the consecutive Summaries provided, in chronological order, into one New Summary.
+* The New Summary must be written in Japanese.
+* New Summary should not exceed 150 words.
+* Keep names, promises and facts that may be referred to later. Drop small talk.
+
+## Summaries:
+{summaries}
 ## New Summary:
 """
+
+
+FUSED_SYSTEM_TEMPLATE = """You are directing a conversation between the User and several AI characters.
+Decide which one of the Characters should respond to the last statement, then write that character's response.
+Past conversations are provided in Talk Summary.
+Excerpts from older conversations that may be relevant are shown in each character's Memories.
+The immediate preceding statement is shown in Lines of Conversation.
+
+## Characters:
+{personas}
+
+## Talk Summary:
+{talk_summary}
+
+## Lines of Conversation:
+{lines_of_conversations}"""
+
+
+FUSED_PERSONA_TEMPLATE = """### {name}
+Profile:
+{profile}
+Talk Style:
+{talk_style}
+Talk Samples:
+{talk_sample}
+Memories:
+{memories}"""
+
+
+FUSED_USER_TEMPLATE = """Think step by step as shown below and output only json.
+1. Choose the responder from {candidates}. If it is impossible to guess to whom the statement is addressed, choose the character most likely to respond.{hand_back}
+2. Consider the responder's response in terms consistent with their Talk Style and Talk Samples. Do not use parentheses to add tone or emotional descriptions.
+3. Check whether the same statements are being repeated. If the same statements are repeated, change the topic.
+4. Adjust the response so that it is concise and does not exceed {words} words.
+
+## Last lines of Conversation:
+{user}: {input}
+
+## Output format:
+{{"responder": "<name>", "content": "<response>"}}"""
+
+
+FUSED_HAND_BACK_TEMPLATE = """ If the statement is addressed to {user}, choose "{user}" and output an empty content."""
@@ -1,13 +1,20 @@
 import json
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from functools import wraps
 from tenacity import (
     retry,
-    retry_if_exception_type,
+    retry_if_exception,
     stop_after_attempt,
-    wait_exponential,
+    stop_before_delay,
 )
 
 import openai
 
+from .hedge import DEADLINES, deadline, call_deadline
+
 with open('settings.json', mode="r", encoding="utf-8") as f:
     settings_dict = json.load(f)
 
@@ -15,18 +22,237 @@ MAX_ATTEMPT = settings_dict["retry"]["max_attempt_number"] # リトライ回数
 MIN_SECONDS = settings_dict["retry"]["min_wait_seconds"] # 最小リトライ秒数
 MAX_SECONDS = settings_dict["retry"]["max_wait_seconds"] # 最大リトライ秒数
 
-def retry_decorator(func):
-    return retry(
-        #reraise=True,
-        stop=stop_after_attempt(MAX_ATTEMPT),
-        wait=wait_exponential(multiplier=1, min=MIN_SECONDS, max=MAX_SECONDS),
-        retry=(
-            retry_if_exception_type(openai.error.APIError)
-            | retry_if_exception_type(openai.error.Timeout)
-            | retry_if_exception_type(openai.error.RateLimitError)
-            | retry_if_exception_type(openai.error.APIConnectionError)
-            | retry_if_exception_type(openai.error.InvalidRequestError)
-            | retry_if_exception_type(openai.error.AuthenticationError)
-            | retry_if_exception_type(openai.error.ServiceUnavailableError)
-        )
-    )(func)
\ No newline at end of file
+BREAKER_THRESHOLD = settings_dict["retry"]["circuit_breaker"]["failure_threshold"] # 連続失敗でオープンする回数
+BREAKER_RESET_SECONDS = settings_dict["retry"]["circuit_breaker"]["reset_seconds"] # オープンから試行再開までの秒数
+
+DEFAULT_ENDPOINT = 'chat_completion'
+
+# リトライしても結果が変わらないエラー
+PERMANENT_ERRORS = (
+    openai.error.InvalidRequestError,
+    openai.error.AuthenticationError,
+    openai.error.PermissionError,
+    openai.error.SignatureVerificationError,
+)
+
+# 時間をおけば成功し得るエラー
+TRANSIENT_ERRORS = (
+    openai.error.APIError,
+    openai.error.Timeout,
+    openai.error.RateLimitError,
+    openai.error.APIConnectionError,
+    openai.error.ServiceUnavailableError,
+    openai.error.TryAgain,
+)
+
+class CircuitOpenError(Exception):
+    """サーキットブレーカーがオープン中でAPIを呼ばずに失敗したことを表す。"""
+
+    def __init__(self, endpoint:str, remaining:float):
+        super().__init__('Circuit open for {} ({:.1f}s remaining)'.format(endpoint, remaining))
+        self.endpoint = endpoint
+        self.remaining = remaining
+
+def is_transient(e:BaseException) -> bool:
+    if isinstance(e, PERMANENT_ERRORS):
+        return False
+    if isinstance(e, TRANSIENT_ERRORS):
+        # 4xxのAPIErrorはリクエスト側の問題なのでリトライしない（429は除く）
+        status = getattr(e, 'http_status', None)
+        if type(status) == int and 400 <= status < 500 and status not in (408, 409, 429):
+            return False
+        return True
+    return False
+
+def retry_after_seconds(e:BaseException):
+    """エラーのレスポンスヘッダーからRetry-After秒数を取り出す。無ければNone。"""
+    headers = getattr(e, 'headers', None) or {}
+    try:
+        if 'retry-after-ms' in headers:
+            return max(0.0, float(headers['retry-after-ms']) / 1000)
+        if 'retry-after' in headers:
+            value = headers['retry-after']
+            try:
+                return max(0.0, float(value))
+            except ValueError:
+                # HTTP-date形式
+                return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        pass
+    return None
+
+def wait_retry_after_or_jitter(retry_state) -> float:
+    """Retry-Afterがあればそれに従い、無ければfull jitter付きの指数バックオフ。"""
+    e = retry_state.outcome.exception()
+    retry_after = retry_after_seconds(e)
+    if retry_after is not None:
+        return min(retry_after, MAX_SECONDS)
+
+    ceiling = min(MAX_SECONDS, MIN_SECONDS * 2 ** (retry_state.attempt_number - 1))
+    return random.uniform(MIN_SECONDS, max(MIN_SECONDS, ceiling))
+
+class CircuitBreaker(object):
+    """エンドポイントごとのサーキットブレーカー
+
+    ・closed : 通常。一時的エラーが連続threshold回でopenへ。
+    ・open : reset_seconds経過まで呼び出しを即失敗させる。
+    ・half_open : 1件だけ試行を通し、成功でclosed、失敗でopenへ戻る。
+      一時的でないエラー（InvalidRequestError等）は応答があったので成功とみなす。
+
+    """
+
+    def __init__(self, endpoint:str, threshold:int=BREAKER_THRESHOLD, reset_seconds:float=BREAKER_RESET_SECONDS):
+        self.endpoint = endpoint
+        self.threshold = threshold
+        self.reset_seconds = reset_seconds
+
+        self._lock = threading.Lock()
+        self._state = 'closed'
+        self._failures = 0
+        self._opened_at = 0.0
+        self._trial_running = False
+
+    @property
+    def state(self):
+        with self._lock:
+            return self._state
+
+    def before_call(self):
+        with self._lock:
+            if self._state == 'closed':
+                return
+
+            elapsed = time.monotonic() - self._opened_at
+            if self._state == 'open' and elapsed >= self.reset_seconds:
+                self._state = 'half_open'
+                self._trial_running = False
+
+            if self._state == 'half_open' and not self._trial_running:
+                self._trial_running = True
+                return
+
+            raise CircuitOpenError(self.endpoint, max(0.0, self.reset_seconds - elapsed))
+
+    def record_success(self):
+        with self._lock:
+            self._state = 'closed'
+            self._failures = 0
+            self._trial_running = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_running = False
+            if self._state == 'half_open' or self._failures >= self.threshold:
+                self._state = 'open'
+                self._opened_at = time.monotonic()
+
+    def end_call(self):
+        """呼び出しの後に必ず呼ぶ。成功・失敗を記録せずに終わった試行（中断など）でも、次の試行を通せるようにする。"""
+        with self._lock:
+            self._trial_running = False
+
+class RetryMetrics(object):
+    """呼び出し種別ごとのリトライ統計"""
+
+    KEYS = ['calls', 'attempts', 'retries', 'successes', 'failures', 'permanent_errors', 'short_circuits', 'wait_seconds']
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = {}
+
+    def add(self, call_type:str, key:str, value=1):
+        with self._lock:
+            if not call_type in self._data:
+                self._data[call_type] = dict.fromkeys(self.KEYS, 0)
+            self._data[call_type][key] += value
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return {k: dict(v) for k, v in self._data.items()}
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+metrics = RetryMetrics()
+
+def get_circuit_breaker(endpoint:str=DEFAULT_ENDPOINT) -> CircuitBreaker:
+    with _breakers_lock:
+        if not endpoint in _breakers:
+            _breakers[endpoint] = CircuitBreaker(endpoint)
+        return _breakers[endpoint]
+
+def retry_metrics() -> dict:
+    return metrics.snapshot()
+
+def retry_decorator(call_type:str, endpoint:str=DEFAULT_ENDPOINT):
+    """APIコール用のリトライデコレーター
+
+    deadline.call_typesにある呼び出し種別は、timeout_secondsがリトライを含めた全体の締め切りになる。
+    締め切りまでに次の試行を始められなければ（待ち時間を含めて）リトライしない。
+
+    Args:
+        call_type (str): メトリクス集計用の呼び出し種別（talk, guess, summarize...）
+        endpoint (str): サーキットブレーカーを共有する単位
+    """
+
+    breaker = get_circuit_breaker(endpoint)
+
+    def before_sleep(retry_state):
+        metrics.add(call_type, 'retries')
+        metrics.add(call_type, 'wait_seconds', retry_state.next_action.sleep)
+
+    def decorator(func):
+
+        @wraps(func)
+        def attempt(*args, **kwargs):
+            metrics.add(call_type, 'attempts')
+            try:
+                breaker.before_call()
+            except CircuitOpenError:
+                metrics.add(call_type, 'short_circuits')
+                raise
+
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if is_transient(e):
+                    breaker.record_failure()
+                else:
+                    # 一時的でないエラーは、エンドポイントからの応答はあったものとして成功扱いにする
+                    metrics.add(call_type, 'permanent_errors')
+                    breaker.record_success()
+                raise
+            else:
+                breaker.record_success()
+                return result
+            finally:
+                breaker.end_call()
+
+        stop = stop_after_attempt(MAX_ATTEMPT)
+        if call_type in DEADLINES:
+            stop = stop | stop_before_delay(deadline(call_type))
+
+        retrying = retry(
+            reraise=True,
+            stop=stop,
+            wait=wait_retry_after_or_jitter,
+            retry=retry_if_exception(is_transient),
+            before_sleep=before_sleep,
+        )(attempt)
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            metrics.add(call_type, 'calls')
+            try:
+                with call_deadline(call_type):
+                    result = retrying(*args, **kwargs)
+            except Exception:
+                metrics.add(call_type, 'failures')
+                raise
+            metrics.add(call_type, 'successes')
+            return result
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,102 @@
+import threading
+from collections import deque
+
+class CandidateRouter(object):
+    """応答者の判別に送る候補キャラを絞り込む
+
+    キャラが多いと判別のプロンプトが長くなり、精度も落ちるので、判別の前に候補をmax_candidates人までにする。
+    発言者以外のキャラを次のスコアで並べ、上位を返す（同点は名前順）。
+
+    ・発言中で名前・別名（aliases）を呼ばれた : mention_weight
+    ・直近recent_turnsターンの発言者 : 新しいほど高く、最大recent_weight
+    ・直近cooldown_turnsターン以内に話した : -cooldown_weight（同じキャラばかり話さないように）
+    ・話した回数が少ない : 最大fairness_weight
+
+    キャラがmax_candidates人以下なら絞り込まない。
+    """
+
+    def __init__(self,
+                max_candidates:int=4,
+                recent_turns:int=6,
+                cooldown_turns:int=1,
+                mention_weight:float=10.0,
+                recent_weight:float=2.0,
+                cooldown_weight:float=1.0,
+                fairness_weight:float=1.0,
+                logger=None):
+        self.max_candidates = max_candidates
+        self.recent_turns = recent_turns
+        self.cooldown_turns = cooldown_turns
+        self.mention_weight = mention_weight
+        self.recent_weight = recent_weight
+        self.cooldown_weight = cooldown_weight
+        self.fairness_weight = fairness_weight
+        self.logger = logger
+
+        self._aliases = {} # 名前 -> 呼び名のリスト
+        self._recent = deque(maxlen=max(recent_turns, cooldown_turns, 1)) # 直近の発言者（新しいものが右）
+        self._counts = {} # 名前 -> 話した回数
+        self._lock = threading.Lock()
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def add_character(self, name:str, aliases:list=None):
+        # 長い呼び名から探す（「デレ子」より「ツン・デレ子」を先に）
+        names = sorted(set([name] + list(aliases or [])), key=len, reverse=True)
+        with self._lock:
+            self._aliases[name] = [alias for alias in names if alias]
+            self._counts.setdefault(name, 0)
+
+    def observe(self, name:str):
+        """発言者を記録する（ユーザーも含む）。"""
+        with self._lock:
+            self._recent.append(name)
+            if name in self._counts:
+                self._counts[name] += 1
+
+    def mentions(self, content:str) -> list:
+        """発言中で呼ばれたキャラの名前"""
+        with self._lock:
+            return [name for name, aliases in self._aliases.items() if any(alias in content for alias in aliases)]
+
+    def scores(self, speaker:str, content:str) -> dict:
+        """発言者以外のキャラのスコア"""
+
+        mentioned = self.mentions(content)
+        with self._lock:
+            recent = list(self._recent)
+            counts = {name: count for name, count in self._counts.items() if name != speaker}
+
+        scores = {}
+        max_count = max(counts.values(), default=0)
+        for name, count in counts.items():
+            score = 0.0
+            if name in mentioned:
+                score += self.mention_weight
+            # 直近の発言者ほど高い（いちばん新しい発言が1.0）
+            window = recent[-self.recent_turns:] if self.recent_turns else []
+            for age, recent_name in enumerate(reversed(window)):
+                if recent_name == name:
+                    score += self.recent_weight * (1.0 - age / len(window))
+                    break
+            cooldown = recent[-self.cooldown_turns:] if self.cooldown_turns else []
+            if name in cooldown:
+                score -= self.cooldown_weight
+            if max_count:
+                score += self.fairness_weight * (max_count - count) / max_count
+            scores[name] = score
+        return scores
+
+    def shortlist(self, speaker:str, content:str) -> list:
+        """判別に送る候補の名前を、スコアの高い順に返す。"""
+
+        scores = self.scores(speaker, content)
+        names = sorted(scores, key=lambda name: (-scores[name], name))
+        if len(names) > self.max_candidates:
+            self.__log('Shortlist {} / {} : {}', self.max_candidates, len(names),
+                        {name: round(scores[name], 2) for name in names[:self.max_candidates]}, lv='debug')
+            names = names[:self.max_candidates]
+        return names
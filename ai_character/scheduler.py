@@ -0,0 +1,122 @@
+import threading
+import time
+import queue
+import wave
+from collections import deque
+from contextlib import contextmanager
+
+def wave_duration(wav:str) -> float:
+    """wavファイルの再生秒数"""
+    with wave.open(wav, mode='r') as wf:
+        return wf.getnframes() / float(wf.getframerate())
+
+class PlaybackScheduler(object):
+    """再生待ち音声の先読み量を「秒数」で制限するキュー
+
+    ・put は再生待ちの合計秒数が max_seconds 以上のあいだブロックする。
+      ただし空のときは長さにかかわらず1件は受け入れる。
+    ・put_if_idle は再生待ちも再生中も無いときだけ入れる（つなぎの音声用）。
+    ・completion_slot で同時に走るCompletion（まだ音声になっていない発言）の数を制限する。
+    ・再生待ちの秒数（buffer_seconds）をメトリクスとして参照できる。
+
+    queue.Queueと同じく get / task_done / empty / qsize を持つ。
+    """
+
+    def __init__(self, max_seconds:float, max_pending_completions:int=1):
+        self.max_seconds = max_seconds
+
+        self._items = deque()
+        self._playing = deque() # get済みで再生完了していないアイテムの秒数
+        self._buffer_seconds = 0.0
+        self._cond = threading.Condition()
+        self._completion_slots = threading.BoundedSemaphore(max_pending_completions)
+        self._pending_completions = 0
+
+        # メトリクス
+        self._peak_seconds = 0.0
+        self._blocked_seconds = 0.0
+
+    @property
+    def buffer_seconds(self) -> float:
+        with self._cond:
+            return self._buffer_seconds
+
+    @property
+    def pending_completions(self) -> int:
+        with self._cond:
+            return self._pending_completions
+
+    def metrics(self) -> dict:
+        with self._cond:
+            return {
+                "buffer_seconds": self._buffer_seconds,
+                "peak_buffer_seconds": self._peak_seconds,
+                "queued_items": len(self._items),
+                "pending_completions": self._pending_completions,
+                "producer_blocked_seconds": self._blocked_seconds,
+            }
+
+    @contextmanager
+    def completion_slot(self):
+        """Completion〜音声合成〜putまでをこの中で行う。"""
+        self._completion_slots.acquire()
+        with self._cond:
+            self._pending_completions += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._pending_completions -= 1
+            self._completion_slots.release()
+
+    def put(self, item, duration:float):
+        with self._cond:
+            start = time.monotonic()
+            while (self._items or self._playing) and self._buffer_seconds + duration > self.max_seconds:
+                self._cond.wait()
+            self._blocked_seconds += time.monotonic() - start
+
+            self._items.append((item, duration))
+            self._buffer_seconds += duration
+            self._peak_seconds = max(self._peak_seconds, self._buffer_seconds)
+            self._cond.notify_all()
+
+    def put_if_idle(self, item, duration:float) -> bool:
+        """再生待ちも再生中も無ければ入れてTrueを返す。確認と追加を1回のロックで行うので、間に他のputが入らない。"""
+        with self._cond:
+            if self._items or self._playing:
+                return False
+            self._items.append((item, duration))
+            self._buffer_seconds += duration
+            self._peak_seconds = max(self._peak_seconds, self._buffer_seconds)
+            self._cond.notify_all()
+            return True
+
+    def get(self, timeout:float=None):
+        """先頭のアイテムを取り出す。秒数は再生完了（task_done）までバッファに残る。"""
+        with self._cond:
+            if not self._cond.wait_for(lambda: self._items, timeout=timeout):
+                raise queue.Empty
+            item, duration = self._items.popleft()
+            self._playing.append(duration)
+            return item
+
+    def task_done(self):
+        """getしたアイテムの再生完了。バッファから秒数を除き、待っているputを起こす。"""
+        with self._cond:
+            duration = self._playing.popleft()
+            self._buffer_seconds = max(0.0, self._buffer_seconds - duration)
+            self._cond.notify_all()
+
+    def empty(self) -> bool:
+        with self._cond:
+            return not self._items
+
+    def idle(self) -> bool:
+        """再生待ちも再生中も無いかどうか"""
+        with self._cond:
+            return not self._items and not self._playing
+
+    def qsize(self) -> int:
+        with self._cond:
+            return len(self._items)
@@ -0,0 +1,98 @@
+import os
+import json
+import threading
+from datetime import datetime
+
+SNAPSHOT_VERSION = 1
+
+# インデックスは全セッションで1ファイルなので、同じプロセスの全SessionStoreで1つのロックを使う
+_index_lock = threading.Lock()
+
+class SessionStore(object):
+    """セッションのスナップショットとセッション一覧（インデックス）の保存・読み込み
+
+    ・log/<session_id>/snapshot.json : 会話データ、要約の位置、各キャラのCompletion履歴。
+      1ファイルなので再開時は読み込んで戻すだけで、要約のやり直しは不要。
+      ただしメモリから外した古い履歴は入れず、件数だけ入れる（本体は各jsonl）。
+    ・log/sessions.json : セッションID -> 登場キャラ、行数、更新日時、スナップショットのパス。
+
+    """
+
+    def __init__(self, log_dir:str, logger=None):
+        self.log_dir = os.path.abspath(log_dir)
+        self.index_path = os.path.join(self.log_dir, 'sessions.json')
+        self.logger = logger
+
+        self._lock = _index_lock
+
+    def __log(self, msg:str, *args, lv='info'):
+        if not self.logger:
+            return
+        self.logger(msg, *args, cls=self, lv=lv)
+
+    def snapshot_path(self, session_id:str) -> str:
+        return os.path.join(self.log_dir, session_id, 'snapshot.json')
+
+    def __write_json(self, data, path:str):
+        # 書き込み途中で落ちても前のファイルが残るように、一時ファイルに書いてから置き換える
+        # 一時ファイル名は書き込むスレッドごとに変える（同時に書いても互いの一時ファイルを置き換えない）
+        tmp_path = '{}.{}.{}.tmp'.format(path, os.getpid(), threading.get_ident())
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, separators=(',', ':'))
+        os.replace(tmp_path, path)
+
+    def __read_json(self, path:str):
+        if not os.path.isfile(path):
+            return None
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def sessions(self) -> dict:
+        """セッションのインデックスを返す。"""
+        with self._lock:
+            return self.__read_json(self.index_path) or {}
+
+    def save(self, session_id:str, conv, characters:dict):
+        """スナップショットを保存し、インデックスを更新する。
+
+        Args:
+            conv (Conversations): 会話
+            characters (dict): キャラID -> Character
+        """
+
+        snapshot = {
+            "version": SNAPSHOT_VERSION,
+            "session_id": session_id,
+            "updated": datetime.now().isoformat(timespec='seconds'),
+            "conversations": conv.get_state(),
+            "characters": {ch_id: ch.get_state() for ch_id, ch in characters.items()},
+        }
+
+        with self._lock:
+            path = self.snapshot_path(session_id)
+            self.__write_json(snapshot, path)
+
+            index = self.__read_json(self.index_path) or {}
+            index[session_id] = {
+                "characters": list(characters.keys()),
+                "lines": len(conv.session_data),
+                "updated": snapshot["updated"],
+                "snapshot": os.path.relpath(path, self.log_dir),
+            }
+            self.__write_json(index, self.index_path)
+
+        self.__log('Save snapshot : {}', path, lv='debug')
+
+    def load(self, session_id:str):
+        """スナップショットを返す。無ければNone。"""
+        path = self.snapshot_path(session_id)
+        snapshot = self.__read_json(path)
+        if snapshot is None:
+            self.__log('Snapshot not found : {}', path, lv='warning')
+            return None
+        if snapshot.get("version") != SNAPSHOT_VERSION:
+            self.__log('Unsupported snapshot version : {}', snapshot.get("version"), lv='warning')
+            return None
+
+        self.__log('Load snapshot : {}', path)
+        return snapshot
@@ -1,56 +1,123 @@
 import os
+import io
+import re
 import json
 import requests
-import wave
-import pyaudio
-import socket
-import subprocess
-import re
-import alkana
+from concurrent.futures import ThreadPoolExecutor
+
+from .kana import EnglishKanaConverter
+from .engine import VoicevoxEngine, EnginePool
+from .cassette import active_cassette, cassette_call
+from .audio import AudioEngine, AudioFormat, create_sink, read_wave, write_wave
 
 with open('settings.json', mode="r", encoding="utf-8") as f:
     settings_dict = json.load(f)
 
 VOICEVOX_ENGINE_PATH = settings_dict["voicevox"]["engine_path"]
+VOICEVOX_HOST = settings_dict["voicevox"]["engine"]["host"]
+VOICEVOX_PORTS = settings_dict["voicevox"]["engine"]["ports"] # ポートごとに1つエンジンを使う（起動する）
+VOICEVOX_ARGS = settings_dict["voicevox"]["engine"]["args"] # 起動時の追加引数（--use_gpu等）
+VOICEVOX_STARTUP_TIMEOUT = settings_dict["voicevox"]["engine"]["startup_timeout"]
+VOICEVOX_POLL_INTERVAL = settings_dict["voicevox"]["engine"]["poll_interval"]
+VOICEVOX_WATCH_INTERVAL = settings_dict["voicevox"]["engine"]["watch_interval"]
+VOICEVOX_RESTART = settings_dict["voicevox"]["engine"]["restart"] # 落ちたら再起動する
+VOICEVOX_MAX_CONCURRENCY = settings_dict["voicevox"]["pool"]["max_concurrency"] # エンジンごとの同時合成数
+VOICEVOX_HEALTH_INTERVAL = settings_dict["voicevox"]["pool"]["health_interval"]
+VOICEVOX_ACQUIRE_TIMEOUT = settings_dict["voicevox"]["pool"]["acquire_timeout"]
+VOICEVOX_REQUEST_TIMEOUT = settings_dict["voicevox"]["pool"]["request_timeout"] # audio_query・synthesisの1回あたり。超えたら別のエンジンでやり直す
+CHUNK_MAX_CHARS = settings_dict["voicevox"]["chunk"]["max_chars"] # 1回の合成に送る最大文字数。0なら区切らない
+CHUNK_PAUSE = settings_dict["voicevox"]["chunk"]["pause"] # 区切った塊の間の無音秒数
+CHUNK_WORKERS = settings_dict["voicevox"]["chunk"]["workers"] # 同時に合成する塊の数
+KANA_DICT = settings_dict["voicevox"]["kana_dict"] # 英単語の読みの上書き辞書
+
+AUDIO_SINK = settings_dict["audio"]["sink"] # pyaudio / null / file
+AUDIO_FILE_PATH = settings_dict["audio"]["file_path"] # sinkがfileの時の出力先
+AUDIO_SAMPLE_RATE = settings_dict["audio"]["sample_rate"]
+AUDIO_CHANNELS = settings_dict["audio"]["channels"]
+AUDIO_CHUNK_FRAMES = settings_dict["audio"]["chunk_frames"]
+AUDIO_BUFFER_SECONDS = settings_dict["audio"]["buffer_seconds"] # リングバッファの長さ
+
+SENTENCE_PATTERN = re.compile(r'[^。．！？!?\n]*[。．！？!?\n]+|[^。．！？!?\n]+$')
+CLAUSE_PATTERN = re.compile(r'[^、，,]*[、，,]+|[^、，,]+$')
+
+def split_text(text:str, max_chars:int) -> list:
+    """文末の句読点で区切り、max_chars以下の塊にまとめる。長すぎる文は読点で、それでも長ければ文字数で区切る。"""
+
+    if max_chars <= 0 or len(text) <= max_chars:
+        return [text]
+
+    pieces = []
+    for sentence in SENTENCE_PATTERN.findall(text):
+        if len(sentence) <= max_chars:
+            pieces.append(sentence)
+            continue
+        for clause in CLAUSE_PATTERN.findall(sentence):
+            while len(clause) > max_chars:
+                pieces.append(clause[:max_chars])
+                clause = clause[max_chars:]
+            if clause:
+                pieces.append(clause)
+
+    chunks = []
+    for piece in pieces:
+        # 句読点だけの塊は前にくっつける
+        if chunks and (len(chunks[-1]) + len(piece) <= max_chars or not re.search(r'\w', piece)):
+            chunks[-1] += piece
+        else:
+            chunks.append(piece)
+
+    return [chunk for chunk in chunks if chunk.strip()] or [text]
 
 class VoiceGenerator(object):
 
-    def __init__(self, logger=None):
+    def __init__(self, speaker_ids:list=(), logger=None):
         self.logger = logger
         self.__log('Init')
         
-        self.chunk_size = 1024
+        self.chunk_size = AUDIO_CHUNK_FRAMES
+
+        # 常駐の音声出力エンジン。VOICEVOXにはこのフォーマットで合成させる（変換は不要になる）
+        self.audio_format = AudioFormat(AUDIO_SAMPLE_RATE, AUDIO_CHANNELS, 2)
+        self.audio_engine = AudioEngine(create_sink(AUDIO_SINK, AUDIO_FILE_PATH), 
+                                        self.audio_format, 
+                                        chunk_frames=self.chunk_size, 
+                                        buffer_seconds=AUDIO_BUFFER_SECONDS, 
+                                        logger=logger)
 
-        if VOICEVOX_ENGINE_PATH:
-            if not self.__check_server('localhost', 50021):
-                subprocess.Popen(['start', '', VOICEVOX_ENGINE_PATH, '--use_gpu'], shell=True)
+        # 英単語 -> カナ変換
+        self.kana_converter = EnglishKanaConverter(KANA_DICT)
+
+        # 長い文を区切って並列に合成する用
+        self._chunk_executor = ThreadPoolExecutor(max_workers=CHUNK_WORKERS, thread_name_prefix='synthesis')
+
+        # VOICEVOX ENGINE。起動していなければ起動し、使うspeakerを先に初期化しておく
+        # 複数あれば空いているエンジンに振り分ける
+        engines = [VoicevoxEngine(VOICEVOX_ENGINE_PATH, 
+                                    host=VOICEVOX_HOST, 
+                                    port=port, 
+                                    args=VOICEVOX_ARGS, 
+                                    startup_timeout=VOICEVOX_STARTUP_TIMEOUT, 
+                                    poll_interval=VOICEVOX_POLL_INTERVAL, 
+                                    watch_interval=VOICEVOX_WATCH_INTERVAL, 
+                                    restart=VOICEVOX_RESTART, 
+                                    logger=logger) for port in VOICEVOX_PORTS]
+        self.engine_pool = EnginePool(engines, 
+                                    max_concurrency=VOICEVOX_MAX_CONCURRENCY, 
+                                    health_interval=VOICEVOX_HEALTH_INTERVAL, 
+                                    acquire_timeout=VOICEVOX_ACQUIRE_TIMEOUT, 
+                                    logger=logger)
+        # カセットの再生中はエンジンを使わない
+        cassette = active_cassette()
+        if not (cassette and cassette.replaying):
+            self.engine_pool.start(speaker_ids)
     
-    def __log(self, msg:str, lv='info'):
+    def __log(self, msg:str, *args, lv='info'):
         if not self.logger:
             return
-        self.logger(msg, cls=self, lv=lv)
-
-    def __check_server(self, address, port):
-        s = socket.socket()
-        try:
-            s.connect((address, port))
-            return True
-        except ConnectionRefusedError:
-            return False
-        finally:
-            s.close()
+        self.logger(msg, *args, cls=self, lv=lv)
     
     def __alkana(self, text:str) -> str:
-        
-        pattern = r'[a-zA-Z]+'
-        words = re.findall(pattern, text)
-        
-        for w in words:
-            kana = alkana.get_kana(w)
-            if kana:
-                text = re.sub(w, kana, text)
-
-        return text
+        return self.kana_converter(text)
 
     def text2voice(self, text, 
                     filename, 
@@ -61,61 +128,141 @@ class VoiceGenerator(object):
                     pitch=0, 
                     intonation=1,
                     post=0) -> str:
+        """音声合成してwavのパスを返す。長い文は区切って並列に合成し、つなげて1つのwavにする。"""
+
+        futures = self.__submit_chunks(text, speaker, volume, speed, pitch, intonation, post)
+
+        pcm_list = []
+        for future in futures:
+            pcm, fmt = read_wave(io.BytesIO(future.result()))
+            pcm_list.append(pcm)
+
+        audio_file = self.__wav_path(path, filename)
+        write_wave(audio_file, b''.join(pcm_list), fmt)
+
+        self.__log('Complete synthesis : {} ({} chunks)', audio_file, len(futures))
+
+        return audio_file
+
+    def text2voice_chunks(self, text, 
+                    filename, 
+                    path='wav', 
+                    speaker=0, 
+                    volume=1, 
+                    speed=1.0, 
+                    pitch=0, 
+                    intonation=1,
+                    post=0):
+        """text2voiceと同じだが、区切った塊ごとのwavのパスを、できた順ではなく文の順に返すジェネレータ。
+
+        最初の塊ができた時点で再生を始められる。
+        """
+
+        futures = self.__submit_chunks(text, speaker, volume, speed, pitch, intonation, post)
+
+        for i, future in enumerate(futures):
+            audio_file = self.__wav_path(path, '{}_{}'.format(filename, i))
+            with open(audio_file, mode="wb") as f:
+                f.write(future.result())
+
+            self.__log('Complete synthesis : {} ({}/{})', audio_file, i + 1, len(futures))
+
+            yield audio_file
+
+    def __wav_path(self, path:str, filename:str) -> str:
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        return os.path.join(path, filename + '.wav')
+
+    def __submit_chunks(self, text, speaker, volume, speed, pitch, intonation, post) -> list:
+        """区切った塊ごとの合成を投げ、wavのbytesを返すfutureのリストを返す。"""
         
         text = self.__alkana(text)
+        chunks = split_text(text, CHUNK_MAX_CHARS)
         
-        self.__log('Start voice synthesis... ({})'.format(text))
+        self.__log('Start voice synthesis... ({}) {} chunks', text, len(chunks))
+
+        futures = []
+        for i, chunk in enumerate(chunks):
+            # 韻律の設定は全塊で同じにする。塊の間は文の区切り程度の無音にする
+            query = {
+                "volumeScale": volume,
+                "speedScale": speed,
+                "pitchScale": pitch,
+                "intonationScale": intonation,
+                "postPhonemeLength": post if i == len(chunks) - 1 else CHUNK_PAUSE,
+                "outputSamplingRate": self.audio_format.rate,
+                "outputStereo": self.audio_format.channels == 2,
+            }
+            if i > 0:
+                query["prePhonemeLength"] = 0.0
+            futures.append(self._chunk_executor.submit(self.__synthesize_chunk, chunk, speaker, query))
+
+        return futures
+
+    def __synthesize_chunk(self, text:str, speaker:int, query:dict) -> bytes:
+
+        # audio_query〜synthesisは同じエンジンで行う
+        request = {"text": text, "speaker": speaker, "query": query}
+        return cassette_call('voicevox', request, 
+                                lambda: self.engine_pool.call(lambda url: self.__synthesis(url, text, speaker, query)))
+
+    def __synthesis(self, url:str, text:str, speaker:int, query:dict) -> bytes:
 
         # audio_query
-        res1 = requests.post("http://localhost:50021/audio_query",
-                            params={"text": text, "speaker": speaker})
+        res1 = requests.post(url + "/audio_query",
+                            params={"text": text, "speaker": speaker}, 
+                            timeout=VOICEVOX_REQUEST_TIMEOUT)
+        res1.raise_for_status()
         
         res1 = res1.json()
-        res1["volumeScale"]=volume
-        res1["speedScale"]=speed
-        res1["pitchScale"]=pitch
-        res1["intonationScale"]=intonation
-        res1["postPhonemeLength"]=post
+        res1.update(query)
         
         # synthesis
-        res2 = requests.post("http://localhost:50021/synthesis",
+        res2 = requests.post(url + "/synthesis",
                             params={"speaker": speaker},
-                            data=json.dumps(res1))
-        
-        if not os.path.isdir(path):
-            os.makedirs(path)
-        
-        audio_file = os.path.join(path, filename + '.wav')
-        with open(audio_file, mode="wb") as f:
-            f.write(res2.content)
-
-        self.__log('Complete synthesis : {}'.format(audio_file))
+                            data=json.dumps(res1), 
+                            timeout=VOICEVOX_REQUEST_TIMEOUT)
+        res2.raise_for_status()
 
-        return audio_file
+        return res2.content
 
     def play_wave(self, wav:str, delete=False):
+        """wavを常駐の出力エンジンで再生し、再生し終わるまで待つ。
+
+        出力ストリームは開いたままなので、終わった直後に次のwavを渡せば隙間なく続けて再生される。
+        """
         if not os.path.isfile(wav):
             return
         
-        self.__log('Play : {}'.format(wav))
+        self.__log('Play : {}', wav)
 
-        with wave.open(wav, mode='r') as wf:
+        pcm, fmt = read_wave(wav)
+        self.play_pcm(pcm, fmt)
 
-            p = pyaudio.PyAudio()
-            stream = p.open(format=p.get_format_from_width(wf.getsampwidth()),
-                            channels=wf.getnchannels(),
-                            rate=wf.getframerate(),
-                            output=True)
+        if delete:
+            os.remove(wav)
+            self.__log('Delete file : {}', wav)
 
-            data = wf.readframes(self.chunk_size)
-            while data != b'':
-                stream.write(data)
-                data = wf.readframes(self.chunk_size)
+    def play_pcm(self, pcm:bytes, fmt, wait:bool=True):
+        """PCMを再生し、再生し終わるまで待つ。waitがFalseなら再生キューに入れるだけで、PlaybackHandleを返す。"""
+        handle = self.audio_engine.play(pcm, fmt)
+        if wait:
+            handle.wait()
+        return handle
 
-            stream.stop_stream()
-            stream.close()
-            p.terminate()
+    def play_archived(self, archive, utterance_id:int):
+        """アーカイブ済みの発話を再合成せずに再生する。"""
+        self.__log('Play archived : {}', utterance_id)
+        pcm, fmt = archive.read(utterance_id)
+        self.play_pcm(pcm, fmt)
 
-        if delete:
-            os.remove(wav)
-            self.__log('Delete file : {}'.format(wav))
+    def metrics(self) -> dict:
+        """エンジンごとの同時実行数・リクエスト数・失敗数・健全かどうか"""
+        return self.engine_pool.metrics()
+
+    def close(self):
+        self._chunk_executor.shutdown(wait=True)
+        self.audio_engine.close()
+        self.engine_pool.stop()
+        self.__log('Close')
@@ -0,0 +1,59 @@
+"""英単語 -> カナ変換のマイクロベンチマーク
+
+リポジトリのルートで実行する。
+    python -m benchmarks.bench_alkana
+"""
+import argparse
+import random
+import re
+import time
+
+import alkana
+
+from ai_character.kana import EnglishKanaConverter
+
+WORDS = ["hello", "world", "python", "computer", "music", "game", "coffee",
+        "school", "test", "program", "summer", "happy", "apple", "AI", "GPT",
+        "internet", "smartphone", "video", "camera", "best"]
+
+def legacy_alkana(text:str) -> str:
+    """変更前のVoiceGenerator.__alkana（単語ごとにre.subで全体を再走査）"""
+    pattern = r'[a-zA-Z]+'
+    words = re.findall(pattern, text)
+
+    for w in words:
+        kana = alkana.get_kana(w)
+        if kana:
+            text = re.sub(w, kana, text)
+
+    return text
+
+def make_utterance(n_words:int, seed:int=0) -> str:
+    rnd = random.Random(seed)
+    parts = []
+    for _ in range(n_words):
+        parts.append(rnd.choice(WORDS))
+        parts.append(rnd.choice(["、", "って", "は", "の", "。"]))
+    return ''.join(parts)
+
+def bench(fn, text:str, repeat:int) -> float:
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn(text)
+    return (time.perf_counter() - start) / repeat
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--words", type=int, nargs='*', default=[10, 50, 200, 1000], help="発言あたりの英単語数")
+    parser.add_argument("-r", "--repeat", type=int, default=200, help="繰り返し回数")
+    opt = parser.parse_args()
+
+    converter = EnglishKanaConverter()
+
+    print('{:>8} | {:>12} | {:>12} | {:>8}'.format('words', 'legacy [us]', 'new [us]', 'speedup'))
+    for n in opt.words:
+        text = make_utterance(n)
+        t_legacy = bench(legacy_alkana, text, opt.repeat)
+        t_new = bench(converter, text, opt.repeat)
+        print('{:>8} | {:>12.1f} | {:>12.1f} | {:>7.1f}x'.format(n, t_legacy * 1e6, t_new * 1e6, t_legacy / t_new))
@@ -0,0 +1,125 @@
+"""2回コール（判別 -> 返答）と1回コール（fused）の比較ベンチマーク
+
+レイテンシ、トークン数、応答者の判別精度を比べる。OpenAI APIを実際に呼ぶのでOPENAI_API_KEYが必要。
+--stubを付けると、bench_scalingのOpenAIスタブを相手にする（APIキー不要。応答者はスタブがランダムに選ぶので、
+判別精度は意味が無く、プロンプトのトークン数とオーバーヘッドの比較用）。
+リポジトリのルートで実行する。
+    python -m benchmarks.bench_fused -c dereko interiko
+    python -m benchmarks.bench_fused --stub 0.3
+"""
+import os
+import argparse
+import json
+import statistics
+import tempfile
+import time
+
+import openai
+
+from ai_character import Character, Interlocutor, draw_response_words, response_max_tokens
+from benchmarks.bench_scaling import StubServer, OpenAIHandler
+
+# (発言者, 発言, 応答すべきキャラの名前)。名前はcharacter_dataのsettings.jsonのname。発言者・応答者Noneはユーザー。
+CASES = [
+    (None, "デレ子、今日の小テストどうだった？", "ツン・デレ子"),
+    (None, "インテリ子さん、相対性理論を簡単に説明してくれる？", "インテリ子"),
+    (None, "ねえデレ子、部活は何に入ってるの？", "ツン・デレ子"),
+    (None, "インテリ子、おすすめの本を教えて", "インテリ子"),
+    ("ツン・デレ子", "インテリ子、あんたまた難しい本読んでるの？", "インテリ子"),
+    ("インテリ子", "デレ子さん、宿題は終わりましたか？", "ツン・デレ子"),
+    ("ツン・デレ子", "ねえ、あんたはどう思うのよ？", None),
+]
+
+def run_two_call(characters:dict, interlocutor:Interlocutor, username:str, speaker:str, content:str):
+    # run.pyと同じく、発言者以外のユーザーとキャラ
+    template = {name: 0.0 for name in [username] + list(characters.keys()) if name != speaker}
+    template["unknown"] = 1.0
+
+    start = time.perf_counter()
+    result = interlocutor.guess(template, content)
+    tokens = 0
+    responder = "unknown"
+    if result and result[0]:
+        interlocutor_dict, usage = result
+        tokens += usage['total_tokens']
+        responder = max(interlocutor_dict, key=interlocutor_dict.get)
+
+    if responder in characters:
+        ch = characters[responder]
+        words = draw_response_words()
+        result = ch.talk(ch.create_messages(user_input=content, user_name=speaker, words=words), 
+                        max_tokens=response_max_tokens(words))
+        if result:
+            tokens += result[1]['total_tokens']
+
+    return time.perf_counter() - start, tokens, responder
+
+def run_fused(characters:dict, interlocutor:Interlocutor, username:str, speaker:str, content:str):
+    candidates = [ch for name, ch in characters.items() if name != speaker]
+
+    start = time.perf_counter()
+    result = interlocutor.guess_and_talk(candidates, content, user_name=speaker, 
+                                        username=username if speaker != username else '')
+    if not result:
+        return time.perf_counter() - start, 0, "unknown"
+
+    responder, _, _, usage = result
+    return time.perf_counter() - start, usage['total_tokens'], responder
+
+def summarize(name:str, rows:list):
+    latencies = [r[0] for r in rows]
+    tokens = [r[1] for r in rows]
+    accuracy = sum(1 for r in rows if r[2] == r[3]) / len(rows)
+    print('{:>10} | {:>8.2f} | {:>8.2f} | {:>8.2f} | {:>8.1f} | {:>7.0%}'.format(
+        name,
+        statistics.median(latencies),
+        sorted(latencies)[int(0.95 * (len(latencies) - 1))],
+        max(latencies),
+        statistics.mean(tokens),
+        accuracy))
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-c", "--character", type=str, nargs='*', default=["dereko", "interiko"], help="キャラクター名")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="各ケースの繰り返し回数")
+    parser.add_argument("-o", "--output", type=str, default='', help="結果をjsonで保存するパス")
+    parser.add_argument("--stub", type=float, default=None, metavar='LATENCY', help="OpenAIの代わりに、このレイテンシ（秒）のスタブを使う")
+    opt = parser.parse_args()
+
+    with open('settings.json', mode="r", encoding="utf-8") as f:
+        settings_dict = json.load(f)
+
+    log_dir = tempfile.mkdtemp()
+    characters = {}
+    for ch_id in opt.character:
+        ch = Character(os.path.abspath(settings_dict["character_dir"]), ch_id, log_dir, 'bench')
+        characters[ch.name] = ch
+    interlocutor = Interlocutor()
+
+    if opt.stub is not None:
+        stub = StubServer(OpenAIHandler)
+        stub.latency = opt.stub
+        stub.content = 'ふーん、そうなんだ。'
+        stub.names = set(characters.keys())
+        openai.api_base = 'http://127.0.0.1:{}/v1'.format(stub.port)
+        openai.api_key = 'bench'
+
+    results = {"two_call": [], "fused": []}
+    for _ in range(opt.repeat):
+        for speaker, content, expected in CASES:
+            username = settings_dict["username"]
+            speaker = speaker or username
+            expected = expected or username
+            latency, tokens, responder = run_two_call(characters, interlocutor, username, speaker, content)
+            results["two_call"].append((latency, tokens, responder, expected))
+            latency, tokens, responder = run_fused(characters, interlocutor, username, speaker, content)
+            results["fused"].append((latency, tokens, responder, expected))
+
+    print('{:>10} | {:>8} | {:>8} | {:>8} | {:>8} | {:>7}'.format('mode', 'p50 [s]', 'p95 [s]', 'max [s]', 'tokens', 'routing'))
+    for name, rows in results.items():
+        summarize(name, rows)
+
+    if opt.output:
+        with open(opt.output, 'w', encoding='utf-8') as f:
+            json.dump(results, f, indent=4, ensure_ascii=False)
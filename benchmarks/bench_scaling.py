@@ -0,0 +1,447 @@
+"""会話パイプライン（MultiCharacterTalking）の同時実行スケーリングのベンチマーク
+
+キャラ数・同時セッション数・スタブのレイテンシを変えながら、1プロセス内で複数セッションを動かし、
+スループット、キュー（q_message / q_user_input / q_voice_play）の深さ、CPU使用率・スレッド数、
+セッションあたりのメモリを表とCSVで出す。1台のホストがどこで頭打ちになるかを見る用。
+
+OpenAIとVOICEVOX ENGINEは同じプロセス内のHTTPサーバー（スタブ）で置き換えるので、APIキーもエンジンも不要。
+設定は一時ディレクトリにsettings.jsonを書いて読ませる（ポート、ログの場所、キャラの場所、null出力、ペース制御なし）。
+リポジトリのルートで実行する。
+    python -m benchmarks.bench_scaling --cast 2 4 8 --sessions 1 2 4 --latency 0.2 0.8 -o scaling.csv
+"""
+import os
+import io
+import sys
+import csv
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import contextlib
+import importlib
+import wave
+from urllib.parse import urlparse, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# ---- スタブ ----
+
+class StubServer(object):
+    """ThreadingHTTPServerを別スレッドで動かす。レイテンシは実行中に変えられる。"""
+
+    def __init__(self, handler):
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.port = self.server.server_address[1]
+        self.latency = 0.0
+        self.requests = 0
+        # OpenAI用
+        self.random = random.Random(0)
+        self.content = ''
+        self.token_interval = 0.0
+        self.names = set() # AIキャラの名前（判別・fusedではこの中から選ぶ。ユーザーを選ぶとAI同士の会話が止まるので）
+        # VOICEVOX用
+        self.speech_per_char = 0.0
+        self._lock = threading.Lock()
+        threading.Thread(target=self.server.serve_forever, name='stub-{}'.format(self.port), daemon=True).start()
+
+    def count(self):
+        with self._lock:
+            self.requests += 1
+
+    def reset(self):
+        with self._lock:
+            requests, self.requests = self.requests, 0
+        return requests
+
+    def close(self):
+        self.server.shutdown()
+
+class StubHandler(BaseHTTPRequestHandler):
+
+    def log_message(self, *args):
+        pass
+
+    @property
+    def stub(self):
+        return self.server.stub
+
+    def read_body(self) -> bytes:
+        return self.rfile.read(int(self.headers.get('Content-Length') or 0))
+
+    def send(self, code:int, body:bytes=b'', content_type:str='application/json'):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class OpenAIHandler(StubHandler):
+    """/v1/chat/completions。判別・fused・返答・要約をプロンプトから見分けて、それらしい形で返す。"""
+
+    def do_POST(self):
+        request = json.loads(self.read_body())
+        self.stub.count()
+        time.sleep(self.stub.latency)
+
+        content = self.reply(request["messages"])
+        prompt_tokens = sum(len(message["content"]) for message in request["messages"]) // 2
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(content), "total_tokens": prompt_tokens + len(content)}
+
+        if not request.get("stream"):
+            body = {"object": "chat.completion",
+                    "choices": [{"index": 0, "message": {"role": "assistant", "content": content}, "finish_reason": "stop"}],
+                    "usage": usage}
+            return self.send(200, json.dumps(body, ensure_ascii=False).encode('utf-8'))
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/event-stream')
+        self.end_headers()
+        for i in range(0, len(content), 4):
+            chunk = {"object": "chat.completion.chunk",
+                    "choices": [{"index": 0, "delta": {"content": content[i:i + 4]}, "finish_reason": None}]}
+            self.wfile.write('data: {}\n\n'.format(json.dumps(chunk, ensure_ascii=False)).encode('utf-8'))
+            self.wfile.flush()
+            time.sleep(self.stub.token_interval)
+        self.wfile.write(b'data: [DONE]\n\n')
+
+    def reply(self, messages:list) -> str:
+        system, user = messages[0]["content"], messages[-1]["content"]
+        rnd = self.stub.random
+
+        if user.startswith('Command(input='):
+            # 判別 : templateのキャラから1人
+            template = json.loads(system[system.index('template=') + len('template='):system.index('\n\ndef Command')])
+            names = [name for name in template if name in self.stub.names]
+            template[rnd.choice(names)] = 1.0
+            template["unknown"] = 0.0
+            return json.dumps(template, ensure_ascii=False)
+
+        if '"responder"' in user:
+            # fused : 候補のキャラから1人と返答
+            candidates = json.loads(user[user.index('from ') + len('from '):user.index('. If')])
+            names = [name for name in candidates if name in self.stub.names]
+            return json.dumps({"responder": rnd.choice(names), "content": self.stub.content}, ensure_ascii=False)
+
+        return self.stub.content
+
+class VoicevoxHandler(StubHandler):
+    """VOICEVOX ENGINEの/version、/initialize_speaker、/audio_query、/synthesis"""
+
+    def do_GET(self):
+        self.send(200, b'"stub"')
+
+    def do_POST(self):
+        body = self.read_body()
+        if self.path.startswith('/initialize_speaker'):
+            return self.send(204)
+        if self.path.startswith('/audio_query'):
+            text = parse_qs(urlparse(self.path).query)["text"][0]
+            return self.send(200, json.dumps({"chars": len(text)}).encode('utf-8'))
+        if self.path.startswith('/synthesis'):
+            self.stub.count()
+            time.sleep(self.stub.latency)
+            query = json.loads(body)
+            return self.send(200, self.wave(query), 'audio/wav')
+        self.send(404)
+
+    def wave(self, query:dict) -> bytes:
+        rate = query.get("outputSamplingRate", 24000)
+        channels = 2 if query.get("outputStereo") else 1
+        frames = int(rate * self.stub.speech_per_char * query["chars"])
+        data = io.BytesIO()
+        with wave.open(data, 'wb') as wf:
+            wf.setnchannels(channels)
+            wf.setsampwidth(2)
+            wf.setframerate(rate)
+            wf.writeframes(b'\0\0' * channels * frames)
+        return data.getvalue()
+
+# ---- ベンチマーク用の設定とキャラ ----
+
+def create_workdir(voicevox_port:int, cast:int) -> str:
+    """settings.jsonとcast人ぶんのキャラデータを置いた作業ディレクトリを作る。"""
+
+    workdir = tempfile.mkdtemp(prefix='bench_scaling_')
+
+    with open(os.path.join(ROOT, 'settings.json'), 'r', encoding='utf-8') as f:
+        settings_dict = json.load(f)
+    src_dir = os.path.join(ROOT, settings_dict["character_dir"])
+    settings_dict["log_dir"] = os.path.join(workdir, 'log')
+    settings_dict["character_dir"] = os.path.join(workdir, 'character_data')
+    settings_dict["audio"]["sink"] = 'null'
+    settings_dict["audio"]["archive"] = False
+    settings_dict["voicevox"]["engine_path"] = ''
+    settings_dict["voicevox"]["engine"]["host"] = '127.0.0.1'
+    settings_dict["voicevox"]["engine"]["ports"] = [voicevox_port]
+    settings_dict["voicevox"]["engine"]["restart"] = False
+    settings_dict["voicevox"]["pool"]["max_concurrency"] = 64 # スタブは何本でも受ける
+    settings_dict["governor"]["enabled"] = False # 上限まで回す
+    with open(os.path.join(workdir, 'settings.json'), 'w', encoding='utf-8') as f:
+        json.dump(settings_dict, f, ensure_ascii=False, indent=4)
+
+    # 既存のキャラをコピーして名前だけ変える
+    bases = sorted(os.listdir(src_dir))
+    for i in range(cast):
+        ch_dir = os.path.join(settings_dict["character_dir"], 'ch{:02d}'.format(i))
+        shutil.copytree(os.path.join(src_dir, bases[i % len(bases)]), ch_dir)
+        ch_settings_path = os.path.join(ch_dir, 'settings.json')
+        with open(ch_settings_path, 'r', encoding='utf-8') as f:
+            ch_settings = json.load(f)
+        ch_settings["profile"]["name"] = 'キャラ{:02d}'.format(i)
+        ch_settings["profile"]["aliases"] = []
+        with open(ch_settings_path, 'w', encoding='utf-8') as f:
+            json.dump(ch_settings, f, ensure_ascii=False, indent=4)
+
+    return workdir
+
+class UserFeeder(object):
+    """input()の代わり。interval秒ごとにキャラの誰かに話しかけ、start()からduration秒たったらexitを返す。"""
+
+    def __init__(self, names:list, duration:float, interval:float, exit_key:str, seed:int):
+        self.names = names
+        self.duration = duration
+        self.deadline = None
+        self.next_time = None
+        self.interval = interval
+        self.exit_key = exit_key
+        self.random = random.Random(seed)
+
+    def start(self):
+        self.next_time = time.monotonic() # 最初はすぐ話しかける
+        self.deadline = self.next_time + self.duration
+
+    def __call__(self) -> str:
+        wait = min(self.next_time, self.deadline) - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        if time.monotonic() >= self.deadline:
+            return self.exit_key
+        self.next_time += self.interval
+        return '{}、最近どう？'.format(self.random.choice(self.names))
+
+# ---- 計測 ----
+
+def rss_bytes():
+    """プロセスの常駐メモリ。取れなければNone。"""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, AttributeError):
+        pass
+    try:
+        import resource
+        # ru_maxrssはピーク値（Linux : KB、macOS : byte）
+        maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return maxrss if sys.platform == 'darwin' else maxrss * 1024
+    except ImportError:
+        return None
+
+class Sampler(object):
+    """interval秒ごとに、各セッションのキューの深さ・スレッド数・メモリを取る。"""
+
+    QUEUES = ('q_message', 'q_user_input', 'q_voice_play')
+
+    def __init__(self, apps:list, interval:float):
+        self.apps = apps
+        self.interval = interval
+        self.samples = {name: [] for name in self.QUEUES}
+        self.threads = []
+        self.rss = []
+        self._stop_event = threading.Event()
+        self._thread = threading.Thread(target=self.__run, name='bench-sampler', daemon=True)
+
+    def __run(self):
+        while not self._stop_event.wait(self.interval):
+            for name in self.QUEUES:
+                self.samples[name].append(sum(getattr(app, name).qsize() for app in self.apps))
+            self.threads.append(threading.active_count())
+            rss = rss_bytes()
+            if rss is not None:
+                self.rss.append(rss)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop_event.set()
+        self._thread.join()
+
+def mean(values:list) -> float:
+    return sum(values) / len(values) if values else 0.0
+
+def run_cell(run, cast:int, sessions:int, latency:float, tts_latency:float, opt, stubs:dict, cell_id:str) -> dict:
+    """1つの条件で、sessions個のセッションをduration秒動かした結果を返す。"""
+
+    openai_stub, voicevox_stub = stubs["openai"], stubs["voicevox"]
+    openai_stub.latency = latency
+    voicevox_stub.latency = tts_latency
+    openai_stub.reset()
+    voicevox_stub.reset()
+
+    ch_ids = ['ch{:02d}'.format(i) for i in range(cast)]
+    names = ['キャラ{:02d}'.format(i) for i in range(cast)]
+    rss_before = rss_bytes()
+    threads_before = threading.active_count()
+
+    # 起動（エンジンの確認、つなぎの合成など）
+    start = time.monotonic()
+    feeders = []
+    apps = []
+    for i in range(sessions):
+        feeders.append(UserFeeder(names, opt.duration, opt.user_interval, run.EXIT_KEY, seed=opt.seed + i))
+        apps.append(run.MultiCharacterTalking(ch_id_list=ch_ids,
+                                                session_id='{}_{}'.format(cell_id, i),
+                                                input_fn=feeders[-1],
+                                                start=False))
+    startup = time.monotonic() - start
+    openai_stub.reset()
+    voicevox_stub.reset()
+
+    sampler = Sampler(apps, opt.sample_interval)
+    sampler.start()
+    cpu_start = time.process_time()
+    start = time.monotonic()
+    for feeder in feeders:
+        feeder.start()
+    workers = [threading.Thread(target=app.main, name='bench-session-{}'.format(i)) for i, app in enumerate(apps)]
+    for worker in workers:
+        worker.start()
+
+    # スループットはexitを入れるまでの間で測る（終了処理の待ちは含めない）
+    time.sleep(opt.duration)
+    wall = time.monotonic() - start
+    cpu = time.process_time() - cpu_start
+    turns = sum(app._turn_count for app in apps)
+    completions = openai_stub.reset()
+    syntheses = voicevox_stub.reset()
+    sampler.stop()
+
+    for worker in workers:
+        worker.join()
+    drain = time.monotonic() - start - wall
+
+    rss_peak = max(sampler.rss) if sampler.rss else None
+    return {
+        "cast": cast,
+        "sessions": sessions,
+        "latency": latency,
+        "tts_latency": tts_latency,
+        "startup_s": startup,
+        "wall_s": wall,
+        "drain_s": drain,
+        "turns": turns,
+        "turns_per_min": turns * 60.0 / wall,
+        "turns_per_min_per_session": turns * 60.0 / wall / sessions,
+        "completions_per_s": completions / wall,
+        "syntheses_per_s": syntheses / wall,
+        "q_message_mean": mean(sampler.samples["q_message"]) / sessions,
+        "q_user_input_mean": mean(sampler.samples["q_user_input"]) / sessions,
+        "q_voice_play_mean": mean(sampler.samples["q_voice_play"]) / sessions,
+        "q_voice_play_max": max(sampler.samples["q_voice_play"], default=0),
+        "cpu_util": cpu / wall, # 平均して何コアぶん使ったか
+        "threads_peak": max(sampler.threads, default=threads_before) - threads_before,
+        "rss_mb_per_session": (rss_peak - rss_before) / sessions / 2**20 if rss_peak and rss_before else None,
+    }
+
+COLUMNS = [
+    ('cast', '{:>4}'), ('sessions', '{:>8}'), ('latency', '{:>7.2f}'), ('tts_latency', '{:>11.2f}'),
+    ('startup_s', '{:>9.2f}'), ('turns_per_min', '{:>13.1f}'), ('turns_per_min_per_session', '{:>9.1f}'), ('efficiency', '{:>10.0%}'),
+    ('completions_per_s', '{:>9.2f}'), ('syntheses_per_s', '{:>9.2f}'),
+    ('q_message_mean', '{:>9.2f}'), ('q_user_input_mean', '{:>9.2f}'), ('q_voice_play_mean', '{:>9.2f}'),
+    ('cpu_util', '{:>8.2f}'), ('threads_peak', '{:>7}'), ('rss_mb_per_session', '{:>9.1f}'),
+]
+HEADERS = {
+    'turns_per_min_per_session': '/session', 'completions_per_s': 'compl/s', 'syntheses_per_s': 'synth/s',
+    'q_message_mean': 'q_msg', 'q_user_input_mean': 'q_user', 'q_voice_play_mean': 'q_voice',
+    'threads_peak': 'threads', 'rss_mb_per_session': 'MB/sess',
+}
+
+def print_row(row:dict):
+    cells = []
+    for key, fmt in COLUMNS:
+        value = row.get(key)
+        width = int(''.join(c for c in fmt.split('.')[0] if c.isdigit()))
+        cells.append('-'.rjust(width) if value is None else fmt.format(value))
+    print(' | '.join(cells), flush=True)
+
+def add_efficiency(rows:list):
+    """同じ条件（キャラ数・レイテンシ）の最小セッション数に対する、セッションあたりスループットの比。
+
+    セッションを増やしてもこれが下がらなければ、まだホストに余裕がある。
+    """
+    for row in rows:
+        base = min((r for r in rows if (r["cast"], r["latency"], r["tts_latency"]) == (row["cast"], row["latency"], row["tts_latency"])),
+                    key=lambda r: r["sessions"])
+        row["efficiency"] = row["turns_per_min_per_session"] / base["turns_per_min_per_session"] if base["turns_per_min_per_session"] else None
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--cast", type=int, nargs='*', default=[2, 4, 8], help="セッションあたりのキャラ数")
+    parser.add_argument("--sessions", type=int, nargs='*', default=[1, 2, 4], help="同時に動かすセッション数")
+    parser.add_argument("--latency", type=float, nargs='*', default=[0.2, 0.8], help="OpenAIスタブの応答までの秒数")
+    parser.add_argument("--tts_latency", type=float, nargs='*', default=[0.1], help="VOICEVOXスタブの合成1回の秒数")
+    parser.add_argument("--duration", type=float, default=20.0, help="1条件あたりの計測秒数")
+    parser.add_argument("--user_interval", type=float, default=5.0, help="ユーザー入力の間隔（秒）")
+    parser.add_argument("--reply_chars", type=int, default=40, help="返答の文字数")
+    parser.add_argument("--speech_per_char", type=float, default=0.05, help="合成音声の1文字あたりの秒数（null出力でもこの時間だけ再生を待つ）")
+    parser.add_argument("--sample_interval", type=float, default=0.1, help="キュー・メモリを見る間隔（秒）")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", type=str, default='', help="結果をCSVで保存するパス")
+    opt = parser.parse_args()
+
+    random.seed(opt.seed)
+
+    openai_stub = StubServer(OpenAIHandler)
+    openai_stub.random = random.Random(opt.seed)
+    openai_stub.content = ('こんにちは、今日はいい天気ですね。' * opt.reply_chars)[:opt.reply_chars]
+    openai_stub.token_interval = 0.005
+    openai_stub.names = set('キャラ{:02d}'.format(i) for i in range(max(opt.cast)))
+    voicevox_stub = StubServer(VoicevoxHandler)
+    voicevox_stub.speech_per_char = opt.speech_per_char
+    stubs = {"openai": openai_stub, "voicevox": voicevox_stub}
+
+    # 各モジュールはimport時にカレントディレクトリのsettings.jsonを読むので、作業ディレクトリに移ってからimportする
+    workdir = create_workdir(voicevox_stub.port, max(opt.cast))
+    os.chdir(workdir)
+    sys.path.insert(0, ROOT)
+    os.environ["TEMP"] = os.path.join(workdir, 'wav')
+    import openai
+    openai.api_base = 'http://127.0.0.1:{}/v1'.format(openai_stub.port)
+    openai.api_key = 'bench'
+    run = importlib.import_module('run')
+    openai.api_key = 'bench' # ai_characterのimport時に環境変数で上書きされるので
+
+    print(' | '.join(HEADERS.get(key, key).rjust(int(''.join(c for c in fmt.split('.')[0] if c.isdigit()))) for key, fmt in COLUMNS))
+    rows = []
+    try:
+        for latency in opt.latency:
+            for tts_latency in opt.tts_latency:
+                for cast in opt.cast:
+                    for sessions in opt.sessions:
+                        cell_id = 'bench_c{}_s{}_l{}_t{}'.format(cast, sessions, latency, tts_latency).replace('.', '')
+                        # セッションのコンソール出力は捨てる
+                        with open(os.devnull, 'w', encoding='utf-8') as devnull, contextlib.redirect_stdout(devnull):
+                            row = run_cell(run, cast, sessions, latency, tts_latency, opt, stubs, cell_id)
+                        rows.append(row)
+                        add_efficiency(rows)
+                        print_row(row)
+    finally:
+        os.chdir(ROOT)
+        openai_stub.close()
+        voicevox_stub.close()
+
+    if opt.output and rows:
+        with open(opt.output, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=list(rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(rows)
+        print('Saved : {}'.format(opt.output))
+
+    shutil.rmtree(workdir, ignore_errors=True)
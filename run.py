@@ -1,15 +1,16 @@
 import os
 import argparse
 import json
-import random
 import time
 from datetime import datetime
 import queue
+import tempfile
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 
 from ai_character import *
 
-WAV_PATH = os.getenv('TEMP')
+WAV_PATH = os.getenv('TEMP') or tempfile.gettempdir() # Windows以外ではTEMPが無いことがある
 
 with open('settings.json', mode="r", encoding="utf-8") as f:
     settings_dict = json.load(f)
@@ -21,12 +22,49 @@ LOG_PATH = os.path.abspath(settings_dict["log_dir"])
 
 EXIT_KEY = settings_dict["exit_key"]
 
+LOG_LEVEL = settings_dict["log"]["level"]
+LOG_MAX_BYTES = settings_dict["log"]["max_bytes"] # これを超えたらローテーション（0で無効）
+LOG_BACKUP_COUNT = settings_dict["log"]["backup_count"]
+
 CONV_MAX = settings_dict["conversation"]["max"]
 CONV_SUMMARIZE = settings_dict["conversation"]["summarize"]
 
 V_VOL = settings_dict["voicevox"]["volume"]
 V_POST = settings_dict["voicevox"]["post"]
 
+AUDIO_ARCHIVE = settings_dict["audio"]["archive"] # 合成音声をセッションのアーカイブに残すかどうか
+
+TALK_MODE = settings_dict["talk"]["mode"] # two_call : 判別と返答で2回APIコール / fused : 1回で両方
+
+PROFILE_INTERVAL = settings_dict["profile"]["interval"] # samplingモードのサンプリング間隔
+PROFILE_MAX_DEPTH = settings_dict["profile"]["max_depth"]
+
+ROUTING_MAX_CANDIDATES = settings_dict["routing"]["max_candidates"] # 応答者の判別に送るキャラの上限
+ROUTING_RECENT_TURNS = settings_dict["routing"]["recent_turns"]
+ROUTING_COOLDOWN_TURNS = settings_dict["routing"]["cooldown_turns"]
+ROUTING_MENTION_WEIGHT = settings_dict["routing"]["mention_weight"]
+ROUTING_RECENT_WEIGHT = settings_dict["routing"]["recent_weight"]
+ROUTING_COOLDOWN_WEIGHT = settings_dict["routing"]["cooldown_weight"]
+ROUTING_FAIRNESS_WEIGHT = settings_dict["routing"]["fairness_weight"]
+
+GOVERNOR_ENABLED = settings_dict["governor"]["enabled"] # AI同士の会話のペース制御
+GOVERNOR_MAX_TOKENS = settings_dict["governor"]["max_tokens_per_minute"] # 0で無制限
+GOVERNOR_MAX_TURNS = settings_dict["governor"]["max_turns_per_minute"] # 0で無制限
+GOVERNOR_IDLE_AFTER = settings_dict["governor"]["idle_after_seconds"] # ユーザーがこの秒数話さなければAI同士の間隔をあける
+GOVERNOR_IDLE_INTERVAL = settings_dict["governor"]["idle_turn_interval"]
+GOVERNOR_PAUSE_AFTER = settings_dict["governor"]["pause_after_seconds"] # ユーザーがこの秒数話さなければAI同士の会話を止める
+
+FILLER_ENABLED = settings_dict["filler"]["enabled"] # 返答の音声が間に合わない時につなぎの音声を流す
+FILLER_THRESHOLD = settings_dict["filler"]["threshold_seconds"] # ターン開始からこの秒数たっても何も再生していなければ流す
+
+FANOUT_ENABLED = settings_dict["fanout"]["enabled"] # 複数キャラの同時返答（two_callモードのみ）
+FANOUT_TOP_K = settings_dict["fanout"]["top_k"]
+FANOUT_MARGIN = settings_dict["fanout"]["margin"] # 最大確率からこの差以内のキャラが返答する
+FANOUT_MIN_PROBABILITY = settings_dict["fanout"]["min_probability"]
+
+PLAY_MAX_BUFFER_SECONDS = settings_dict["playback"]["max_buffer_seconds"] # 再生待ち音声の上限秒数
+PLAY_MAX_PENDING_COMPLETIONS = settings_dict["playback"]["max_pending_completions"] # 同時に走るCompletion数の上限
+
 
 
 class CharacterData(object):
@@ -71,23 +109,68 @@ class Message(object):
 
 class MultiCharacterTalking(object):
 
-    def __init__(self, ch_id_list:list, verbose:bool=False):
+    def __init__(self, ch_id_list:list, verbose:bool=False, resume:str='', profile:str='', 
+                    record:bool=False, replay:str='', replay_latency:str='original', 
+                    session_id:str='', input_fn=input, start:bool=True):
+        """
+        Args:
+            session_id (str): 新しいセッションのID。省略時は日時から作る（同じプロセスで複数動かす時に指定する）
+            input_fn (callable): ユーザー入力を1行返す関数
+            start (bool): Falseならmain()は呼び出し側で呼ぶ
+        """
         
+        # console
+        self.verbose = verbose
+        self.console = Console()
+        self.console.set_default_color("yellow")
+
+        # セッションの再開。-cが無ければスナップショットのキャラで再開する
+        self.session_store = SessionStore(LOG_PATH)
+        snapshot = None
+        if resume:
+            snapshot = self.session_store.load(resume)
+            if snapshot is None:
+                self.console('セッション {} のスナップショットがありません'.format(resume), col="red")
+                return
+            if not ch_id_list:
+                ch_id_list = list(snapshot["characters"].keys())
+
         if not ch_id_list:
             return
         
         # global settings
         self.username = USERNAME
-        self.session_id = datetime.now().strftime('s_%y%m%d_%H%M%S')
+        self.session_id = resume if snapshot else (session_id or datetime.now().strftime('s_%y%m%d_%H%M%S'))
+        self.input_fn = input_fn
+        # 合成したwavの置き場所。セッションごとに分ける（同時に動くセッションとファイル名がぶつからないように）
+        self.wav_path = os.path.join(WAV_PATH, self.session_id)
         self._exit_flag = False
-
-        # console
-        self.verbose = verbose
-        self.console = Console()
-        self.console.set_default_color("yellow")
+        self._turn_count = 0 # talk_threadが処理した発言の数（カセットのユーザー入力のタイミング合わせに使う）
 
         # logger
-        self.logger = Logger(logdir=os.path.join(LOG_PATH, self.session_id), filename=self.session_id+'.log')
+        self.logger = Logger(logdir=os.path.join(LOG_PATH, self.session_id), 
+                            filename=self.session_id+'.log', 
+                            lv=LOG_LEVEL, 
+                            max_bytes=LOG_MAX_BYTES, 
+                            backup_count=LOG_BACKUP_COUNT)
+        self.session_store.logger = self.logger
+
+        # OpenAI・VOICEVOXの録音/再生。乱数のシードもここで決まるので、キャラ等より先に作る
+        self.cassette = None
+        if replay:
+            replay_path = replay if os.path.isdir(replay) else os.path.join(LOG_PATH, replay, 'cassette')
+            self.cassette = Cassette(replay_path, mode='replay', latency=replay_latency, logger=self.logger)
+        elif record:
+            self.cassette = Cassette(os.path.join(LOG_PATH, self.session_id, 'cassette'), mode='record', logger=self.logger)
+        use_cassette(self.cassette)
+
+        # profiler
+        self.profiler = None
+        if profile:
+            self.profiler = ThreadProfiler(mode=profile, 
+                                            interval=PROFILE_INTERVAL, 
+                                            max_depth=PROFILE_MAX_DEPTH, 
+                                            logger=self.logger)
 
         # init characters
         self.ch_dict = {}
@@ -107,52 +190,146 @@ class MultiCharacterTalking(object):
                             verbose=verbose, 
                             logger=self.logger)
         
-        self.interlocutor_template = {}
-        self.interlocutor_template[self.username] = 0.0
-        for ch_name in self.ch_dict.keys():
-            self.interlocutor_template[ch_name] = 0.0
-        self.interlocutor_template["unknown"] = 1.0
+        # 応答者の判別には、絞り込んだ候補だけを送る（キャラが増えてもプロンプトの長さが変わらないように）
+        self.router = CandidateRouter(max_candidates=ROUTING_MAX_CANDIDATES, 
+                                        recent_turns=ROUTING_RECENT_TURNS, 
+                                        cooldown_turns=ROUTING_COOLDOWN_TURNS, 
+                                        mention_weight=ROUTING_MENTION_WEIGHT, 
+                                        recent_weight=ROUTING_RECENT_WEIGHT, 
+                                        cooldown_weight=ROUTING_COOLDOWN_WEIGHT, 
+                                        fairness_weight=ROUTING_FAIRNESS_WEIGHT, 
+                                        logger=self.logger)
+        for ch_name, ch_data in self.ch_dict.items():
+            self.router.add_character(ch_name, ch_data.character.aliases)
 
         self.interlocutor = Interlocutor(logger=self.logger)
+
+        # ユーザーがいない間にAI同士の会話がトークン・TTSを使い続けないようにする
+        self.governor = None
+        if GOVERNOR_ENABLED:
+            self.governor = ThroughputGovernor(max_tokens_per_minute=GOVERNOR_MAX_TOKENS, 
+                                                max_turns_per_minute=GOVERNOR_MAX_TURNS, 
+                                                idle_after=GOVERNOR_IDLE_AFTER, 
+                                                idle_interval=GOVERNOR_IDLE_INTERVAL, 
+                                                pause_after=GOVERNOR_PAUSE_AFTER, 
+                                                logger=self.logger)
+        self.fanout_executor = ThreadPoolExecutor(max_workers=max(1, FANOUT_TOP_K), thread_name_prefix='fanout')
+
+        if snapshot:
+            self.__restore_snapshot(snapshot)
         
         # init voice
-        self.voice_generator = VoiceGenerator(logger=self.logger)
-        self.q_voice_play = queue.Queue(1) #これ増やすとcompletionがどんどん先行するので注意
+        self.voice_generator = VoiceGenerator(speaker_ids=[ch_data.character.voice_speaker_id for ch_data in self.ch_dict.values()], 
+                                            logger=self.logger)
+        if AUDIO_ARCHIVE:
+            self.audio_archive = AudioArchive(os.path.join(LOG_PATH, self.session_id, 'audio'), logger=self.logger)
+        else:
+            self.audio_archive = None
+        # つなぎの音声（起動時に合成しておく）
+        self.filler_bank = None
+        if FILLER_ENABLED:
+            self.filler_bank = FillerBank(self.voice_generator, 
+                                        threshold=FILLER_THRESHOLD, 
+                                        path=self.wav_path, 
+                                        volume=V_VOL, 
+                                        logger=self.logger)
+            self.filler_bank.render(list(self.__characters_by_id().values()), 
+                                    {ch_id: ch.voice_fillers for ch_id, ch in self.__characters_by_id().items()})
+        # 再生待ちの合計秒数で先読みを制限する（件数ではなく秒数。増やすとcompletionが先行するので注意）
+        self.q_voice_play = PlaybackScheduler(max_seconds=PLAY_MAX_BUFFER_SECONDS, 
+                                            max_pending_completions=PLAY_MAX_PENDING_COMPLETIONS)
         
-        self.main()
+        if start:
+            self.main()
+
+    def __characters_by_id(self) -> dict:
+        return {ch_data.id: ch_data.character for ch_data in self.ch_dict.values()}
+
+    def __restore_snapshot(self, snapshot:dict):
+        """スナップショットから会話と各キャラの状態を戻す。"""
+        self.logger('Resume session : {}', self.session_id, cls=self, fn=self.__restore_snapshot)
+        self.conv.set_state(snapshot["conversations"])
+        for line in self.conv.session_data.resident:
+            self.router.observe(line.name)
+        for ch_id, ch in self.__characters_by_id().items():
+            if ch_id in snapshot["characters"]:
+                ch.set_state(snapshot["characters"][ch_id])
+
+    def __save_snapshot(self):
+        self.session_store.save(self.session_id, self.conv, self.__characters_by_id())
 
     def main(self):
 
         executor = ThreadPoolExecutor()
         future_list = []
 
+        if self.profiler:
+            self.profiler.start()
+
         self.logger('Submit talk_thread.', cls=self, fn=self.main)
-        future_list.append(executor.submit(self.talk_thread, 
+        future_list.append(executor.submit(self.__worker(self.talk_thread), 
                                                 self.conv))
         
         self.logger('Submit manage_conv_thread.', cls=self, fn=self.main)
-        future_list.append(executor.submit(self.manage_conv_thread, 
+        future_list.append(executor.submit(self.__worker(self.manage_conv_thread), 
                                             self.conv))
 
         self.logger('Submit voice_play_thread.', cls=self, fn=self.main)
-        future_list.append(executor.submit(self.voice_play_thread, 
+        future_list.append(executor.submit(self.__worker(self.voice_play_thread), 
                                             self.voice_generator))
 
         self.logger('Submit user_input_thread.', cls=self, fn=self.main)
-        future_list.append(executor.submit(self.user_input_thread))
+        future_list.append(executor.submit(self.__worker(self.user_input_thread)))
 
-        self.logger('Thread Count : {}'.format(len(future_list)), cls=self, fn=self.main)
+        self.logger('Thread Count : {}', len(future_list), cls=self, fn=self.main)
         
         executor.shutdown(wait=True)
+        self.fanout_executor.shutdown(wait=True)
+
+        if self.profiler:
+            self.profiler.dump(os.path.join(LOG_PATH, self.session_id, 'profile'))
+
+        self.__save_snapshot()
+        if self.cassette:
+            self.cassette.close()
+        self.logger('Voicevox metrics : {}', self.voice_generator.metrics(), cls=self, fn=self.main)
+        self.voice_generator.close()
+        if self.audio_archive:
+            self.audio_archive.close()
+        try:
+            os.rmdir(self.wav_path) # 空なら消す
+        except OSError:
+            pass
+
+        self.logger('Retry metrics : {}', retry_metrics(), cls=self, fn=self.main)
+        self.logger('Hedge metrics : {}', hedge_metrics(), cls=self, fn=self.main)
+        self.logger('Playback metrics : {}', self.q_voice_play.metrics(), cls=self, fn=self.main)
+        if self.filler_bank:
+            self.logger('Fillers played : {}', self.filler_bank.played, cls=self, fn=self.main)
+        if self.governor:
+            self.logger('Governor metrics : {}', self.governor.metrics(), cls=self, fn=self.main)
         
         self.logger('Exit', cls=self, fn=self.main)
+        self.logger.close()
+        self.console.flush()
+
+    def __worker(self, fn):
+        """--profileの時はプロファイラで包んだ関数を返す。"""
+        if not self.profiler:
+            return fn
+        return self.profiler.wrap(fn, fn.__name__)
 
     def user_input_thread(self):
         """ユーザー入力を受け取り、キューにアイテムを追加する。"""
         
         while True:
-            self.logger('Waiting for user input...', cls=self, fn=self.user_input_thread)
-            user_input = input()
+            if self.cassette and self.cassette.replaying:
+                user_input = self.__replay_user_input()
+            else:
+                self.logger('Waiting for user input...', cls=self, fn=self.user_input_thread)
+                user_input = self.input_fn()
+                if self.cassette:
+                    self.cassette.record_user_input(user_input, self._turn_count)
 
             if not user_input:
                 continue
@@ -160,13 +337,32 @@ class MultiCharacterTalking(object):
             if user_input == EXIT_KEY:
                 self.logger('==== Command exit ====', cls=self, fn=self.user_input_thread)
                 self._exit_flag = True
+                if self.governor:
+                    self.governor.wake()
                 break
             
-            self.logger('Put item to user message queue {}:{}'.format(self.username, user_input), cls=self, fn=self.user_input_thread)
+            self.logger('Put item to user message queue {}:{}', self.username, user_input, cls=self, fn=self.user_input_thread)
             self.q_user_input.put(Message(name=self.username, content=user_input))
-            self.logger('user message queue size: {}'.format(self.q_user_input.qsize()), cls=self, fn=self.user_input_thread)
+            if self.governor:
+                # 待たされているAI同士のターンより先にユーザーの発言を処理させる
+                self.governor.user_active()
+            self.logger('user message queue size: {}', self.q_user_input.qsize(), cls=self, fn=self.user_input_thread)
         
         self.logger('Exit', cls=self, fn=self.user_input_thread)
+
+    def __replay_user_input(self) -> str:
+        """録音したユーザー入力を、録音時と同じターンまで進んでから返す。無くなったらexit。"""
+
+        result = self.cassette.next_user_input()
+        if result is None:
+            return EXIT_KEY
+        user_input, turn = result
+
+        while self._turn_count < turn and not self._exit_flag:
+            time.sleep(0.1)
+
+        self.console('{} : {}'.format(self.username, user_input))
+        return user_input
     
     def talk_thread(self, conv:Conversations):
         """
@@ -196,47 +392,60 @@ class MultiCharacterTalking(object):
             except queue.Empty:
                 user_msg = False
 
+            # AIの発言だけのときは、ペース制御で待つ。待っている間にユーザーが話したら一緒に処理する
+            if ai_msg and not user_msg and self.governor:
+                self.governor.wait_ai_turn(interrupted=lambda: self._exit_flag or not self.q_user_input.empty())
+                try:
+                    user_msg = self.q_user_input.get_nowait()
+                    current_queue_list.append(self.q_user_input)
+                except queue.Empty:
+                    user_msg = False
+
             # ユーザー発言もAI発言もどちらもなければcontinue
             if not (ai_msg or user_msg):
                 continue
+            self._turn_count += 1
+            if self.governor:
+                self.governor.record_turn(user=bool(user_msg))
             
             # log
-            self.logger('Get item count : {}'.format(len([x for x in [ai_msg, user_msg] if x])), cls=self, fn=self.talk_thread)
+            self.logger('Get item count : {}', len([x for x in [ai_msg, user_msg] if x]), cls=self, fn=self.talk_thread)
             
             # AIの発言を会話データに追加
             if ai_msg:
-                self.logger('Get item : {}:{}'.format(ai_msg.name, ai_msg.content), cls=self, fn=self.talk_thread)
+                self.logger('Get item : {}:{}', ai_msg.name, ai_msg.content, cls=self, fn=self.talk_thread)
                 conv.add_content(name=ai_msg.name, content=ai_msg.content)
+                self.router.observe(ai_msg.name)
             
             # ユーザーの発言を会話データに記録　※キューに足されたタイミングがどうであれ、ユーザーの発言を後ろにする。
             if user_msg:
-                self.logger('Get item : {}:{}'.format(user_msg.name, user_msg.content), cls=self, fn=self.talk_thread)
+                self.logger('Get item : {}:{}', user_msg.name, user_msg.content, cls=self, fn=self.talk_thread)
                 conv.add_content(name=user_msg.name, content=user_msg.content)
+                self.router.observe(user_msg.name)
                 
             # ユーザーとAI発言両方来た場合、ユーザーの発言を最新としてCompletionする。
             msg = user_msg if user_msg else ai_msg
 
-            # 誰が応答すべきか、発言者以外の中から判別する
-            new_template = dict(self.interlocutor_template)
-            del new_template[msg.name]
-
-            interlocutor_dict, usage = self.interlocutor.guess(new_template, msg.content)
+            # 発言者以外のAIキャラから、判別に送る候補を絞る（スコアの高い順）
+            candidates = self.router.shortlist(msg.name, msg.content)
 
-            if interlocutor_dict:
-                interlocutor_key = max(interlocutor_dict, key=interlocutor_dict.get)
+            fused_content = None
+            interlocutor_dict = None
+            if TALK_MODE == 'fused':
+                # 誰が応答すべきかの判別と返答の作成を、1回のAPIコールで行う
+                interlocutor_key, fused_content = self.__guess_and_talk(msg, conv, candidates)
             else:
-                interlocutor_key = "unknown"
+                # 誰が応答すべきか、候補の中から判別する
+                interlocutor_key, interlocutor_dict = self.__guess(msg, candidates)
 
-            # 判別不能（unknown）だった場合、発言者以外のAIキャラからランダム抽選する
-            if interlocutor_key == "unknown":
-                self.logger('Next is unknown. Random choice...', cls=self, fn=self.talk_thread)
-                ch_name_list = list(self.ch_dict.keys())
-                if msg.name in ch_name_list:
-                    ch_name_list.remove(msg.name)
-                interlocutor_key = random.choice(ch_name_list)
+            # 判別不能（unknown）だった場合、候補のうちスコアがいちばん高いキャラにする
+            if interlocutor_key == "unknown" and candidates:
+                self.logger('Next is unknown. Choose top candidate...', cls=self, fn=self.talk_thread)
+                interlocutor_key = candidates[0]
+                interlocutor_dict = None
 
             # 次に誰が話すか決定
-            self.logger('Next : {}'.format(interlocutor_key), cls=self, fn=self.talk_thread)
+            self.logger('Next : {}', interlocutor_key, cls=self, fn=self.talk_thread)
             if self.verbose:
                 self.console(" -> {}".format(interlocutor_key))
             if not interlocutor_key in self.ch_dict.keys():
@@ -245,40 +454,216 @@ class MultiCharacterTalking(object):
                     current_queue.task_done()
                 continue
 
-            ch = self.ch_dict[interlocutor_key].character
-            
-            # messages作成（内部でsystemプロンプトとuserプロンプトを生成）
-            messages = ch.create_messages(
-                        user_input=msg.content, 
-                        user_name=msg.name, 
-                        talk_summary=conv.prev_summary, 
-                        lines_of_conversations=conv.lines_of_conversations)
-            
-            # completion
-            result = ch.talk(messages)
-            if result:
-                ai_content, token_usage = result
-            else:
-                # リトライしても応答がなかった場合、発言無しとして""を入れる。
-                ai_content = ""
+            # 同じくらいの確率で複数のAIキャラが話しかけられていたら、上位のキャラが同時に返答する
+            responders = [interlocutor_key]
+            if FANOUT_ENABLED and interlocutor_dict:
+                responders = self.__fanout_responders(interlocutor_dict, interlocutor_key)
 
-            # AIの発言をキューに追加（音声合成用）
-            # __voice_synthesis内、再生キューにputするところでCompletionだけが進みすぎないようにブロックしてる。
-            # 再生キューのサイズを無限にしちゃうとCompletionだけどんどん先に進むので注意。
-            self.__voice_synthesis(ch, ai_content)
+            # 返答の音声が間に合わなければ、最初に答えるキャラのつなぎを流す
+            filler_timer = None
+            if self.filler_bank:
+                filler_timer = self.filler_bank.start(self.ch_dict[responders[0]].character, self.__put_filler)
+
+            try:
+                if len(responders) > 1:
+                    ch, ai_content = self.__fanout_talk(responders, msg, conv)
+                else:
+                    ch, ai_content = self.__talk(interlocutor_key, msg, conv, fused_content)
+            finally:
+                if filler_timer:
+                    filler_timer.cancel()
             
             # AIの発言をAIメッセージキューに追加（次の人に渡すため）
             # ※exitになったときはキューに入れず（他者に渡さず）終える。キューを空にしないとループ抜けられないので。。。
             if not self._exit_flag:
-                self.logger('[{}] Put item to message queue: {}'.format(ch.id, ai_content), cls=self, fn=self.talk_thread)
+                self.logger('[{}] Put item to message queue: {}', ch.id, ai_content, cls=self, fn=self.talk_thread)
                 self.q_message.put(Message(name=ch.name, content=ai_content))
-                self.logger('message queue size: {}'.format(self.q_message.qsize()), cls=self, fn=self.talk_thread)
+                self.logger('message queue size: {}', self.q_message.qsize(), cls=self, fn=self.talk_thread)
+
+            self.__save_snapshot()
 
             for current_queue in current_queue_list:
                 current_queue.task_done()
         
         self.logger('Exit', cls=self, fn=self.talk_thread)
 
+    def __talk(self, interlocutor_key:str, msg:Message, conv:Conversations, fused_content:str=None):
+        """1人のキャラが返答し、音声合成して再生キューに入れる。(Character, 返答) を返す。"""
+
+        ch = self.ch_dict[interlocutor_key].character
+            
+        # Completion〜音声合成〜再生キューへのputまでを1スロットとして、同時実行数を制限する
+        with self.q_voice_play.completion_slot():
+
+            stream = None
+            if fused_content is not None:
+                # fusedモードでは返答も得られている
+                ai_content = fused_content
+            else:
+                # 何も再生していなければ、生成されたそばからコンソールに出す。
+                # 再生中・再生待ちがあるときは、文字が音声より先に進まないよう再生直前に出す。
+                if self.q_voice_play.idle():
+                    stream = ch.console.stream('{} : '.format(ch.name))
+                ai_content = self.__create_reply(ch, msg, conv, stream=stream)
+
+            # AIの発言をキューに追加（音声合成用）
+            # __voice_synthesis内、再生キューにputするところで、再生待ちの秒数が上限を超えないようにブロックしてる。
+            # 上限秒数を大きくしすぎるとCompletionだけどんどん先に進むので注意。
+            self.__voice_synthesis(ch, ai_content, printed=bool(stream and stream.text))
+
+        return ch, ai_content
+
+    def __create_reply(self, ch:Character, msg:Message, conv:Conversations, stream=None) -> str:
+
+        # 応答のワード数。max_tokensもここから決める
+        words = draw_response_words()
+
+        # messages作成（内部でsystemプロンプトとuserプロンプトを生成）
+        messages = ch.create_messages(
+                    user_input=msg.content, 
+                    user_name=msg.name, 
+                    talk_summary=conv.prev_summary, 
+                    lines_of_conversations=conv.lines_of_conversations, 
+                    words=words)
+        
+        # completion
+        result = ch.talk(messages, max_tokens=response_max_tokens(words), stream=stream)
+        if result:
+            ai_content, token_usage = result
+            if self.governor:
+                self.governor.record_tokens(token_usage)
+        else:
+            # リトライしても応答がなかった場合、発言無しとして""を入れる。
+            ai_content = ""
+
+        return ai_content
+
+    def __fanout_responders(self, interlocutor_dict:dict, interlocutor_key:str) -> list:
+        """最大確率からmargin以内かつmin_probability以上のAIキャラを、確率の高い順（同率は名前順）に最大top_k人返す。"""
+
+        if not interlocutor_key in self.ch_dict.keys():
+            return [interlocutor_key]
+
+        probabilities = self.__probabilities(interlocutor_dict)
+        if not interlocutor_key in probabilities:
+            return [interlocutor_key]
+
+        top = probabilities[interlocutor_key]
+        names = [name for name, p in probabilities.items() 
+                    if name in self.ch_dict.keys() and p >= FANOUT_MIN_PROBABILITY and p >= top - FANOUT_MARGIN]
+        names.sort(key=lambda name: (-probabilities[name], name))
+
+        return names[:FANOUT_TOP_K] or [interlocutor_key]
+
+    def __probabilities(self, interlocutor_dict:dict) -> dict:
+        """判別結果の値をfloatにする。モデルの出力なので"0.4"のような文字列も来る。floatにできないものは除く。"""
+        probabilities = {}
+        for name, p in interlocutor_dict.items():
+            try:
+                probabilities[name] = float(p)
+            except (TypeError, ValueError):
+                self.logger('Invalid probability {} : {}', name, p, cls=self, fn=self.__probabilities, lv='warning')
+        return probabilities
+
+    def __fanout_talk(self, responders:list, msg:Message, conv:Conversations):
+        """複数のキャラが同時に返答・音声合成し、responders順に再生キューに入れる。
+
+        最後のキャラ以外の返答はここで会話データに追加し、最後のキャラの (Character, 返答) を返す。
+        1人の返答・音声合成が失敗しても、他のキャラの返答は使う（音声合成だけ失敗したら、返答は声無しで出す）。
+        """
+
+        self.logger('Fan-out : {}', responders, cls=self, fn=self.__fanout_talk)
+        ch_list = [self.ch_dict[name].character for name in responders]
+
+        def reply_and_synthesize(ch:Character):
+            ai_content = self.__create_reply(ch, msg, conv)
+            try:
+                wav_path = self.__synthesize(ch, ai_content)
+            except Exception as e:
+                self.logger('[{}] Fan-out synthesis failure : {}', ch.id, e, cls=self, fn=self.__fanout_talk, lv='error')
+                wav_path = None
+            return ai_content, wav_path
+
+        # 1ターンとして1スロットを使う
+        with self.q_voice_play.completion_slot():
+            futures = [self.fanout_executor.submit(reply_and_synthesize, ch) for ch in ch_list]
+
+            # 終わった順ではなく、決まった順に再生キューへ
+            results = []
+            for ch, future in zip(ch_list, futures):
+                try:
+                    ai_content, wav_path = future.result()
+                except Exception as e:
+                    self.logger('[{}] Fan-out reply failure : {}', ch.id, e, cls=self, fn=self.__fanout_talk, lv='error')
+                    continue
+                if wav_path:
+                    self.__put_voice(ch, ai_content, wav_path)
+                else:
+                    ch.console('{} : {}'.format(ch.name, ai_content))
+                results.append((ch, ai_content))
+
+        if not results:
+            # 全員失敗した場合は、発言無しとして""を入れる
+            return ch_list[-1], ""
+
+        for ch, ai_content in results[:-1]:
+            conv.add_content(name=ch.name, content=ai_content)
+            self.router.observe(ch.name)
+
+        return results[-1]
+
+    def __guess(self, msg:Message, candidates:list):
+        """誰が応答すべきか、ユーザーと候補のAIキャラの中から判別する。(名前かunknown, 判別結果のdictかNone) を返す。"""
+
+        # 並びはキャラの指定順のまま（候補を絞らないときは今までと同じプロンプトになる）
+        names = [self.username] + [name for name in self.ch_dict.keys() if name in candidates]
+        new_template = {name: 0.0 for name in names if name != msg.name}
+        new_template["unknown"] = 1.0
+
+        result = self.interlocutor.guess(new_template, msg.content)
+
+        if result and result[0]:
+            interlocutor_dict, usage = result
+            if self.governor:
+                self.governor.record_tokens(usage)
+            interlocutor_dict = self.__probabilities(interlocutor_dict)
+            if interlocutor_dict:
+                return max(interlocutor_dict, key=interlocutor_dict.get), interlocutor_dict
+        return "unknown", None
+
+    def __guess_and_talk(self, msg:Message, conv:Conversations, candidates:list):
+        """ユーザーと候補のAIキャラの中から応答者を決め、その返答も作る。(応答者の名前かunknown, 返答かNone) を返す。
+
+        two_callモードと同じく、発言者がAIならユーザーも候補に入れる（ユーザーが選ばれたらAIは返答しない）。
+        """
+
+        candidates = [ch_data.character for name, ch_data in self.ch_dict.items() if name in candidates]
+        if not candidates:
+            return "unknown", None
+
+        result = self.interlocutor.guess_and_talk(candidates, 
+                                                msg.content, 
+                                                user_name=msg.name, 
+                                                talk_summary=conv.prev_summary, 
+                                                lines_of_conversations=conv.lines_of_conversations, 
+                                                username=self.username if msg.name != self.username else '')
+        if not result:
+            return "unknown", None
+
+        responder, content, messages, usage = result
+        if self.governor:
+            self.governor.record_tokens(usage)
+        if responder == self.username and msg.name != self.username:
+            # ユーザーに話を返す（AIは返答しない）
+            return responder, None
+        if not responder in [ch.name for ch in candidates]:
+            self.logger('Responder is not a candidate : {}', responder, cls=self, fn=self.__guess_and_talk)
+            return "unknown", None
+
+        self.ch_dict[responder].character.record_completion(messages, content, usage)
+
+        return responder, content
+
     def manage_conv_thread(self, conv:Conversations):
 
         while not self._exit_flag:
@@ -290,78 +675,217 @@ class MultiCharacterTalking(object):
                 continue
 
             conv.shrink_messages(CONV_SUMMARIZE)
+            self.__save_snapshot()
             
         #conv.shrink_messages(-1) # 残りすべて要約して終了
         
         self.logger('Exit', cls=self, fn=self.manage_conv_thread)
 
     def voice_play_thread(self, v:VoiceGenerator):
+        """
+            合成されたwavを再生キューから取り出し、出力エンジンに入れる。
+            再生中の発話が終わる前に次の発話を1つ入れておくので、発話の間に隙間ができない。
+            再生が終わったものから task_done し、wavを消す。
+            _exit_flagがTrueかつ、キューが空で再生中のものも無くなると抜ける
+        """
+
+        playing = deque() # 出力エンジンに入れた発話 [handle, wav_path, text, ch, printed]（つなぎはwav_pathがNone）
+
+        while not (self._exit_flag and self.q_voice_play.empty() and not playing):
+
+            # 再生の終わった発話を片付ける。次の発話が始まったらコンソールに出す
+            while playing and playing[0][0].done():
+                handle, wav_path, text, ch, printed = playing.popleft()
+                self.__finish_voice(wav_path)
+                if playing:
+                    self.__print_voice(playing[0])
+
+            # 再生中のほかに1つ入れてあれば、どちらかが終わるまで待つ
+            if len(playing) >= 2:
+                playing[0][0].wait(0.1)
+                continue
 
-        while not (self._exit_flag and self.q_voice_play.empty()):
-            """
-            合成されたwavパスをキューから取り出す
-            アイテムが取り出せるまで、1秒おきにチェック。
-            _exit_flagがTrueかつ、キューが空になると抜ける
-            """
             try:
-                data = self.q_voice_play.get(timeout=1)
+                data = self.q_voice_play.get(timeout=0.1)
             except queue.Empty:
+                if playing:
+                    playing[0][0].wait(0.1)
                 continue
 
             wav_path = data[0]
             text = data[1]
             ch= data[2]
+            printed = data[3] # ストリーミングで表示済みかどうか
+            clip = data[4] # 合成済みのPCM（つなぎ）なら (pcm, fmt)
 
-            self.logger('Get item : {}'.format(wav_path), cls=self, fn=self.voice_play_thread)
+            self.logger('Get item : {}', wav_path or text, cls=self, fn=self.voice_play_thread)
 
-            # ボイス再生の直前にコンソール出力
-            ch.console('{} : {}'.format(ch.name, text))
+            if clip:
+                pcm, fmt = clip
+            elif os.path.isfile(wav_path):
+                pcm, fmt = read_wave(wav_path)
+            else:
+                self.q_voice_play.task_done()
+                continue
+
+            entry = [v.play_pcm(pcm, fmt, wait=False), wav_path, text, ch, printed]
+            playing.append(entry)
 
-            # 再生
-            v.play_wave(wav=wav_path, delete=True)
+            # 何も再生していなければすぐ始まるので、ここでコンソール出力
+            if len(playing) == 1:
+                self.__print_voice(entry)
         
         self.logger('Exit', cls=self, fn=self.voice_play_thread)
 
-    def __voice_synthesis(self, ch:Character, text:str):
-        """受け取ったテキストで音声合成し、得られたwavをキューに追加する。"""
+    def __print_voice(self, entry:list):
+        """ボイス再生の開始時にコンソール出力（表示済みでなければ）"""
+        handle, wav_path, text, ch, printed = entry
+        if not printed:
+            ch.console('{} : {}'.format(ch.name, text))
+            entry[4] = True
+
+    def __finish_voice(self, wav_path:str):
+        self.q_voice_play.task_done()
+        if wav_path:
+            os.remove(wav_path)
+            self.logger('Delete file : {}', wav_path, cls=self, fn=self.voice_play_thread)
+
+    def __put_filler(self, ch:Character, text:str, pcm:bytes, fmt) -> bool:
+        """何も再生していなければ、つなぎの音声を再生キューに入れる（コンソールには出さない）"""
+        duration = len(pcm) / float(fmt.rate * fmt.channels * fmt.width)
+        return self.q_voice_play.put_if_idle([None, text, ch, True, (pcm, fmt)], duration=duration)
+
+    def __voice_synthesis(self, ch:Character, text:str, printed:bool=False):
+        """受け取ったテキストで音声合成し、得られたwavをキューに追加する。
+
+        長い文は区切って並列に合成し、最初の塊ができたところから順にキューに追加する（再生を早く始められる）。
+        """
+
+        pcm_list = []
+        for i, wav_path in enumerate(self.voice_generator.text2voice_chunks(text, 
+                                '{}_{}'.format(time.time(), ch.id), 
+                                path=self.wav_path, 
+                                speaker=ch.voice_speaker_id,
+                                speed=ch.voice_speed,
+                                pitch=ch.voice_pitch,
+                                intonation=ch.voice_intonation, 
+                                volume=V_VOL,
+                                post=V_POST)):
+
+            # 再生後にwavは消えるので、アーカイブ用にPCMを取っておく
+            if self.audio_archive:
+                pcm, fmt = read_wave(wav_path)
+                pcm_list.append(pcm)
+
+            # テキストは最初の塊の再生前にだけ出す
+            self.__put_voice(ch, text, wav_path, printed=printed or i > 0)
+
+        if self.audio_archive and pcm_list:
+            utterance_id = self.audio_archive.append(ch.id, b''.join(pcm_list), fmt)
+            self.logger('[{}] Archived utterance {} : {}', ch.id, utterance_id, text, cls=self, fn=self.__voice_synthesis)
+
+    def __synthesize(self, ch:Character, text:str) -> str:
+        """音声合成してwavのパスを返す。"""
 
         wav_path = self.voice_generator.text2voice(text, 
-                                str(time.time()), 
-                                path=WAV_PATH, 
+                                '{}_{}'.format(time.time(), ch.id), 
+                                path=self.wav_path, 
                                 speaker=ch.voice_speaker_id,
                                 speed=ch.voice_speed,
                                 pitch=ch.voice_pitch,
                                 intonation=ch.voice_intonation, 
                                 volume=V_VOL,
                                 post=V_POST)
+
+        # 再生後にwavは消えるので、アーカイブに残しておく
+        if self.audio_archive:
+            utterance_id = self.audio_archive.append_wave(wav_path, ch.id)
+            self.logger('[{}] Archived utterance {} : {}', ch.id, utterance_id, text, cls=self, fn=self.__synthesize)
+
+        return wav_path
+
+    def __put_voice(self, ch:Character, text:str, wav_path:str, printed:bool=False):
         
-        self.q_voice_play.put([wav_path, text, ch])
+        self.q_voice_play.put([wav_path, text, ch, printed, None], duration=wave_duration(wav_path))
+        self.logger('[{}] voice buffer: {:.2f} sec / {} items', ch.id, self.q_voice_play.buffer_seconds, self.q_voice_play.qsize(), cls=self, fn=self.__put_voice)
 
 
 if __name__ == "__main__":
 
-    try:
-        os.environ['OPENAI_API_KEY']
-    except KeyError:
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument(
+        "-c", "--character",
+        type=str,
+        nargs='*',
+        default=[],
+        help="キャラクター名。複数指定可。",
+    )
+
+    parser.add_argument(
+        "-v", "--verbose",
+        type=bool,
+        default=False,
+        help="コンソールに情報を出力",
+    )
+
+    parser.add_argument(
+        "-r", "--resume",
+        type=str,
+        default='',
+        help="再開するセッションID。-cを省略するとそのセッションのキャラで再開。",
+    )
+
+    parser.add_argument(
+        "-l", "--list_sessions",
+        action='store_true',
+        help="保存されているセッションの一覧を表示",
+    )
+
+    parser.add_argument(
+        "-p", "--profile",
+        type=str,
+        nargs='?',
+        const='sampling',
+        default='',
+        choices=ThreadProfiler.MODES,
+        help="スレッドごとにプロファイルしてlog/<セッションID>/profileに出力。sampling（省略時）かdeterministic（Python 3.11以前のみ。3.12以降はsamplingになる）。",
+    )
+
+    parser.add_argument(
+        "--record",
+        action='store_true',
+        help="OpenAI・VOICEVOXとのやり取りとユーザー入力をlog/<セッションID>/cassetteに録音",
+    )
+
+    parser.add_argument(
+        "--replay",
+        type=str,
+        default='',
+        help="録音したセッションIDかカセットのディレクトリ。ネットワークに出ずに同じ会話を再生する。",
+    )
+
+    parser.add_argument(
+        "--replay_latency",
+        type=str,
+        default='original',
+        choices=Cassette.LATENCIES,
+        help="再生時のレイテンシ。original : 録音時と同じ / zero : 待たない",
+    )
+
+    opt = parser.parse_args()
+
+    if opt.list_sessions:
+        for session_id, info in sorted(SessionStore(LOG_PATH).sessions().items()):
+            print('{} : {} ({} lines, {})'.format(session_id, ' '.join(info["characters"]), info["lines"], info["updated"]))
+    elif not (opt.replay or os.getenv('OPENAI_API_KEY')):
+        # 再生時はAPIを呼ばないのでキーは不要
         print(u'OPENAI_API_KEY が設定されていません。')
     else:
-        parser = argparse.ArgumentParser()
-
-        parser.add_argument(
-            "-c", "--character",
-            type=str,
-            nargs='*',
-            default=[],
-            help="キャラクター名。複数指定可。",
-        )
-
-        parser.add_argument(
-            "-v", "--verbose",
-            type=bool,
-            default=False,
-            help="コンソールに情報を出力",
-        )
-
-        opt = parser.parse_args()
-
-        MultiCharacterTalking(ch_id_list=opt.character, verbose=opt.verbose)
\ No newline at end of file
+        MultiCharacterTalking(ch_id_list=opt.character, 
+                                verbose=opt.verbose, 
+                                resume=opt.resume, 
+                                profile=opt.profile, 
+                                record=opt.record, 
+                                replay=opt.replay, 
+                                replay_latency=opt.replay_latency)
\ No newline at end of file
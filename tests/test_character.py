@@ -0,0 +1,38 @@
+"""Characterの返答作成のテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+import os
+
+import pytest
+from openai.util import convert_to_openai_object
+
+from ai_character import character
+from ai_character.character import Character, response_max_tokens, trim_incomplete_sentence
+
+@pytest.mark.parametrize("text, expected", [
+    ("そうなんだ。でも今日は", "そうなんだ。"),
+    ("本当に？うれしい！また", "本当に？うれしい！"),
+    ("区切りが無い", "区切りが無い"),
+])
+def test_trim_incomplete_sentence(text, expected):
+    assert trim_incomplete_sentence(text) == expected
+
+def test_truncated_reply_is_trimmed(tmp_path, monkeypatch):
+    ch = Character(os.path.abspath('character_data'), 'dereko', str(tmp_path), 'test')
+    requests = []
+
+    def fake_call(call_type, fn, **kwargs):
+        requests.append(kwargs)
+        return convert_to_openai_object({
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": "べ、別に。待ってたわけじゃ"}, "finish_reason": "length"}],
+            "usage": {"prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+        })
+
+    monkeypatch.setattr(character, 'hedged_call', fake_call)
+
+    messages = ch.create_messages(user_input='おはよう', user_name='ユーザー', words=10)
+    content, usage = ch.talk(messages, max_tokens=response_max_tokens(10))
+
+    assert content == "べ、別に。"
+    assert requests[0]["max_tokens"] == response_max_tokens(10)
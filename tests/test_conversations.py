@@ -0,0 +1,38 @@
+"""Conversationsの階層要約のテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+import pytest
+
+from ai_character import conversations
+from ai_character.conversations import Conversations
+
+def node(name:str, start:int, end:int) -> dict:
+    # estimate_tokensでは日本語1文字≒1トークン
+    return {"summary": name * 10, "start": start, "end": end}
+
+@pytest.fixture
+def conv(tmp_path):
+    conv = Conversations(log_dir=str(tmp_path), session_id='test')
+    conv._summary_levels = [
+        [node('ど', 48, 51), node('え', 52, 55), node('ふ', 56, 59)],
+        [node('び', 32, 39), node('し', 40, 47)],
+        [node('あ', 0, 31)],
+    ]
+    return conv
+
+def compose(conv:Conversations) -> list:
+    return [line[0] for line in conv._Conversations__compose_summary().split('\n')]
+
+def test_compose_summary_keeps_everything_within_budget(conv, monkeypatch):
+    monkeypatch.setattr(conversations, 'SUMMARY_MAX_TOKENS', 100)
+    assert compose(conv) == ['あ', 'び', 'し', 'ど', 'え', 'ふ']
+
+def test_compose_summary_overflow_keeps_top_level_and_newest(conv, monkeypatch):
+    monkeypatch.setattr(conversations, 'SUMMARY_MAX_TOKENS', 40)
+    # 長期の記憶（いちばん上のレベル）と直前の要約を残し、下のレベルの中ほどから削る
+    assert compose(conv) == ['あ', 'び', 'し', 'ふ']
+
+def test_compose_summary_top_level_always_kept(conv, monkeypatch):
+    monkeypatch.setattr(conversations, 'SUMMARY_MAX_TOKENS', 5)
+    assert compose(conv) == ['あ']
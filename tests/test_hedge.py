@@ -0,0 +1,104 @@
+"""ヘッジ付き呼び出し（複製リクエスト・レイテンシ計測・締め切り）のテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+import time
+
+import openai
+import pytest
+
+from ai_character import hedge
+from ai_character.retry import retry_decorator
+
+def test_failed_call_records_latency(monkeypatch):
+    tracker = hedge.LatencyTracker(min_samples=1)
+    monkeypatch.setitem(hedge._trackers, 'test_failed', tracker)
+    monkeypatch.setitem(hedge.DEADLINES, 'test_failed', {"timeout_seconds": 1, "hedge": False})
+
+    def slow_timeout(**kwargs):
+        time.sleep(0.05)
+        raise TimeoutError('request timed out')
+
+    with pytest.raises(TimeoutError):
+        hedge._hedged_call('test_failed', slow_timeout, {})
+
+    # 失敗しても、かかった秒数はp95の計算に入る
+    assert tracker.percentile(95) >= 0.05
+
+def test_deadline_covers_retries(monkeypatch):
+    monkeypatch.setitem(hedge.DEADLINES, 'test_deadline', {"timeout_seconds": 0.5, "hedge": False})
+    timeouts = []
+
+    def slow_timeout(**kwargs):
+        timeouts.append(kwargs['request_timeout'])
+        time.sleep(0.2)
+        raise openai.error.Timeout('request timed out')
+
+    @retry_decorator('test_deadline', endpoint='test_deadline')
+    def call():
+        return hedge.hedged_call('test_deadline', slow_timeout)
+
+    start = time.monotonic()
+    with pytest.raises(openai.error.Timeout):
+        call()
+
+    # 次の試行を待つと締め切り（0.5秒）を過ぎるので、リトライしない
+    assert len(timeouts) == 1
+    assert timeouts[0] <= 0.5
+    assert time.monotonic() - start < 0.5
+
+@pytest.fixture
+def hedged(monkeypatch):
+    """p95が0.05秒になるよう計測済みで、ヘッジ有りの呼び出し種別。"""
+    tracker = hedge.LatencyTracker(min_samples=1)
+    tracker.add(0.05)
+    monkeypatch.setitem(hedge._trackers, 'test_hedged', tracker)
+    monkeypatch.setitem(hedge.DEADLINES, 'test_hedged', {"timeout_seconds": 5, "hedge": True})
+    monkeypatch.setattr(hedge, 'metrics', hedge.HedgeMetrics())
+    return 'test_hedged'
+
+def test_hedge_fires_above_p95_and_win_is_counted(hedged):
+    calls = []
+
+    def slow_first(**kwargs):
+        calls.append(time.monotonic())
+        if len(calls) == 1:
+            time.sleep(0.5)
+            return 'primary'
+        return 'hedge'
+
+    assert hedge._hedged_call(hedged, slow_first, {}) == 'hedge'
+
+    # p95（0.05秒）を過ぎてから複製を送り、先に返った複製を採用する
+    assert len(calls) == 2
+    assert calls[1] - calls[0] >= 0.05
+    counts = hedge.metrics.snapshot({})[hedged]
+    assert counts['hedges'] == 1
+    assert counts['hedge_wins'] == 1
+
+def test_no_hedge_within_p95(hedged):
+    calls = []
+
+    def fast(**kwargs):
+        calls.append(1)
+        return 'primary'
+
+    assert hedge._hedged_call(hedged, fast, {}) == 'primary'
+    assert len(calls) == 1
+    assert hedge.metrics.snapshot({})[hedged]['hedges'] == 0
+
+def test_error_propagates_when_both_fail(hedged):
+    calls = []
+
+    def failing(**kwargs):
+        calls.append(1)
+        time.sleep(0.1)
+        raise openai.error.APIConnectionError('connection reset')
+
+    with pytest.raises(openai.error.APIConnectionError):
+        hedge._hedged_call(hedged, failing, {})
+
+    assert len(calls) == 2
+    counts = hedge.metrics.snapshot({})[hedged]
+    assert counts['hedges'] == 1
+    assert counts['hedge_wins'] == 0
@@ -0,0 +1,81 @@
+"""BoundedHistoryのスナップショット・復元と、ファイル読み込み中のロックのテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+import os
+import threading
+
+import pytest
+
+from ai_character.history import BoundedHistory, ConversationLine
+
+def make_history(tmp_path, count:int, max_resident:int=3) -> BoundedHistory:
+    history = BoundedHistory(os.path.join(str(tmp_path), 'history.jsonl'), ConversationLine.from_dict, max_resident)
+    for i in range(count):
+        history.append(ConversationLine('user', 'line {}'.format(i)))
+        history.spill()
+    return history
+
+def contents(history:BoundedHistory) -> list:
+    return [line.content for line in history]
+
+@pytest.mark.parametrize("with_bytes", [True, False])
+def test_restore_truncates_later_spills(tmp_path, with_bytes):
+    history = make_history(tmp_path, 10)
+    records, offset, spill_bytes = history.snapshot()
+    assert offset == 7
+
+    # スナップショット後に外したぶんは、戻すと捨てられる
+    for i in range(10, 15):
+        history.append(ConversationLine('user', 'line {}'.format(i)))
+        history.spill()
+
+    restored = BoundedHistory(history.spill_path, ConversationLine.from_dict, 3)
+    if with_bytes:
+        restored.restore(records, offset, spill_bytes)
+    else:
+        restored.restore(records, offset) # バイト数の無い古いスナップショット
+    assert os.path.getsize(history.spill_path) == spill_bytes
+    assert contents(restored) == ['line {}'.format(i) for i in range(10)]
+
+    # 戻した後に外したぶんも読める
+    for i in range(10, 13):
+        restored.append(ConversationLine('user', 'line {}'.format(i)))
+        restored.spill()
+    assert contents(restored) == ['line {}'.format(i) for i in range(13)]
+    assert restored.snapshot()[2] == os.path.getsize(history.spill_path)
+
+def test_restore_rejects_short_spill_file(tmp_path):
+    history = make_history(tmp_path, 10)
+    records, offset, spill_bytes = history.snapshot()
+
+    restored = BoundedHistory(os.path.join(str(tmp_path), 'missing.jsonl'), ConversationLine.from_dict, 3)
+    with pytest.raises(ValueError):
+        restored.restore(records, offset, spill_bytes)
+
+def test_reading_spilled_record_does_not_hold_lock(tmp_path):
+    history = make_history(tmp_path, 10)
+    reading = threading.Event()
+    release = threading.Event()
+
+    def slow_decode(data:dict):
+        reading.set()
+        release.wait(5)
+        return ConversationLine.from_dict(data)
+
+    history.decode = slow_decode
+    reader = threading.Thread(target=lambda: history[0])
+    reader.start()
+    assert reading.wait(5)
+
+    # ファイルから読んでいる間も、追加とspillは待たされない
+    appender = threading.Thread(target=lambda: (history.append(ConversationLine('user', 'line 10')), history.spill()))
+    appender.start()
+    appender.join(1)
+    blocked = appender.is_alive()
+    release.set()
+    reader.join(5)
+    appender.join(5)
+
+    assert not blocked
+    assert len(history) == 11 and history.offset == 8
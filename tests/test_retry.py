@@ -0,0 +1,93 @@
+"""サーキットブレーカーのopen・half_open・回復のテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+import time
+
+import openai
+import pytest
+
+from ai_character.retry import CircuitBreaker, CircuitOpenError, retry_decorator, get_circuit_breaker
+
+def open_breaker(endpoint:str) -> CircuitBreaker:
+    """threshold回の一時的エラーでopenにし、すぐhalf_openの試行を通せるようにする。"""
+    breaker = get_circuit_breaker(endpoint)
+    breaker.reset_seconds = 0.0
+    for _ in range(breaker.threshold):
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.end_call()
+    assert breaker.state == 'open'
+    return breaker
+
+@pytest.mark.parametrize("error", [
+    openai.error.InvalidRequestError('bad request', 'messages'),
+    KeyError('choices'),
+])
+def test_non_transient_trial_closes_breaker(error):
+    endpoint = 'test_trial_{}'.format(type(error).__name__)
+    breaker = open_breaker(endpoint)
+
+    @retry_decorator('test', endpoint=endpoint)
+    def failing():
+        raise error
+
+    @retry_decorator('test', endpoint=endpoint)
+    def ok():
+        return 'ok'
+
+    with pytest.raises(type(error)):
+        failing()
+
+    # 応答はあったので閉じ、次の呼び出しは通る
+    assert breaker.state == 'closed'
+    assert ok() == 'ok'
+
+def test_interrupted_trial_is_released():
+    breaker = open_breaker('test_trial_interrupted')
+
+    # 成功・失敗を記録せずに終わった試行
+    breaker.before_call()
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+    breaker.end_call()
+
+    breaker.before_call()
+    breaker.record_success()
+    breaker.end_call()
+    assert breaker.state == 'closed'
+
+def test_open_breaker_recovers_through_half_open():
+    breaker = CircuitBreaker('test_recover', threshold=2, reset_seconds=0.05)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.end_call()
+
+    # reset_seconds経つまでは呼び出しを通さない
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    assert breaker.state == 'half_open'
+    breaker.record_success()
+    breaker.end_call()
+    assert breaker.state == 'closed'
+
+def test_failed_trial_reopens_breaker():
+    breaker = CircuitBreaker('test_reopen', threshold=2, reset_seconds=0.05)
+    for _ in range(2):
+        breaker.before_call()
+        breaker.record_failure()
+        breaker.end_call()
+
+    time.sleep(0.06)
+    breaker.before_call()
+    breaker.record_failure()
+    breaker.end_call()
+
+    # 試行が失敗したらopenに戻り、またreset_seconds待つ
+    assert breaker.state == 'open'
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
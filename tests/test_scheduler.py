@@ -0,0 +1,26 @@
+"""PlaybackSchedulerのテスト。リポジトリのルートで実行する（settings.jsonを読むので）。
+
+    python -m pytest -q tests
+"""
+from ai_character.scheduler import PlaybackScheduler
+
+def test_put_if_idle_only_when_nothing_queued_or_playing():
+    scheduler = PlaybackScheduler(max_seconds=10)
+
+    assert scheduler.put_if_idle('filler', 0.5)
+    # 再生待ちがあれば入れない
+    assert not scheduler.put_if_idle('filler', 0.5)
+
+    assert scheduler.get(timeout=0) == 'filler'
+    # 再生中も入れない
+    assert not scheduler.put_if_idle('filler', 0.5)
+    scheduler.task_done()
+
+    scheduler.put('reply', 1.0)
+    assert not scheduler.put_if_idle('filler', 0.5)
+    assert scheduler.get(timeout=0) == 'reply'
+    scheduler.task_done()
+
+    assert scheduler.idle()
+    assert scheduler.put_if_idle('filler', 0.5)
+    assert scheduler.buffer_seconds == 0.5